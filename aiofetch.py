@@ -0,0 +1,161 @@
+import asyncio
+import http.client
+import random
+import ssl
+from urllib.parse import urlsplit, urljoin
+
+
+# Statuses whose Location is followed, and how many times in a row
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class FetchError(Exception):
+    """ Raised when a request still fails after all of its retries """
+    def __init__(self, url, status=None, reason=None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        super(FetchError, self).__init__("Fetching {0} failed: {1}".format(url, reason or status))
+
+
+class ConnectionPool(object):
+    """ Keeps idle HTTP/1.1 connections open so later requests skip the TCP and TLS handshake
+
+        Args:
+            max_idle (int): idle connections kept per host
+    """
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = {}
+
+    async def acquire(self, scheme, host, port):
+        idle = self._idle.get((scheme, host, port))
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        context = None
+        if scheme == 'https':
+            # Follows ssl._create_default_https_context, which magogenie.py relaxes
+            context = ssl._create_default_https_context()
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        return reader, writer, False
+
+    def release(self, scheme, host, port, reader, writer):
+        idle = self._idle.setdefault((scheme, host, port), [])
+        if len(idle) < self.max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for idle in self._idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self._idle = {}
+
+
+async def _read_body(reader, headers, status):
+    if status in (204, 304) or 100 <= status < 200:
+        return b'', True
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the blank line ending the message
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks), True
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+    if headers.get('Content-Length') is not None:
+        return await reader.readexactly(int(headers['Content-Length'])), True
+    # No framing: the body runs until the server closes the connection
+    return await reader.read(), False
+
+
+async def _request(pool, url, headers):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    port = parts.port or (443 if scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    lines = ['GET {0} HTTP/1.1'.format(path), 'Host: {0}'.format(parts.netloc), 'Connection: keep-alive', 'Accept-Encoding: identity']
+    for name, value in (headers or {}).items():
+        lines.append('{0}: {1}'.format(name, value))
+
+    reader, writer, reused = await pool.acquire(scheme, parts.hostname, port)
+    try:
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by {0}".format(parts.hostname))
+        status = int(status_line.split()[1])
+        response_headers = http.client.HTTPMessage()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip()] = value.strip()
+        body, reusable = await _read_body(reader, response_headers, status)
+    except BaseException:
+        writer.close()
+        raise
+    if reusable and response_headers.get('Connection', '').lower() != 'close':
+        pool.release(scheme, parts.hostname, port, reader, writer)
+    else:
+        writer.close()
+    return status, body, response_headers
+
+
+class AsyncFetcher(object):
+    """ Fetches many URLs from one event loop over pooled keep-alive connections
+
+        Args:
+            concurrency (int): requests allowed in flight at once
+            timeout (float): seconds allowed for a single attempt
+            retries (int): extra attempts after a failure, timeout or 429/5xx response
+            backoff (float): base delay in seconds, doubled on each retry and jittered
+    """
+    def __init__(self, concurrency, timeout, retries, backoff):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = ConnectionPool(concurrency)
+        self._semaphore = None
+
+    async def fetch(self, url, headers=None):
+        """ Returns (status, body, headers) for url, following redirects; 304 is returned, other 3xx and 4xx raise FetchError """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        attempt = 0
+        redirects = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    status, body, response_headers = await asyncio.wait_for(_request(self.pool, url, headers), self.timeout)
+                if status in REDIRECT_STATUSES and response_headers.get('Location') and redirects < MAX_REDIRECTS:
+                    url = urljoin(url, response_headers['Location'])
+                    redirects += 1
+                    continue
+                if status < 300 or status == 304:
+                    return status, body, response_headers
+                if status != 429 and status < 500:
+                    raise FetchError(url, status)
+                error = FetchError(url, status)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+                error = FetchError(url, reason=repr(e))
+            if attempt >= self.retries:
+                raise error
+            await asyncio.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+
+    def close(self):
+        self.pool.close()
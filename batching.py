@@ -0,0 +1,149 @@
+import collections
+import json
+import os
+
+
+class BatchPlanner(object):
+    """ Chooses how many question ids go into each QUESTION_URL request
+
+        The planner keeps a moving average of the seconds and bytes the server
+        needs per question id and sizes batches so one request stays within
+        target_seconds and target_bytes. It grows at most 2x per measurement,
+        shrinks straight away and never builds a URL longer than
+        max_url_length. A failed request halves the size and caps growth just
+        below the size that failed; the cap is probed upwards one id at a time
+        as requests succeed again. The size it settles on is saved to
+        state_path and used as the starting size of the next run.
+
+        Args:
+            url_template (str): QUESTION_URL, with %s for the comma separated ids
+            initial_size (int): batch size used when there is no saved state
+            min_size (int), max_size (int): bounds for the batch size
+            target_seconds (float): response time aimed for per request
+            target_bytes (int): response size aimed for per request
+            max_url_length (int): longest request URL the planner will build
+            state_path (str): JSON file the settled size is kept in between runs
+    """
+    # Weight of the newest measurement in the moving averages
+    SMOOTHING = 0.3
+
+    def __init__(self, url_template, initial_size, min_size, max_size, target_seconds, target_bytes, max_url_length, state_path=None):
+        self.url_template = url_template
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.max_url_length = max_url_length
+        self.state_path = state_path
+        self.seconds_per_id = None
+        self.bytes_per_id = None
+        self.size = self._clamp(self._load_size(initial_size))
+        self.ceiling = max_size
+
+    def _clamp(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def _load_size(self, default):
+        return self.load_state().get('batch_size', default)
+
+    def load_state(self):
+        """ What the last run saved: batch_size, seconds_per_id and bytes_per_id; {} when nothing was saved """
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def save(self):
+        if not self.state_path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        state = {'batch_size': self.size, 'seconds_per_id': self.seconds_per_id, 'bytes_per_id': self.bytes_per_id}
+        with open(self.state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+
+    def next_batch(self, pending):
+        """ Pops the next batch of ids off the front of the pending deque """
+        batch = [pending.popleft()]
+        while pending and len(batch) < self.size:
+            candidate = batch + [pending[0]]
+            if len(self.url_template % ','.join(map(str, candidate))) > self.max_url_length:
+                break
+            batch.append(pending.popleft())
+        return batch
+
+    def _average(self, current, sample):
+        if current is None:
+            return sample
+        return current + self.SMOOTHING * (sample - current)
+
+    def record(self, requested, elapsed, nbytes):
+        """ Adjusts the batch size after a request for `requested` ids succeeded """
+        if requested <= 0:
+            return
+        self.seconds_per_id = self._average(self.seconds_per_id, elapsed / requested)
+        self.bytes_per_id = self._average(self.bytes_per_id, nbytes / requested)
+        ideal = self.max_size
+        if self.seconds_per_id > 0:
+            ideal = min(ideal, self.target_seconds / self.seconds_per_id)
+        if self.bytes_per_id > 0:
+            ideal = min(ideal, self.target_bytes / self.bytes_per_id)
+        if ideal > self.size:
+            ideal = min(ideal, self.size * 2, self.ceiling)
+        if requested >= self.ceiling:
+            self.ceiling += 1
+        self.size = self._clamp(ideal)
+
+    def record_failure(self, batch):
+        """ Shrinks the batch size and returns the halves of a failed batch to retry """
+        self.ceiling = max(self.min_size, len(batch) - 1)
+        self.size = self._clamp(min(self.size, len(batch)) // 2)
+        middle = (len(batch) + 1) // 2
+        return [part for part in (batch[:middle], batch[middle:]) if part]
+
+
+class QuestionFeed(object):
+    """ Question ids for a fetch engine to request, which may still be arriving
+
+        The engines take batches off `pending` with BatchPlanner.next_batch.
+        While the feed is open more ids may be add()ed, by the crawl as it
+        reads the topics of the tree document, and the engines wait for them
+        instead of finishing; close() says no more are coming. Every
+        listener is called, on the thread that adds, whenever ids are added
+        or the feed is closed. A feed made from a list is closed already.
+
+        Args:
+            question_ids (list): ids to start with
+            closed (bool): whether more ids may be added
+    """
+    def __init__(self, question_ids=(), closed=True):
+        self.pending = collections.deque(question_ids)
+        self.closed = closed
+        self._listeners = []
+
+    def listen(self, listener):
+        self._listeners.append(listener)
+
+    def add(self, question_ids):
+        self.pending.extend(question_ids)
+        self._notify()
+
+    def close(self):
+        self.closed = True
+        self._notify()
+
+    def _notify(self):
+        for listener in self._listeners:
+            listener()
+
+
+class Note(object):
+    """ Something other than a batch put on the queue of a fetch engine, which
+        the engine yields as it comes, in order with the batches around it """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
@@ -0,0 +1,428 @@
+#############################################################################
+#   python bench.py convert [corpus.jsonl ...]   # questions per second     #
+#   python bench.py record-corpus <corpus.jsonl> # corpus from the cache    #
+#   python bench.py suite [--sizes 100,400] [--baseline bench.json]         #
+#   python bench.py memory [--questions 20000] [--boards 3]  # peak RSS     #
+#                                                                           #
+#   A corpus is line-delimited JSON, one record per converted string:       #
+#   {"q_id", "flag", "content", "mathml": {fragment: latex}}. The LaTeX     #
+#   recorded for each MathML fragment is replayed, so converting a corpus   #
+#   needs neither mmltex.xsl nor xsltproc.                                  #
+#                                                                           #
+#   The suite crawls fixture stores of several sizes through a local        #
+#   replay server (see replay.py) and reports the rate of each stage.       #
+#   --save-baseline keeps the rates; --baseline compares against them and   #
+#   exits with status 1 when a stage got slower than REGRESSION_TOLERANCE.  #
+#                                                                           #
+#   memory crawls a multi-board store into one tree and reports the peak    #
+#   RSS of the crawl, and what the tree and its questions would take as     #
+#   plain dicts, as they were held before the compact records.              #
+#############################################################################
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import pickle
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import html2text
+import magogenie
+from magogenie import *
+from replay import ReplayServer, generate_fixtures
+from images import ImageStore
+from records import Record, as_plain
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# Fixture store sizes, in questions, the suite runs every stage at
+SIZES = (100, 400, 1600)
+# A stage regresses when its rate drops more than this below the baseline
+REGRESSION_TOLERANCE = 0.2
+
+
+def legacy_convert_question_content(content, q_id, flag):
+    """ convert_question_content as it was before the rewrite rules were compiled,
+        kept as the reference the compiled rules must match byte for byte
+    """
+    content = re.sub(IMG_ALT_REGEX, lambda m: "".format(m.group(0)), content)
+    if flag:
+        content = content
+        content = content.replace('$$','$')
+
+    content = content.replace("\n", "@@@@")
+    if len(re.findall(r"<math.*?</math>", content)) > 0:
+        content = re.sub(r"<math.*?</math>", lambda x : magogenie.mathml_to_latex(x, q_id), content)
+        content = re.sub(r"(\\overline{\)[\\ ]+})", lambda m:"\_\_\_\_\_\_\_\_\_".format(m.group(0)), content)
+        content = content.replace('\_','_').replace('\\mathrm{__}','___').replace('--',' - - -').replace('-',' -')
+
+    content = content.replace("@@@@", "\n")
+    if len(re.findall(REGEX_BASE64, content))  > 0:
+        content = content.replace('\n','').replace('\r','').replace('&#10;', '')
+
+    content = content.replace(url,'').replace('../..','').replace("..",'')
+    content = re.sub(REGEX_IMAGE, lambda m: url+"{}".format(m.group(0)) if url not in m.group(0) else "{}".format(m.group(0)), content)
+    content = html2text.html2text(content)
+
+    content = content.replace("\\\\","\\")
+    content = re.sub(r"___", lambda m: ("\_\_\_") .format(m.group(0)), content)
+    content = content.replace('\\___$','\\_$').replace('\overline{ }','\_\_\_\_\_\_\_\_\_').replace('\\__','\\_').replace("\\_","\_")
+    content = re.sub(REGEX_GIF, lambda m: "image/png".format(m.group(0)), content)
+    content = re.sub(REGEX_BMP, lambda m: "image/png".format(m.group(0)), content)
+
+    if not flag:
+        content = content.replace('$$','$')
+    return content
+
+
+def corpus_files():
+    return sorted(glob.glob(os.path.join(FIXTURES_DIR, '*corpus*.jsonl')))
+
+
+def load_corpus(paths):
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def replay_mathml(records):
+    """ Returns a stand-in for magogenie.mathml_to_latex serving the LaTeX recorded in records """
+    recorded = {}
+    for record in records:
+        recorded.update(record.get('mathml', {}))
+    def mathml_to_latex(match, q_id):
+        return recorded[match.group().replace("&gt;",">").replace('@@@@','\n')]
+    return mathml_to_latex
+
+
+def record_corpus(path, limit=None):
+    """ Writes every question and answer in the response cache to a corpus file """
+    recorded = {}
+    convert_mathml = magogenie.mathml_to_latex
+    def mathml_to_latex(match, q_id):
+        latex = convert_mathml(match, q_id)
+        recorded[match.group().replace("&gt;",">").replace('@@@@','\n')] = latex
+        return latex
+    magogenie.mathml_to_latex = mathml_to_latex
+
+    count = 0
+    with open(path, 'w', encoding='utf-8') as out:
+        for filename in glob.glob(os.path.join(RESPONSE_CACHE.path, '*', '*.json')):
+            with open(filename, encoding='utf-8') as f:
+                entry = json.load(f)
+            value = entry['value']
+            if not entry['key'].startswith('question:') or not value.get('success'):
+                continue
+            strings = [(str(value['question']['id']), str(value['question']['content']), True)]
+            strings += [(str(answer['id']), answer['content'], False) for answer in value['possible_answers']]
+            for q_id, content, flag in strings:
+                recorded.clear()
+                try:
+                    convert_question_content(content, q_id, flag)
+                except Exception as e:
+                    print (e)
+                    continue
+                out.write(json.dumps({'q_id': q_id, 'flag': flag, 'content': content, 'mathml': dict(recorded)}) + '\n')
+                count += 1
+            if limit and count >= limit:
+                break
+    magogenie.mathml_to_latex = convert_mathml
+    print ("Recorded {0} strings to {1}".format(count, path))
+
+
+def time_conversion(convert, records, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for record in records:
+            convert(record['content'], record['q_id'], record['flag'])
+    return time.perf_counter() - start
+
+
+def bench_convert(paths, repeat=20):
+    records = load_corpus(paths or corpus_files())
+    magogenie.mathml_to_latex = replay_mathml(records)
+    # The legacy function left images inline; compare like with like
+    magogenie.IMAGE_STORE = None
+    for record in records:
+        if legacy_convert_question_content(record['content'], record['q_id'], record['flag']) != \
+                convert_question_content(record['content'], record['q_id'], record['flag']):
+            print ("Output differs for {0}".format(record['q_id']))
+    count = len(records) * repeat
+    print ("convert_question_content over {0} strings x {1}".format(len(records), repeat))
+    print ("  before: {0:10.1f} questions/s".format(count / time_conversion(legacy_convert_question_content, records, repeat)))
+    print ("  after:  {0:10.1f} questions/s".format(count / time_conversion(convert_question_content, records, repeat)))
+    # Leave the Markdown conversion out to see the rewrite rules alone
+    convert_html = html2text.html2text
+    html2text.html2text = lambda content: content
+    magogenie.MARKDOWN.convert = lambda content: content
+    try:
+        print ("rewrite rules only, excluding the Markdown conversion")
+        print ("  before: {0:10.1f} questions/s".format(count / time_conversion(legacy_convert_question_content, records, repeat)))
+        print ("  after:  {0:10.1f} questions/s".format(count / time_conversion(convert_question_content, records, repeat)))
+    finally:
+        html2text.html2text = convert_html
+        del magogenie.MARKDOWN.convert
+    bench_markdown(records, repeat)
+
+
+def markdown_inputs(records):
+    """ The HTML convert_question_content hands to the Markdown conversion for every record """
+    inputs = []
+    convert = magogenie.MARKDOWN.convert
+    magogenie.MARKDOWN.convert = lambda content: inputs.append(content) or convert(content)
+    try:
+        for record in records:
+            convert_question_content(record['content'], record['q_id'], record['flag'])
+    finally:
+        del magogenie.MARKDOWN.convert
+    return inputs
+
+
+def bench_markdown(records, repeat):
+    inputs = markdown_inputs(records)
+    converter = magogenie.MARKDOWN
+    for content in inputs:
+        if converter.convert(content) != html2text.html2text(content):
+            print ("Markdown differs for {0!r}".format(content))
+    def rate(convert):
+        start = time.perf_counter()
+        for i in range(repeat):
+            for content in inputs:
+                convert(content)
+        return len(inputs) * repeat / (time.perf_counter() - start)
+    converter.take_counters()
+    print ("Markdown conversion alone")
+    print ("  html2text:        {0:10.1f} strings/s".format(rate(html2text.html2text)))
+    print ("  QuestionMarkdown: {0:10.1f} strings/s".format(rate(converter.convert)))
+    counters = converter.take_counters()
+    print ("  {0} of {1} strings converted directly".format(counters['direct'] // repeat, len(inputs)))
+
+
+@contextlib.contextmanager
+def replayed_crawl(store, workdir, **server_options):
+    """ Points magogenie at a ReplayServer for store, with empty caches under workdir
+
+        MathML is converted with the LaTeX recorded in the store and remote
+        images are not prefetched, so the crawl runs offline. Everything is
+        put back on exit.
+    """
+    names = ('TREE_URL', 'QUESTION_URL', 'STATE_DIR', 'RESPONSE_CACHE', 'TOPIC_STORE', 'MATHML_CACHE', 'convert_mathml',
+             'PAYLOAD_CACHE', 'IMAGE_STORE', 'INLINE_IMAGES', 'PREFETCH_IMAGES', 'CHECKPOINT_JOURNAL', 'SNAPSHOT_PATH')
+    saved = dict((name, getattr(magogenie, name)) for name in names)
+    with ReplayServer(store, **server_options) as server:
+        magogenie.TREE_URL = server.tree_url
+        magogenie.QUESTION_URL = server.question_url
+        magogenie.STATE_DIR = os.path.join(workdir, 'state')
+        magogenie.RESPONSE_CACHE = ResponseCache(os.path.join(workdir, 'cache'), CACHE_TTL, CACHE_MAX_BYTES)
+        magogenie.TOPIC_STORE = ResponseCache(os.path.join(workdir, 'topics'), TOPIC_STORE_TTL, TOPIC_STORE_MAX_BYTES)
+        magogenie.MATHML_CACHE = ConversionCache(lambda mathml: magogenie.convert_mathml(mathml), MATHML_CACHE_SIZE)
+        magogenie.convert_mathml = lambda mathml: store.mathml.get(mathml, '')
+        magogenie.PAYLOAD_CACHE = ConversionCache(magogenie.PAYLOAD_CACHE.convert, PAYLOAD_CACHE_SIZE)
+        magogenie.IMAGE_STORE = ImageStore(os.path.join(workdir, 'images'))
+        magogenie.INLINE_IMAGES = ConversionCache(lambda data_uri: magogenie.extract_image(data_uri), IMAGE_CACHE_SIZE)
+        magogenie.PREFETCH_IMAGES = False
+        magogenie.CHECKPOINT_JOURNAL = os.path.join(workdir, 'journal.sqlite')
+        magogenie.SNAPSHOT_PATH = os.path.join(workdir, 'snapshot.jsonl.gz')
+        try:
+            yield server
+        finally:
+            for name, value in saved.items():
+                setattr(magogenie, name, value)
+
+
+def best_time(run, repeat):
+    """ Shortest of `repeat` runs of run(workdir), each with a fresh working directory """
+    best = None
+    for i in range(repeat):
+        workdir = tempfile.mkdtemp(prefix='magogenie-bench-')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                elapsed = run(workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_crawl(store, repeat, **server_options):
+    """ Questions per second for a cold get_magogenie_info_url, and the tree it built """
+    result = []
+    def run(workdir):
+        with replayed_crawl(store, workdir, **server_options):
+            start = time.perf_counter()
+            result[:] = get_magogenie_info_url(incremental=False, boards=None, standards=None)
+            return time.perf_counter() - start
+    return len(store.questions) / best_time(run, repeat), result
+
+
+def bench_question_list(store, repeat, **server_options):
+    """ Questions per second through question_list, one QUESTION_BATCH_SIZE batch at a time """
+    ids = store.question_ids()
+    def run(workdir):
+        with replayed_crawl(store, workdir, **server_options):
+            start = time.perf_counter()
+            for offset in range(0, len(ids), QUESTION_BATCH_SIZE):
+                question_list(ids[offset:offset + QUESTION_BATCH_SIZE])
+            return time.perf_counter() - start
+    return len(ids) / best_time(run, repeat)
+
+
+def bench_convert_sized(records, size, repeat):
+    """ Strings per second through convert_question_content for `size` corpus strings """
+    records = [records[i % len(records)] for i in range(size)]
+    convert, image_store = magogenie.mathml_to_latex, magogenie.IMAGE_STORE
+    magogenie.mathml_to_latex = replay_mathml(records)
+    workdir = tempfile.mkdtemp(prefix='magogenie-images-')
+    magogenie.IMAGE_STORE = ImageStore(workdir)
+    try:
+        # One untimed pass stores the images and warms the caches
+        time_conversion(convert_question_content, records, 1)
+        return size / min(time_conversion(convert_question_content, records, 1) for i in range(repeat))
+    finally:
+        magogenie.mathml_to_latex, magogenie.IMAGE_STORE = convert, image_store
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_build_tree(sourcetree, questions, repeat):
+    """ Questions per second turned into ricecooker nodes by _build_tree """
+    def run(workdir):
+        channel = nodes.ChannelNode(source_domain="magogenie.com", source_id="bench", title="bench")
+        start = time.perf_counter()
+        magogenie._build_tree(channel, sourcetree)
+        return time.perf_counter() - start
+    return questions / best_time(run, repeat)
+
+
+def run_suite(sizes=SIZES, repeat=3, latency=0.0, error_rate=0.0):
+    """ Runs every stage at every size and returns {stage[size]: rate} """
+    options = {'latency': latency, 'error_rate': error_rate, 'seed': 1}
+    corpus = load_corpus(corpus_files())
+    results = {}
+    for size in sizes:
+        workdir = tempfile.mkdtemp(prefix='magogenie-fixtures-')
+        try:
+            store = generate_fixtures(workdir, size)
+            questions = len(store.questions)
+            results['crawl[{0}]'.format(size)], sourcetree = bench_crawl(store, repeat, **options)
+            results['question_list[{0}]'.format(size)] = bench_question_list(store, repeat, **options)
+            results['convert_question_content[{0}]'.format(size)] = bench_convert_sized(corpus, size, repeat)
+            results['_build_tree[{0}]'.format(size)] = bench_build_tree(sourcetree, questions, repeat)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def deep_size(value, seen=None):
+    """ Bytes taken by value and everything it holds, counting every object once """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in value)
+    elif isinstance(value, Record):
+        size += sum(deep_size(getattr(value, name), seen) for name in value.__slots__)
+    return size
+
+
+def tree_questions(children):
+    for child in children:
+        for question in child.get('questions', []):
+            yield question
+        for question in tree_questions(child.get('children', [])):
+            yield question
+
+
+def bench_memory(questions, boards):
+    """ Peak RSS of a cold get_magogenie_info_url over a store of `questions` questions
+        spread over `boards` boards, and the size of the tree and questions it built
+    """
+    workdir = tempfile.mkdtemp(prefix='magogenie-bench-')
+    try:
+        store = generate_fixtures(os.path.join(workdir, 'store'), questions,
+                                  boards=['BalBharati'] + ['Board{0}'.format(i) for i in range(2, boards + 1)])
+        with contextlib.redirect_stdout(io.StringIO()):
+            with replayed_crawl(store, os.path.join(workdir, 'crawl')):
+                tree = get_magogenie_info_url(incremental=False, boards=None, standards=None)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    records = list(tree_questions(tree))
+    plain = [as_plain(question) for question in records]
+    print ("{0} questions over {1} boards".format(len(records), boards))
+    print ("  peak RSS, crawl process:  {0:10.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6))
+    print ("  peak RSS, largest worker: {0:10.1f} MB".format(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6))
+    print ("  tree held in memory:      {0:10.1f} MB, {1:.1f} MB as dicts".format(deep_size(tree) / 1e6, deep_size(as_plain(tree)) / 1e6))
+    print ("  questions pickled:        {0:10.1f} MB, {1:.1f} MB as dicts".format(
+        sum(len(pickle.dumps(question)) for question in records) / 1e6, sum(len(pickle.dumps(question)) for question in plain) / 1e6))
+
+
+def compare_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """ Prints every rate against the baseline and returns the stages that regressed """
+    regressions = []
+    for name, rate in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            print ("  {0:36} {1:10.1f}/s".format(name, rate))
+            continue
+        change = rate / before - 1
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print ("  {0:36} {1:10.1f}/s {2:+7.1%}{3}".format(name, rate, change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the magogenie chef")
+    commands = parser.add_subparsers(dest='command')
+    convert = commands.add_parser('convert', help="convert_question_content before and after over corpus files")
+    convert.add_argument('corpus', nargs='*')
+    record = commands.add_parser('record-corpus', help="write a corpus from the response cache")
+    record.add_argument('corpus')
+    suite = commands.add_parser('suite', help="crawl, question_list, conversion and _build_tree rates at several sizes")
+    suite.add_argument('--sizes', default=','.join(map(str, SIZES)), help="fixture sizes in questions, comma separated")
+    suite.add_argument('--repeat', type=int, default=3, help="runs per measurement; the fastest counts")
+    suite.add_argument('--latency', type=float, default=0.0, help="seconds the replay server waits per request")
+    suite.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    suite.add_argument('--baseline', help="JSON rates to compare against")
+    suite.add_argument('--save-baseline', help="write the rates to this JSON file")
+    suite.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    memory = commands.add_parser('memory', help="peak RSS and tree size of a multi-board crawl")
+    memory.add_argument('--questions', type=int, default=20000)
+    memory.add_argument('--boards', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        bench_convert(args.corpus)
+    elif args.command == 'record-corpus':
+        record_corpus(args.corpus)
+    elif args.command == 'suite':
+        results = run_suite([int(size) for size in args.sizes.split(',')], args.repeat, args.latency, args.error_rate)
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        regressions = compare_baseline(results, baseline, args.tolerance)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if regressions:
+            print ("Regressed: " + ", ".join(regressions))
+            sys.exit(1)
+    elif args.command == 'memory':
+        bench_memory(args.questions, args.boards)
+    else:
+        parser.print_help()
@@ -0,0 +1,292 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+
+# Conditional request headers for revalidating a cached entry
+def validator_headers(entry):
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+# The end of an entry put() wrote, where 'stored' is the last member
+REGEX_STORED = re.compile(rb', "stored": ([-+.0-9eE]+)}$')
+
+
+class ResponseCache(object):
+    """ Persistent on-disk cache of decoded JSON responses
+
+        Every entry is stored in its own file so that pool workers can read
+        and write the cache at the same time. Writes go through a temporary
+        file and os.replace, so readers never see a half written entry.
+
+        Args:
+            path (str): directory holding the cache entries
+            ttl (int): seconds an entry is served without revalidation
+            max_bytes (int): size above which least recently used entries are evicted
+    """
+    def __init__(self, path, ttl, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._written = 0
+
+    def _filename(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.json')
+
+    def get(self, key):
+        """ Returns the entry stored under key or None """
+        filename = self._filename(key)
+        try:
+            with open(filename, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            # mtime doubles as the last access time used for eviction
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl
+
+    def put(self, key, value, url=None, etag=None, last_modified=None):
+        entry = {
+            'key': key,
+            'value': value,
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored': time.time(),
+        }
+        self._write(key, entry)
+        return entry
+
+    def refresh(self, key, entry):
+        """ Marks entry as fresh again after the server answered 304 Not Modified """
+        entry['stored'] = time.time()
+        self._write(key, entry)
+        return entry
+
+    def writer(self, key, url=None, etag=None, last_modified=None):
+        """ A StreamedEntry writing the JSON text given to it as the value of key """
+        return StreamedEntry(self, key, url, etag, last_modified)
+
+    def header(self, key):
+        """ The entry stored under key without its value, when a StreamedEntry wrote it, else None """
+        try:
+            with open(self._filename(key), 'rb') as f:
+                line = f.readline(StreamedEntry.MAX_HEADER)
+        except OSError:
+            return None
+        if not line.endswith(StreamedEntry.VALUE):
+            return None
+        try:
+            return json.loads(line[:-len(StreamedEntry.VALUE)].decode('utf-8') + '}')
+        except ValueError:
+            return None
+
+    def stored(self, key):
+        """ The time the entry under key was stored or None, read without its value or marking it as used """
+        header = self.header(key)
+        if header is not None:
+            return header['stored']
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - 64, 0))
+                match = REGEX_STORED.search(f.read())
+                if match:
+                    return float(match.group(1))
+                f.seek(0)
+                return json.loads(f.read().decode('utf-8'))['stored']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def iter_value(self, key, chunk_size=64 * 1024):
+        """ Yields the raw JSON text of the value a StreamedEntry wrote under key, in chunks of bytes """
+        filename = self._filename(key)
+        with open(filename, 'rb') as f:
+            f.readline(StreamedEntry.MAX_HEADER)
+            os.utime(filename, None)
+            pending = b''
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                # The closing brace of the entry is not part of the value
+                if pending:
+                    yield pending
+                pending = chunk
+            yield pending[:-1]
+
+    def refresh_streamed(self, key, header):
+        """ refresh() for an entry a StreamedEntry wrote, without decoding its value """
+        writer = self.writer(key, header.get('url'), header.get('etag'), header.get('last_modified'))
+        try:
+            for chunk in self.iter_value(key):
+                writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def _write(self, key, entry):
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            self._written += os.path.getsize(tmp)
+            os.replace(tmp, filename)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self._written > self.max_bytes // 16:
+            self.evict()
+
+    def evict(self):
+        """ Deletes least recently used entries until the cache fits in max_bytes """
+        self._written = 0
+        entries = []
+        total = 0
+        for root, dirs, filenames in os.walk(self.path):
+            for name in filenames:
+                filename = os.path.join(root, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% so that the next few writes don't trigger another walk
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+
+class StreamedEntry(object):
+    """ A ResponseCache entry whose value is written as it arrives
+
+        The raw JSON text of the value, such as a response read a block at a
+        time, is copied to a temporary file after the rest of the entry, so
+        it is never held in memory; commit() puts the file in place, where
+        get() reads it like any other entry. The entry's header, everything
+        but the value, is its first line, which ResponseCache.header reads
+        without the value.
+
+        Args:
+            cache (ResponseCache): cache the entry goes into
+            key (str): key of the entry
+            url, etag, last_modified: as for ResponseCache.put
+    """
+    # End of the header line, after which the value starts
+    VALUE = b', "value":\n'
+    # Longest header read back
+    MAX_HEADER = 64 * 1024
+
+    def __init__(self, cache, key, url=None, etag=None, last_modified=None):
+        self.cache = cache
+        self.key = key
+        self.filename = cache._filename(key)
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, exist_ok=True)
+        fd, self.tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+        header = {'key': key, 'url': url, 'etag': etag, 'last_modified': last_modified, 'stored': time.time()}
+        self._file.write(json.dumps(header).encode('utf-8')[:-1] + self.VALUE)
+
+    def write(self, chunk):
+        self._file.write(chunk)
+
+    def commit(self):
+        try:
+            self._file.write(b'}')
+            self._file.close()
+            self.cache._written += os.path.getsize(self.tmp)
+            os.replace(self.tmp, self.filename)
+        except Exception:
+            self.abort()
+            raise
+        if self.cache._written > self.cache.max_bytes // 16:
+            self.cache.evict()
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+class ConversionCache(object):
+    """ Memoizes a text conversion by a hash of its input
+
+        Results are kept in an in-memory LRU of max_entries and, when a
+        disk cache is given, also in a ResponseCache shared by every worker
+        process and by later runs. Failed conversions (None) are not stored.
+
+        Args:
+            convert (function): conversion to memoize, taking and returning a str
+            max_entries (int): size of the in-memory tier
+            disk (ResponseCache): optional on-disk tier
+            version (str): salt mixed into every key; change it whenever the
+                conversion itself changes so stale results are not served
+    """
+    def __init__(self, convert, max_entries, disk=None, version=''):
+        self.convert = convert
+        self.max_entries = max_entries
+        self.disk = disk
+        self.version = version
+        self._memory = collections.OrderedDict()
+        self.counters = collections.Counter()
+
+    def key(self, source):
+        return hashlib.sha1((self.version + '\0' + source).encode('utf-8')).hexdigest()
+
+    def __call__(self, source):
+        key = self.key(source)
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.counters['hits'] += 1
+            return self._memory[key]
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.counters['disk_hits'] += 1
+                self._remember(key, entry['value'])
+                return entry['value']
+        self.counters['misses'] += 1
+        result = self.convert(source)
+        if result is not None:
+            self._remember(key, result)
+            if self.disk is not None:
+                self.disk.put(key, result)
+        return result
+
+    def _remember(self, key, result):
+        self._memory[key] = result
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def take_counters(self):
+        """ Returns the counters collected since the last call and resets them """
+        counters = self.counters
+        self.counters = collections.Counter()
+        return counters
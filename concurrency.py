@@ -0,0 +1,207 @@
+import asyncio
+import collections
+import time
+
+from aiofetch import FetchError
+
+
+# True for failures that point at an overloaded or unreachable server:
+# timeouts, connection errors and 429 or 5xx responses. Other 4xx responses
+# and unreadable bodies say nothing about the server's load
+def is_overload(error):
+    status = getattr(error, 'status', None) or getattr(error, 'code', None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return isinstance(error, (FetchError, OSError, asyncio.TimeoutError))
+
+
+class CircuitBreaker(object):
+    """ Stops requests to a server that keeps failing
+
+        After failure_threshold failures in a row the breaker opens and no
+        request is made for open_seconds. Then a single probe is let
+        through (half open): if it succeeds the breaker closes, if it fails
+        the breaker opens again for twice as long, up to max_open_seconds.
+        After max_trips openings without a success in between the outage is
+        taken to be permanent and the breaker stays closed, so failures are
+        reported again instead of waited out.
+
+        Args:
+            failure_threshold (int): failures in a row that open the breaker
+            open_seconds (float): how long the first opening lasts
+            max_open_seconds (float): longest opening
+            max_trips (int): openings in a row before giving up waiting
+            clock (callable): monotonic time in seconds
+    """
+    def __init__(self, failure_threshold, open_seconds, max_open_seconds, max_trips, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.max_trips = max_trips
+        self.clock = clock
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self.open_for = 0.0
+        self.outage_started = None
+        # Seconds every outage lasted, from the first opening to the next success
+        self.outages = []
+        self.counters = collections.Counter()
+
+    @property
+    def exhausted(self):
+        return self.trips > self.max_trips
+
+    def state(self):
+        """ 'closed', 'open' or 'half_open' """
+        if self.opened_at is None or self.exhausted:
+            return 'closed'
+        if self.clock() - self.opened_at < self.open_for:
+            return 'open'
+        return 'half_open'
+
+    def remaining(self):
+        """ Seconds until the breaker lets a probe through; 0 when requests are allowed """
+        if self.state() != 'open':
+            return 0.0
+        return max(0.0, self.opened_at + self.open_for - self.clock())
+
+    def record_success(self):
+        if self.outage_started is not None:
+            self.outages.append(self.clock() - self.outage_started)
+            self.outage_started = None
+            self.counters['closed'] += 1
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        state = self.state()
+        if state == 'half_open' or (state == 'closed' and not self.exhausted and self.failures >= self.failure_threshold):
+            self.trips += 1
+            if self.exhausted:
+                self.counters['gave_up'] += 1
+                return
+            self.counters['opened'] += 1
+            self.open_for = min(self.max_open_seconds, self.open_seconds * 2 ** (self.trips - 1))
+            self.opened_at = self.clock()
+            if self.outage_started is None:
+                self.outage_started = self.opened_at
+
+
+class ConcurrencyController(object):
+    """ Chooses how many QUESTION_URL requests may be in flight (AIMD)
+
+        The limit starts at `initial` and doubles every round of requests
+        (slow start) until the first sign of congestion, then grows by one
+        per round: a round is as many completed requests as the limit.
+        A response slower per question id than latency_tolerance times the
+        best smoothed latency seen so far stops the growth and takes one off
+        the limit; a timeout, connection error or 429/5xx response
+        multiplies it by `decrease`. The limit drops at most once per round,
+        as requests already in flight report the same congestion. Requests
+        also wait while the circuit breaker is open. `counters` and
+        `history` record every decision for the run report.
+
+        Args:
+            initial (int): starting limit
+            min_limit (int), max_limit (int): bounds for the limit
+            latency_tolerance (float): latency growth treated as congestion
+            decrease (float): factor applied to the limit on failures
+            breaker (CircuitBreaker): breaker consulted before every request
+            clock (callable): monotonic time in seconds
+    """
+    # Weight of the newest response in the smoothed latency
+    SMOOTHING = 0.3
+    # Share of the way the best latency moves up towards the smoothed one on
+    # every response, so the limit is not held down by one fast spell forever
+    BASELINE_DRIFT = 0.05
+
+    def __init__(self, initial, min_limit, max_limit, latency_tolerance, decrease, breaker, clock=time.monotonic):
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+        self.breaker = breaker
+        self.clock = clock
+        self.limit = float(max(self.min_limit, min(self.max_limit, initial)))
+        self.slow_start = True
+        self.latency = None
+        self.best_latency = None
+        self.peak = int(self.limit)
+        self.counters = collections.Counter()
+        # (seconds since start, limit) at every change of the limit
+        self.history = [(0.0, int(self.limit))]
+        self._started = clock()
+        self._since_decrease = None
+
+    @property
+    def allowed(self):
+        return int(self.limit)
+
+    def allows(self, in_flight):
+        """ True when another request may start while in_flight are running """
+        state = self.breaker.state()
+        if state == 'open':
+            return False
+        if state == 'half_open':
+            # One probe at a time finds out whether the server is back
+            return in_flight == 0
+        return in_flight < self.allowed
+
+    def wait_time(self):
+        """ Seconds to wait before allows() can become true without a request completing """
+        return self.breaker.remaining()
+
+    def record_success(self, latency=None):
+        """ A request succeeded; latency is its seconds per question id, when it asked for any """
+        if self.breaker.opened_at is not None:
+            # The server is back from an outage: its latency is measured afresh
+            self.latency = self.best_latency = None
+        self.breaker.record_success()
+        self._completed()
+        if latency is not None:
+            self.latency = latency if self.latency is None else self.latency + self.SMOOTHING * (latency - self.latency)
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+            else:
+                self.best_latency += self.BASELINE_DRIFT * (self.latency - self.best_latency)
+            if self.latency > self.best_latency * self.latency_tolerance:
+                if self.allowed > self.min_limit and self._may_decrease():
+                    self.counters['latency_decreases'] += 1
+                    self._set_limit(self.limit - 1)
+                return
+        if self.slow_start:
+            self._set_limit(self.limit + 1)
+        else:
+            self._set_limit(self.limit + 1.0 / max(1, self.allowed))
+
+    def record_failure(self, overload=True):
+        """ A request failed; only overload failures (see is_overload) count against the server """
+        self._completed()
+        if not overload:
+            return
+        self.breaker.record_failure()
+        if self.allowed > self.min_limit and self._may_decrease():
+            self.counters['failure_decreases'] += 1
+            self._set_limit(self.limit * self.decrease)
+
+    def _completed(self):
+        if self._since_decrease is not None:
+            self._since_decrease += 1
+
+    def _may_decrease(self):
+        self.slow_start = False
+        if self._since_decrease is not None and self._since_decrease < self.allowed:
+            return False
+        self._since_decrease = 0
+        return True
+
+    def _set_limit(self, limit):
+        before = self.allowed
+        self.limit = float(max(self.min_limit, min(self.max_limit, limit)))
+        if self.allowed != before:
+            self.counters['increases' if self.allowed > before else 'decreases'] += 1
+            self.peak = max(self.peak, self.allowed)
+            self.history.append((self.clock() - self._started, self.allowed))
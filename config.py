@@ -0,0 +1,143 @@
+# Tunables for the Magogenie chef. Any of these can be overridden by defining
+# the same name in settings.py.
+import os as _os
+import settings as _settings
+
+_BASE_DIR = _os.path.dirname(_os.path.abspath(__file__))
+
+# Persistent cache of TREE_URL and QUESTION_URL responses
+CACHE_DIR = getattr(_settings, 'CACHE_DIR', _os.path.join(_BASE_DIR, '.magogenie_cache'))
+# Seconds before a cached response is revalidated against the server
+CACHE_TTL = getattr(_settings, 'CACHE_TTL', 24 * 60 * 60)
+# Least recently used responses are evicted once the cache grows past this
+CACHE_MAX_BYTES = getattr(_settings, 'CACHE_MAX_BYTES', 512 * 1024 * 1024)
+# Bytes of the TREE_URL document read at a time; its topics are handed to
+# the question fetchers as soon as they are read
+TREE_READ_SIZE = getattr(_settings, 'TREE_READ_SIZE', 64 * 1024)
+
+# Worker processes shared by all topics of a crawl, at least one per core
+POOL_SIZE = getattr(_settings, 'POOL_SIZE', max(5, _os.cpu_count() or 1))
+# Most question batches in flight across every board and standard (pool engine)
+MAX_BATCHES_IN_FLIGHT = getattr(_settings, 'MAX_BATCHES_IN_FLIGHT', POOL_SIZE * 2)
+# Question ids per QUESTION_URL call before the batch planner has measured the server
+QUESTION_BATCH_SIZE = getattr(_settings, 'QUESTION_BATCH_SIZE', 6)
+
+# How question batches are fetched: 'asyncio' runs the crawl as two stages,
+# fetching from one event loop over keep-alive connections while a pool of
+# CONVERT_POOL_SIZE processes converts what was fetched; 'pool' fetches and
+# converts inside the POOL_SIZE workers
+FETCH_ENGINE = getattr(_settings, 'FETCH_ENGINE', 'asyncio')
+# Conversion processes of the asyncio engine, one per core
+CONVERT_POOL_SIZE = getattr(_settings, 'CONVERT_POOL_SIZE', _os.cpu_count() or 1)
+# Fetched batches allowed to wait for conversion; fetching pauses while the
+# queue is full, which bounds the memory held by the asyncio engine
+PIPELINE_QUEUE_SIZE = getattr(_settings, 'PIPELINE_QUEUE_SIZE', 32)
+# Most requests kept in flight by the asyncio engine
+ASYNC_CONCURRENCY = getattr(_settings, 'ASYNC_CONCURRENCY', 32)
+# Seconds allowed for one request attempt
+ASYNC_TIMEOUT = getattr(_settings, 'ASYNC_TIMEOUT', 60)
+# Extra attempts for a failed request, with jittered exponential backoff
+ASYNC_RETRIES = getattr(_settings, 'ASYNC_RETRIES', 3)
+ASYNC_BACKOFF = getattr(_settings, 'ASYNC_BACKOFF', 0.5)
+
+# Requests in flight adapt to the server between CONCURRENCY_MIN and the
+# engine's most (ASYNC_CONCURRENCY or MAX_BATCHES_IN_FLIGHT), starting at
+# CONCURRENCY_INITIAL. The limit grows while the seconds per question stay
+# within CONCURRENCY_LATENCY_TOLERANCE times the best seen and is multiplied
+# by CONCURRENCY_DECREASE on timeouts, connection errors and 429/5xx responses
+CONCURRENCY_INITIAL = getattr(_settings, 'CONCURRENCY_INITIAL', 4)
+CONCURRENCY_MIN = getattr(_settings, 'CONCURRENCY_MIN', 1)
+CONCURRENCY_LATENCY_TOLERANCE = getattr(_settings, 'CONCURRENCY_LATENCY_TOLERANCE', 2.0)
+CONCURRENCY_DECREASE = getattr(_settings, 'CONCURRENCY_DECREASE', 0.5)
+# After CIRCUIT_FAILURE_THRESHOLD failed requests in a row fetching pauses
+# for CIRCUIT_OPEN_SECONDS, doubling up to CIRCUIT_MAX_OPEN_SECONDS while the
+# server stays down; questions are not given up on during the pause. After
+# CIRCUIT_MAX_TRIPS pauses in a row the outage is treated as permanent
+CIRCUIT_FAILURE_THRESHOLD = getattr(_settings, 'CIRCUIT_FAILURE_THRESHOLD', 5)
+CIRCUIT_OPEN_SECONDS = getattr(_settings, 'CIRCUIT_OPEN_SECONDS', 10)
+CIRCUIT_MAX_OPEN_SECONDS = getattr(_settings, 'CIRCUIT_MAX_OPEN_SECONDS', 300)
+CIRCUIT_MAX_TRIPS = getattr(_settings, 'CIRCUIT_MAX_TRIPS', 8)
+
+# Run state kept between crawls, such as the settled question batch size
+STATE_DIR = getattr(_settings, 'STATE_DIR', _os.path.join(_BASE_DIR, '.magogenie_state'))
+
+# Bounds for the adaptive QUESTION_URL batch size; QUESTION_BATCH_SIZE is
+# only the starting size of the first run
+BATCH_MIN_SIZE = getattr(_settings, 'BATCH_MIN_SIZE', 1)
+BATCH_MAX_SIZE = getattr(_settings, 'BATCH_MAX_SIZE', 50)
+# Batches are sized so that one request takes about this long ...
+BATCH_TARGET_SECONDS = getattr(_settings, 'BATCH_TARGET_SECONDS', 2.0)
+# ... and returns no more than this many bytes
+BATCH_TARGET_BYTES = getattr(_settings, 'BATCH_TARGET_BYTES', 2 * 1024 * 1024)
+# Longest QUESTION_URL the planner will build
+MAX_URL_LENGTH = getattr(_settings, 'MAX_URL_LENGTH', 2000)
+# Attempts for a single question id before it is given up on
+BATCH_RETRIES = getattr(_settings, 'BATCH_RETRIES', 3)
+
+# XSLT MathML Library stylesheet used to turn MathML into LaTeX
+MMLTEX_XSL = getattr(_settings, 'MMLTEX_XSL', 'mmltex.xsl')
+
+# MathML fragments converted to LaTeX are memoized by content: the newest
+# MATHML_CACHE_SIZE per worker in memory, and all of them in MATHML_CACHE_DIR
+# (shared by workers and runs; set it to None to keep the cache in memory only)
+MATHML_CACHE_SIZE = getattr(_settings, 'MATHML_CACHE_SIZE', 10000)
+MATHML_CACHE_DIR = getattr(_settings, 'MATHML_CACHE_DIR', _os.path.join(_BASE_DIR, '.magogenie_mathml'))
+MATHML_CACHE_MAX_BYTES = getattr(_settings, 'MATHML_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+# Incremental crawls reuse the converted levels of every topic whose question
+# ids and cached questions have not changed; pass incremental=true to
+# uploadchannel to turn it on for one run
+INCREMENTAL = getattr(_settings, 'INCREMENTAL', False)
+# Stored topics are rebuilt at least this often
+TOPIC_STORE_TTL = getattr(_settings, 'TOPIC_STORE_TTL', 7 * 24 * 60 * 60)
+TOPIC_STORE_MAX_BYTES = getattr(_settings, 'TOPIC_STORE_MAX_BYTES', 512 * 1024 * 1024)
+
+# Boards and standards imported by default; None imports all of them.
+# uploadchannel accepts boards=... and standards=... to override these per run
+BOARDS = getattr(_settings, 'BOARDS', ['BalBharati'])
+STANDARDS = getattr(_settings, 'STANDARDS', ['3', '4', '5', '6', '7', '8'])
+
+# JSON report of stage timings, counters and per board/standard subtotals,
+# written at the end of every construct_channel; set to None to skip it
+RUN_REPORT = getattr(_settings, 'RUN_REPORT', _os.path.join(STATE_DIR, 'run_report.json'))
+
+# Opt-in profiling of the conversion (or profile=true on the command line):
+# every question and MathML fragment is timed and the PROFILE_TOP slowest of
+# each, with their size and the time spent per stage, are ranked in
+# PROFILE_DIR/profile.json. The PROFILE_DUMPS slowest questions also leave a
+# cProfile dump there; profiling every question with cProfile roughly
+# doubles the conversion time, so set it to 0 for timings alone
+PROFILE_QUESTIONS = getattr(_settings, 'PROFILE_QUESTIONS', False)
+PROFILE_TOP = getattr(_settings, 'PROFILE_TOP', 25)
+PROFILE_DUMPS = getattr(_settings, 'PROFILE_DUMPS', 5)
+PROFILE_DIR = getattr(_settings, 'PROFILE_DIR', _os.path.join(STATE_DIR, 'profile'))
+
+# Inline base64 images are decoded, GIF/BMP transcoded to PNG (with Pillow)
+# and stored once per content hash in IMAGE_DIR; questions then refer to the
+# stored file instead of carrying the image. None leaves images inline
+IMAGE_DIR = getattr(_settings, 'IMAGE_DIR', _os.path.join(_BASE_DIR, '.magogenie_images'))
+# Data URIs remembered per worker with the path they were stored at
+IMAGE_CACHE_SIZE = getattr(_settings, 'IMAGE_CACHE_SIZE', 10000)
+
+# Converted questions remembered per worker by a hash of their raw payload
+# (question and answer content), so a payload repeated under other ids is
+# converted once
+PAYLOAD_CACHE_SIZE = getattr(_settings, 'PAYLOAD_CACHE_SIZE', 4096)
+
+# Remote images of the questions (/assets and wirispluginengine URLs) are
+# downloaded into IMAGE_DIR while the crawl runs, and questions point at the
+# local copies. Downloaded URLs are remembered for IMAGE_URL_TTL
+PREFETCH_IMAGES = getattr(_settings, 'PREFETCH_IMAGES', True)
+IMAGE_PREFETCH_CONCURRENCY = getattr(_settings, 'IMAGE_PREFETCH_CONCURRENCY', 8)
+IMAGE_URL_TTL = getattr(_settings, 'IMAGE_URL_TTL', 30 * 24 * 60 * 60)
+IMAGE_URL_MAX_BYTES = getattr(_settings, 'IMAGE_URL_MAX_BYTES', 64 * 1024 * 1024)
+
+# Every finished batch of questions is checkpointed here. A crawl that stops
+# part way is resumed by the next one over the same boards and standards,
+# unless RESUME is off or resume=false is given; None turns checkpoints off
+CHECKPOINT_JOURNAL = getattr(_settings, 'CHECKPOINT_JOURNAL', _os.path.join(STATE_DIR, 'journal.sqlite'))
+RESUME = getattr(_settings, 'RESUME', True)
+
+# Every finished crawl leaves its converted source tree here, so channels can
+# be rebuilt from it with snapshot=<path> and no network; None turns it off
+SNAPSHOT_PATH = getattr(_settings, 'SNAPSHOT_PATH', _os.path.join(STATE_DIR, 'snapshot.jsonl.gz'))
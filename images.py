@@ -0,0 +1,168 @@
+import asyncio
+import base64
+import binascii
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Stands in for a stored image while the content is converted. It has no
+# hyphens or spaces, so html2text cannot wrap a line in the middle of it
+IMAGE_MARKER = 'magogenieimage:'
+REGEX_IMAGE_MARKER = re.compile(IMAGE_MARKER + r'([0-9a-f]{2}/[0-9a-f]{40}\.(?:png|jpg))')
+# A data URI payload; line breaks are only allowed between payload characters
+REGEX_DATA_URI = re.compile(r'data:image/([A-Za-z0-9.+-]*);base64,([A-Za-z0-9+/=]+(?:(?:\r|\n|&#10;)+[A-Za-z0-9+/=]+)*)')
+
+
+class ImageStore(object):
+    """ Content-addressed directory of images taken out of question HTML
+
+        Every image is stored once, as path/<sha1[:2]>/<sha1>.<extension> of
+        its bytes, so an image repeated across questions and runs takes one
+        file. Files are written atomically, so pool workers can share a store.
+
+        Args:
+            path (str): directory the images are kept in
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def put(self, data, extension):
+        """ Stores data unless an identical image is already there and returns its name in the store """
+        digest = hashlib.sha1(data).hexdigest()
+        name = '{0}/{1}.{2}'.format(digest[:2], digest, extension)
+        path = self.path_of(name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return name
+
+    def path_of(self, name):
+        return os.path.join(self.path, *name.split('/'))
+
+
+def decode_data_uri(data_uri):
+    """ Returns the bytes of a base64 data URI matched by REGEX_DATA_URI, or None """
+    match = REGEX_DATA_URI.match(data_uri)
+    if match is None:
+        return None
+    payload = match.group(2).replace('&#10;', '').replace('\r', '').replace('\n', '')
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def image_format(data):
+    """ 'png' or 'jpg' for data Kolibri can show as it is, else None """
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    return None
+
+
+def is_svg(data):
+    head = data[:512].lstrip()
+    return head.startswith(b'<svg') or (head.startswith(b'<?xml') and b'<svg' in head)
+
+
+def transcode_to_png(data):
+    """ Converts any image Pillow can read (GIF, BMP, ...) to PNG; None without Pillow or for unreadable data """
+    if Image is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(data))
+        # GIFs keep their first frame
+        image.seek(0)
+        if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        out = io.BytesIO()
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue()
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+
+class ImagePrefetcher(object):
+    """ Downloads remote images into an ImageStore in the background
+
+        Downloads run on an event loop of their own thread through an
+        AsyncFetcher, so connections are reused and failed requests retried
+        while the caller carries on converting questions. Every URL is
+        fetched once per run; index maps it to the stored image, so later
+        runs only download URLs they have not seen. Images are stored the
+        way inline ones are: PNG and JPEG as they are, SVG as SVG and
+        anything else transcoded to PNG.
+
+        Args:
+            store (ImageStore): where downloaded images are kept
+            index (ResponseCache): stored image name of every downloaded URL
+            fetcher (AsyncFetcher): fetcher used for the downloads
+    """
+    def __init__(self, store, index, fetcher):
+        self.store = store
+        self.index = index
+        self.fetcher = fetcher
+        self.counters = collections.Counter()
+        self._futures = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def prefetch(self, url):
+        """ Returns a concurrent.futures.Future of the local path of url, None when it cannot be fetched """
+        future = self._futures.get(url)
+        if future is None:
+            entry = self.index.get('image:' + url)
+            if entry is not None and self.index.is_fresh(entry) and os.path.exists(self.store.path_of(entry['value'])):
+                self.counters['stored'] += 1
+                future = concurrent.futures.Future()
+                future.set_result(self.store.path_of(entry['value']))
+            else:
+                future = asyncio.run_coroutine_threadsafe(self._download(url), self._loop)
+            self._futures[url] = future
+        return future
+
+    async def _download(self, url):
+        try:
+            status, body, headers = await self.fetcher.fetch(url)
+        except Exception as e:
+            print (e)
+            self.counters['failed'] += 1
+            return None
+        # Transcoding and writing the image would hold up the downloads in flight
+        path = await asyncio.get_running_loop().run_in_executor(None, self._store_image, url, body, headers)
+        self.counters['downloaded' if path else 'failed'] += 1
+        return path
+
+    def _store_image(self, url, body, headers):
+        """ Stores a downloaded image and returns its path, None when it cannot be read """
+        extension = image_format(body) or ('svg' if is_svg(body) else None)
+        if extension is None:
+            body, extension = transcode_to_png(body), 'png'
+        if not body:
+            return None
+        name = self.store.put(body, extension)
+        self.index.put('image:' + url, name, url, headers.get('ETag'), headers.get('Last-Modified'))
+        return self.store.path_of(name)
+
+    def close(self):
+        async def close_fetcher():
+            self.fetcher.close()
+        asyncio.run_coroutine_threadsafe(close_fetcher(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
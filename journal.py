@@ -0,0 +1,99 @@
+import json
+import os
+import sqlite3
+
+
+class CheckpointJournal(object):
+    """ SQLite journal of the question batches a crawl has finished
+
+        Every batch is committed as it completes: the converted question of
+        each id (or nothing, for ids that did not produce a question) and the
+        ids that were given up on. A crawl that stops part way leaves its run
+        marked unfinished, and the next crawl over the same boards and
+        standards picks up from the journal instead of starting over. A
+        crawl that gets to the end finishes its run even when some ids were
+        given up on: they stay in the failed table until the next crawl over
+        the same selection, which fetches them again with everything else
+        and can tell from retried() which of them failed before. The
+        database runs in WAL mode so a crash loses at most the batch being
+        written.
+
+        Args:
+            path (str): SQLite database file
+            version (str): conversion version; questions journaled under
+                another version are converted again
+    """
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS questions (id TEXT PRIMARY KEY, version TEXT, question TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS failed (id TEXT PRIMARY KEY, error TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+        # Ids the last finished run over the same selection gave up on
+        self.retrying = set()
+
+    def _get(self, key):
+        row = self.db.execute('SELECT value FROM run WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO run (key, value) VALUES (?, ?)', (key, value))
+
+    def start(self, selection, resume=True):
+        """ Begins a run over selection; returns True when an unfinished run over the same selection is resumed """
+        selection = json.dumps(selection, sort_keys=True)
+        if resume and self._get('state') == 'running' and self._get('selection') == selection:
+            return True
+        self.retrying = set(self.failed()) if self._get('selection') == selection else set()
+        with self.db:
+            self.db.execute('DELETE FROM questions')
+            self.db.execute('DELETE FROM failed')
+            self._set('state', 'running')
+            self._set('selection', selection)
+        return False
+
+    def finish(self):
+        with self.db:
+            self._set('state', 'finished')
+
+    def load(self, question_ids):
+        """ {id: question dict or None} for the ids already journaled under this version """
+        done = {}
+        ids = [str(question_id) for question_id in question_ids]
+        # Stay below SQLite's limit on bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.db.execute('SELECT id, question FROM questions WHERE version = ? AND id IN ({0})'.format(','.join('?' * len(chunk))),
+                                   [self.version] + chunk)
+            for question_id, question in rows:
+                done[question_id] = json.loads(question) if question is not None else None
+        return done
+
+    def record_batch(self, question_ids, questions):
+        """ Journals a finished batch; ids without a question in questions are recorded as done too """
+        by_id = dict((str(question['id']), question) for question in questions or [])
+        rows = [(str(question_id), self.version, json.dumps(dict(by_id[str(question_id)].items())) if str(question_id) in by_id else None)
+                for question_id in question_ids]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO questions (id, version, question) VALUES (?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM failed WHERE id = ?', [(row[0],) for row in rows])
+
+    def record_failure(self, question_ids, error=None):
+        """ Journals ids given up on; a resumed run fetches them again """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO failed (id, error) VALUES (?, ?)', [(str(question_id), error) for question_id in question_ids])
+
+    def failed(self):
+        return [row[0] for row in self.db.execute('SELECT id FROM failed ORDER BY id')]
+
+    def retried(self):
+        """ Ids given up on in this run that the last run over the same selection gave up on too """
+        return [question_id for question_id in self.failed() if question_id in self.retrying]
+
+    def close(self):
+        self.db.close()
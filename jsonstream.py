@@ -0,0 +1,134 @@
+import codecs
+import json
+import re
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+
+class _Reader(object):
+    """ JSON text read from an iterable of UTF-8 byte chunks, a little at a time """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def more(self):
+        """ Reads at least as much text again as is left past pos. False at the end of the stream """
+        if self.eof:
+            return False
+        wanted = max(1, len(self.text) - self.pos)
+        parts = [self.text[self.pos:]]
+        read = 0
+        for chunk in self._chunks:
+            text = self._decode(chunk)
+            parts.append(text)
+            read += len(text)
+            if read >= wanted:
+                break
+        else:
+            parts.append(self._decode(b'', True))
+            self.eof = True
+            read += len(parts[-1])
+        self.text = ''.join(parts)
+        self.pos = 0
+        return read > 0
+
+    def peek(self):
+        """ The next character that is not whitespace, '' at the end of the stream """
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                return ''
+
+    def take(self, expected):
+        char = self.peek()
+        if not char or char not in expected:
+            raise ValueError("Expecting one of {0!r}, found {1!r}".format(expected, self.text[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ Decodes the next whole JSON value, reading as much of the stream as it takes """
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.more():
+                    continue
+                raise
+            # A number at the end of the text may go on in the next
+            # chunk: "1" of "12", or "1" of "1.5" when only "1." has arrived
+            if _NUMBER_TAIL.match(self.text, end).end() == len(self.text) and self.more():
+                continue
+            self.pos = end
+            return value
+
+
+def _members(reader, path, keys, wildcard):
+    reader.take('{')
+    name = path[0]
+    if reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise ValueError("Expecting a member name, found {0!r}".format(key))
+            reader.take(':')
+            if name is not None and key != name:
+                yield 'other', keys, key, reader.value()
+            elif len(path) == 1:
+                yield 'item', keys + (key,) if name is None else keys, reader.value()
+            elif reader.peek() != '{':
+                # Nothing to walk into
+                yield 'other', keys, key, reader.value()
+            else:
+                for event in _members(reader, path[1:], keys + (key,) if name is None else keys, name is None):
+                    yield event
+            if reader.take(',}') == '}':
+                break
+    if wildcard:
+        yield 'end', keys
+
+
+# Walks a JSON document read from an iterable of UTF-8 byte chunks, such as
+# an HTTP response read a block at a time, without decoding it in one piece.
+# path names the members to walk into, one per level, None standing for
+# every member of its object; ('boards', None) walks into every board of
+# {"boards": {...}}. Yields, as soon as each has been read:
+#   ('item', keys, value)         a member at the end of path, decoded
+#   ('end', keys)                 an object reached through a None level, or
+#                                 the document itself, has no more members
+#   ('other', keys, name, value)  a member off the path, decoded
+# keys are the names of the members the None levels matched on the way.
+# Raises ValueError when the text is not JSON or ends early
+def iter_events(chunks, path):
+    reader = _Reader(chunks)
+    for event in _members(reader, tuple(path), (), True):
+        yield event
+    if reader.peek():
+        raise ValueError("Extra data after the document: {0!r}".format(reader.text[reader.pos:reader.pos + 20]))
+
+
+# The events of iter_events for a document that is already decoded
+def iter_decoded_events(document, path, keys=(), wildcard=True):
+    name = path[0]
+    for key, value in document.items():
+        if name is not None and key != name:
+            yield 'other', keys, key, value
+        elif len(path) == 1:
+            yield 'item', keys + (key,) if name is None else keys, value
+        elif not isinstance(value, dict):
+            yield 'other', keys, key, value
+        else:
+            for event in iter_decoded_events(value, path[1:], keys + (key,) if name is None else keys, name is None):
+                yield event
+    if wildcard:
+        yield 'end', keys
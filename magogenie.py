@@ -5,19 +5,43 @@ from ricecooker.classes.licenses import get_license
 from ricecooker.exceptions import UnknownContentKindError, UnknownFileTypeError, UnknownQuestionTypeError, raise_for_invalid_channel
 from le_utils.constants import content_kinds,file_formats, format_presets, licenses, exercises, languages
 from pressurecooker.encodings import get_base64_encoding
-from urllib.request import urlopen, HTTPError
+from urllib.request import urlopen, Request, HTTPError
 from multiprocessing import Pool
 from settings import *
+from config import *
+from cache import ResponseCache, ConversionCache, validator_headers
+from aiofetch import AsyncFetcher
+from batching import BatchPlanner, QuestionFeed, Note
+from treedoc import TREE_PATH
+import treedoc
+from concurrency import ConcurrencyController, CircuitBreaker, is_overload
+from metrics import Metrics
+from journal import CheckpointJournal
+from records import Question, Level, Topic, DESCRIPTION
+from snapshot import write_snapshot, iter_snapshot
+from markup import QuestionMarkdown
+from payloads import PayloadTable, question_payload, question_parts, build_question
+from profiling import QuestionProfiler
+from images import ImageStore, ImagePrefetcher, IMAGE_MARKER, REGEX_IMAGE_MARKER, REGEX_DATA_URI, decode_data_uri, image_format, transcode_to_png
 import sys
 import json
 import os
+import hashlib
+import asyncio
 import re
 import itertools
+import collections
+import queue
 import operator
-import html2text
 import subprocess
 import time
 import ssl
+import threading
+import datetime
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
 ssl._create_default_https_context = ssl._create_unverified_context
 
 class FileTypes(Enum):
@@ -104,7 +128,6 @@ ANSWER_TYPE_KEY = {
 }
 
 
-DESCRIPTION = "v0.1"
 REGEX_IMAGE = re.compile('(\/assets.+?.(jpeg|jpg|png|gif){1})|\/wirispluginengine([^\"]+)')
 REGEX_BASE64 = re.compile('data:image\/[A-Za-z]*;base64,(?:[A-Za-z0-9+\/]{4})*(?:[A-Za-z0-9+\/]{2}==|[A-Za-z0-9+\/]{3}=)*')
 REGEX_BMP = re.compile('((image\/bmp))')
@@ -120,162 +143,1195 @@ invalid_question_list = ['113178','119500','123348', '123350' , '123356', '12335
                                  '12002', '116651', '142918','143434','143691', '88364', '88366', '88370', '112726', \
                                  '106244', '106245', '142905', '142907', '142909', '142913', '143221', '49657', '49658', '121571']
 arrlevels = []
+RESPONSE_CACHE = ResponseCache(CACHE_DIR, CACHE_TTL, CACHE_MAX_BYTES)
+# Bump whenever convert_mathml, normalize_mathml or mmltex.xsl changes so cached LaTeX is not reused
+MATHML_CACHE_VERSION = '2'
+MATHML_CACHE = ConversionCache(lambda mathml: PROFILER.fragment(mathml, convert_mathml), MATHML_CACHE_SIZE,
+                               ResponseCache(MATHML_CACHE_DIR, float('inf'), MATHML_CACHE_MAX_BYTES) if MATHML_CACHE_DIR else None,
+                               MATHML_CACHE_VERSION)
+# Inline base64 images are moved into IMAGE_STORE; INLINE_IMAGES remembers
+# the path each data URI was stored at so a repeated image is decoded once
+IMAGE_STORE = ImageStore(IMAGE_DIR) if IMAGE_DIR else None
+INLINE_IMAGES = ConversionCache(lambda data_uri: extract_image(data_uri), IMAGE_CACHE_SIZE)
+# Question HTML to Markdown, shared by every call
+MARKDOWN = QuestionMarkdown()
+# Converted questions by raw payload, in each worker
+PAYLOAD_CACHE = ConversionCache(lambda payload: convert_payload(json.loads(payload)), PAYLOAD_CACHE_SIZE)
+# Distinct question payloads of the crawl, in this process
+PAYLOADS = PayloadTable()
+# Counters reported by the pool workers, summed over the crawl
+CRAWL_COUNTERS = collections.Counter()
+# (seconds into the crawl, requests allowed in flight) at every change
+CONCURRENCY_HISTORY = []
+# Stage timings of this process; pool workers send theirs back with each batch
+METRICS = Metrics()
+# Slowest questions and MathML fragments when profiling (see PROFILE_QUESTIONS)
+PROFILER = QuestionProfiler(PROFILE_TOP, PROFILE_DUMPS)
+# Converted levels of each topic, reused by incremental crawls
+TOPIC_STORE = ResponseCache(os.path.join(STATE_DIR, 'topics'), TOPIC_STORE_TTL, TOPIC_STORE_MAX_BYTES)
+# Bump whenever the conversion of questions changes so stored topics are rebuilt
+TOPIC_FINGERPRINT_VERSION = '2'
+
+# Fetch url, revalidating against a cached entry when one is given.
+# Returns (status, body, headers); status 304 means the cached entry is still valid
+def conditional_get(url, entry=None):
+    start = time.perf_counter()
+    try:
+        conn = urlopen(Request(url, headers=validator_headers(entry)))
+    except HTTPError as e:
+        if e.code == 304 and entry is not None:
+            METRICS.record('http', time.perf_counter() - start)
+            return 304, None, e.headers
+        raise
+    body = conn.read()
+    conn.close()
+    METRICS.record('http', time.perf_counter() - start, len(body))
+    return conn.getcode(), body, conn.headers
+
+# The events of the TREE_URL document along TREE_PATH, read as it arrives
+# through the response cache (see treedoc.iter_tree_events)
+def iter_tree_events():
+    return treedoc.iter_tree_events(RESPONSE_CACHE, TREE_URL, TREE_PATH, TREE_READ_SIZE, metrics=METRICS)
+
+# Ids of the questions a QUESTION_URL asks for, or None for any other URL
+def question_url_ids(url):
+    prefix, _, suffix = QUESTION_URL.partition('%s')
+    if not url or len(url) <= len(prefix) + len(suffix) or not url.startswith(prefix) or not url.endswith(suffix):
+        return None
+    return url[len(prefix):len(url) - len(suffix)].split(',')
+
+# Looks question_ids up in the response cache. Questions are cached one entry
+# per id, so only missing or expired ids need to be requested from the server.
+# Validators belong to the whole response an entry was stored from, and
+# batches are sized differently from run to run, so expired ids are
+# revalidated by requesting the URL they were stored from again, whatever
+# batch they are in now; the rest are requested together.
+# Returns (question_info, requests) where requests is empty when everything
+# was cached, else a list of (question_url, entry to revalidate or None,
+# ids of question_ids the request answers)
+def plan_question_request(question_ids):
+    question_ids = [str(question_id) for question_id in question_ids]
+    question_info = {}
+    stale = collections.OrderedDict()
+    to_fetch = []
+    for question_id in question_ids:
+        entry = RESPONSE_CACHE.get('question:' + question_id)
+        if entry is None:
+            to_fetch.append(question_id)
+        elif RESPONSE_CACHE.is_fresh(entry):
+            question_info[question_id] = entry['value']
+        elif (entry.get('etag') or entry.get('last_modified')) and question_url_ids(entry.get('url')):
+            stale.setdefault(entry['url'], (entry, []))[1].append(question_id)
+        else:
+            to_fetch.append(question_id)
+    requests = [(question_url, entry, ids) for question_url, (entry, ids) in stale.items()]
+    if to_fetch:
+        requests.append((QUESTION_URL % (','.join(to_fetch)), None, to_fetch))
+    return question_info, requests
+
+# Merges the response to a planned request into question_info and the cache.
+# Every question of the response is cached, also those of other batches, so
+# a URL revalidated for one batch is fresh for the next
+def store_question_response(question_info, request, status, body, headers):
+    question_url, entry, wanted = request
+    wanted = set(wanted)
+    if status == 304:
+        for question_id in question_url_ids(question_url):
+            stored = RESPONSE_CACHE.get('question:' + question_id)
+            if stored is None:
+                continue
+            if stored.get('url') == question_url:
+                stored = RESPONSE_CACHE.refresh('question:' + question_id, stored)
+            if question_id in wanted:
+                question_info[question_id] = stored['value']
+        return question_info
+
+    fetched = json.loads(body.decode('utf-8'))
+    for key, value in fetched.items():
+        RESPONSE_CACHE.put('question:' + str(key), value, question_url, headers.get('ETag'), headers.get('Last-Modified'))
+        if str(key) in wanted:
+            question_info[str(key)] = value
+    return question_info
+
+# Returns the QUESTION_URL response for question_ids, served from cache where
+# possible. When stats is given, the number of ids requested from the server
+# and the bytes received are added to it
+def fetch_question_info(question_ids, stats=None):
+    question_info, requests = plan_question_request(question_ids)
+    for request in requests:
+        status, body, headers = conditional_get(request[0], request[1])
+        if stats is not None:
+            stats['requested'] += len(question_url_ids(request[0]) or request[2])
+            stats['bytes'] += len(body or b'')
+        store_question_response(question_info, request, status, body, headers)
+    return question_info
+
+async def fetch_question_info_async(fetcher, question_ids, stats=None):
+    question_info, requests = plan_question_request(question_ids)
+    for request in requests:
+        start = time.perf_counter()
+        status, body, headers = await fetcher.fetch(request[0], validator_headers(request[1]))
+        METRICS.record('http', time.perf_counter() - start, len(body or b''))
+        if stats is not None:
+            stats['requested'] += len(question_url_ids(request[0]) or request[2])
+            stats['bytes'] += len(body or b'')
+        store_question_response(question_info, request, status, body, headers)
+    return question_info
+
+# Returns the batches to retry after a failed batch. A batch is split in
+# half; a single id is retried until it has failed BATCH_RETRIES times.
+# Failures that are not charged, like those during an outage the circuit
+# breaker waits out, do not count towards BATCH_RETRIES
+def retry_batches(planner, attempts, batch, charge=True):
+    if len(batch) > 1:
+        return planner.record_failure(batch)
+    question_id = str(batch[0])
+    if charge:
+        attempts[question_id] = attempts.get(question_id, 0) + 1
+    planner.record_failure(batch)
+    if attempts.get(question_id, 0) > BATCH_RETRIES:
+        print ("Giving up on question " + question_id)
+        return []
+    return [batch]
+
+# Fetches the raw responses for question_ids from one event loop over
+# keep-alive connections, in batches sized by the planner, with as many
+# requests in flight as the concurrency controller allows. Every batch is
+# handed to `put`, a coroutine, as (question_ids, question_info, stats);
+# question_info is None for ids that were given up on. question_ids is a
+# list or a QuestionFeed, which is waited on for more ids until it is closed
+async def fetch_question_batches_async(planner, question_ids, put, controller=None):
+    controller = controller or new_concurrency_controller()
+    feed = question_ids if isinstance(question_ids, QuestionFeed) else QuestionFeed(question_ids)
+    pending = feed.pending
+    retry = collections.deque()
+    attempts = {}
+    in_flight = [0]
+    changed = asyncio.Condition()
+    arrived = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def notify():
+        try:
+            loop.call_soon_threadsafe(arrived.set)
+        except RuntimeError:
+            # The loop is closed: nothing is waiting any more
+            pass
+    feed.listen(notify)
+
+    async def more():
+        # Waits for ids while the feed is open; False once there will be none
+        while not (pending or retry):
+            if feed.closed:
+                return False
+            arrived.clear()
+            if not (pending or retry or feed.closed):
+                await arrived.wait()
+        return True
+
+    async def acquire():
+        async with changed:
+            while not controller.allows(in_flight[0]):
+                try:
+                    # An open breaker is waited out; otherwise a request has to finish first
+                    await asyncio.wait_for(changed.wait(), controller.wait_time() or None)
+                except asyncio.TimeoutError:
+                    pass
+            in_flight[0] += 1
+
+    async def release():
+        async with changed:
+            in_flight[0] -= 1
+            changed.notify_all()
+
+    async def fetch_batches(fetcher):
+        while await more():
+            await acquire()
+            if not (pending or retry):
+                # Another coroutine took them
+                await release()
+                continue
+            batch = retry.popleft() if retry else planner.next_batch(pending)
+            stats = {'requested': 0, 'bytes': 0}
+            start = time.time()
+            try:
+                question_info = await fetch_question_info_async(fetcher, batch, stats)
+            except Exception as e:
+                print (e)
+                controller.record_failure(is_overload(e))
+                await release()
+                retries = retry_batches(planner, attempts, batch, controller.breaker.state() == 'closed')
+                retry.extend(retries)
+                if not retries:
+                    await put((batch, None, {}))
+                continue
+            elapsed = time.time() - start
+            if stats['requested']:
+                controller.record_success(elapsed / stats['requested'])
+            await release()
+            planner.record(stats['requested'], elapsed, stats['bytes'])
+            await put((batch, question_info, {'elapsed': elapsed, 'bytes': stats['bytes']}))
+
+    fetcher = AsyncFetcher(ASYNC_CONCURRENCY, ASYNC_TIMEOUT, ASYNC_RETRIES, ASYNC_BACKOFF)
+    try:
+        await asyncio.gather(*[fetch_batches(fetcher) for i in range(ASYNC_CONCURRENCY)])
+    finally:
+        fetcher.close()
+
+# I/O stage of the asyncio engine: fetches on an event loop in a thread of
+# its own and yields the fetched batches through a queue holding at most
+# PIPELINE_QUEUE_SIZE of them. While the queue is full the fetching
+# coroutines wait, so the crawl never holds more raw responses than that.
+# When the batches stop being taken, fetching stops too.
+# Notes other threads put on `fetched`, when given, are yielded too
+def iter_fetched_batches(planner, question_ids, controller=None, fetched=None):
+    fetched = fetched or queue.Queue(PIPELINE_QUEUE_SIZE)
+    done = object()
+    stopped = threading.Event()
+
+    # False once nothing takes the batches any more
+    def put_until_stopped(item):
+        while not stopped.is_set():
+            try:
+                fetched.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def put(item):
+        if not await asyncio.get_running_loop().run_in_executor(None, put_until_stopped, item):
+            raise RuntimeError("Fetched batches are no longer taken")
+
+    def fetch():
+        try:
+            asyncio.run(fetch_question_batches_async(planner, question_ids, put, controller))
+        except Exception as e:
+            if not stopped.is_set():
+                print (e)
+        finally:
+            put_until_stopped(done)
+
+    thread = threading.Thread(target=fetch, daemon=True)
+    thread.start()
+    try:
+        for item in iter(fetched.get, done):
+            yield item
+    finally:
+        stopped.set()
+    thread.join()
+
+# CPU stage of the asyncio engine: converts fetched batches in the pool,
+# taking the next one only while fewer than twice as many batches as there
+# are processes are converting. A batch that fails to convert is split and
+# converted again in halves, down to the question at fault, without being
+# fetched again. With payloads, a PayloadTable, questions whose payload was
+# converted before are built here instead of in the pool. Yields the
+# convert_fetched_batch results as they arrive, and Notes as they come
+def convert_fetched_batches(pool, fetched_batches, payloads=None):
+    fetched_batches = iter(fetched_batches)
+    retry = collections.deque()
+    done = queue.Queue()
+    in_flight = 0
+    exhausted = False
+    while True:
+        while in_flight < CONVERT_POOL_SIZE * 2 and (retry or not exhausted):
+            fetched = retry.popleft() if retry else next(fetched_batches, None)
+            if fetched is None:
+                exhausted = True
+                break
+            if isinstance(fetched, Note):
+                yield fetched
+                continue
+            if payloads is not None:
+                reused, fetched = reuse_converted(payloads, fetched)
+                if reused is not None:
+                    yield reused
+                if fetched is None:
+                    continue
+            pool.apply_async(convert_fetched_batch, (fetched,), callback=done.put,
+                             error_callback=lambda e, batch=fetched[0]: done.put({'question_ids': batch, 'questions': None, 'error': str(e),
+                                                                                  'counters': collections.Counter()}))
+            in_flight += 1
+        if not in_flight:
+            return
+        result = done.get()
+        in_flight -= 1
+        batch = result['question_ids']
+        if payloads is not None:
+            payloads.record(batch, result['questions'])
+        if result.get('convert_failed') and len(batch) > 1:
+            print (result['error'])
+            question_info = result.pop('question_info')
+            middle = (len(batch) + 1) // 2
+            for half in (batch[:middle], batch[middle:]):
+                retry.append((half, dict((str(i), question_info[str(i)]) for i in half if str(i) in question_info), {}))
+            # The halves are not fetched again: keep this batch's fetch cost
+            # and counters in the report
+            result['question_ids'] = []
+        result.pop('question_info', None)
+        if result['error'] is not None and result['question_ids']:
+            print (result['error'])
+        yield result
+
 # This method takes question id and process it
 def question_list(question_ids):
-    # levels = {}
-    try:  
-        question_url = QUESTION_URL % (','.join(map(str, question_ids)))
-        conn = urlopen(question_url)
-        question_info = json.loads(conn.read().decode('utf-8'))
-        # print ("question_info:", question_info)
-        conn.close()
-
-        levels = [] 
-        for key4, value4 in question_info.items():
-            question_data = {}
-            # this statement checks the success of question
-            if question_info[str(key4)]['success'] and str(value4['question']['id']) not in invalid_question_list and str(value4['question']['answer_type']) in ANSWER_TYPE_KEY: # If question response is success then only it will execute following steps
-                question_data['id'] = str(value4['question']['id'])
-                question = str(value4['question']['content'])
-                question_data['question'] = convert_question_content(question, question_data['id'], True)
-                question_data['type'] = ANSWER_TYPE_KEY[value4['question']['answer_type']][1]
-
-                if len(str(value4['question']['unit'])) > 0 and value4['question']['unit'] is not None:
-                    question_data['question'] = question_data['question'] + "\n\n \_\_\_\_\_\_ " + str(value4['question']['unit'])
-
-                possible_answers = []
-                correct_answer = []
-                for answer in value4['possible_answers']:
-                    answer_id = str(answer['id'])
-                    answer_data = convert_question_content(answer['content'], answer_id, False)
-                    possible_answers.append(answer_data)
-                    if answer['is_correct']:
-                        correct_answer.append(answer_data)
-                if str(value4['question']['answer_type']) == str(ANSWER_TYPE[0]):
-                    correct_answer = correct_answer[0]
-                    question_data['hints'] = correct_answer[0]
-
-                if str(value4['question']['answer_type']) == str(ANSWER_TYPE[0]) or str(value4['question']['answer_type']) == str(ANSWER_TYPE[1]):
-                    question_data[(ANSWER_TYPE_KEY[(value4['question']['answer_type'])][2])] = possible_answers
-                question_data[(ANSWER_TYPE_KEY[(value4['question']['answer_type'])][0])] = correct_answer
-                question_data['hints'] = correct_answer
-                question_data["difficulty_level"] = value4['question']['difficulty_level']
-                levels.append(question_data)
-        return levels
+    try:
+        return convert_question_info(fetch_question_info(question_ids))
+    except Exception as e:
+        print ("Questions {0} were skipped: {1}".format(','.join(map(str, question_ids)), e))
+
+# Pool worker: fetches and converts one batch and reports how the request went
+def fetch_question_batch(question_ids):
+    result = {'question_ids': question_ids, 'questions': None, 'requested': 0, 'bytes': 0, 'elapsed': 0.0, 'error': None}
+    start = time.time()
+    try:
+        question_info = fetch_question_info(question_ids, result)
+    except Exception as e:
+        result['error'] = str(e)
+        result['fetch_failed'] = True
+        result['overload'] = is_overload(e)
+        return result
+    result['elapsed'] = time.time() - start
+    start = time.time()
+    try:
+        result['questions'] = convert_question_info(question_info)
+    except Exception as e:
+        result['error'] = "Converting questions {0} failed: {1}".format(','.join(map(str, question_ids)), e)
+        result['convert_failed'] = True
+    result['convert_elapsed'] = time.time() - start
+    # The whole batch, fetched and converted, is the question_list stage
+    METRICS.record('question_list', result['elapsed'] + result['convert_elapsed'], result['bytes'])
+    result['counters'] = take_worker_counters()
+    result['metrics'] = METRICS.take()
+    result['profile'] = PROFILER.take()
+    return result
+
+# Pool worker for the asyncio engine: converts one fetched batch
+def convert_fetched_batch(fetched):
+    question_ids, question_info, fetch_stats = fetched
+    start = time.time()
+    result = {'question_ids': question_ids, 'questions': None, 'error': None,
+              'elapsed': fetch_stats.get('elapsed', 0.0), 'bytes': fetch_stats.get('bytes', 0)}
+    if question_info is None:
+        result['error'] = "Fetching questions {0} failed".format(','.join(map(str, question_ids)))
+    else:
+        try:
+            result['questions'] = convert_question_info(question_info)
+        except Exception as e:
+            result['error'] = "Converting questions {0} failed: {1}".format(','.join(map(str, question_ids)), e)
+            # Sent back so the batch can be split without fetching it again
+            result['convert_failed'] = True
+            result['question_info'] = question_info
+    result['convert_elapsed'] = time.time() - start
+    # The whole batch, fetched and converted, is the question_list stage
+    METRICS.record('question_list', result['elapsed'] + result['convert_elapsed'], result['bytes'])
+    result['counters'] = take_worker_counters()
+    result['metrics'] = METRICS.take()
+    result['profile'] = PROFILER.take()
+    return result
+
+# Starts a pool worker with empty metrics instead of a copy of the crawl
+# process's, profiling when the crawl does
+def start_worker(profile):
+    METRICS.reset()
+    set_profiling(profile)
+
+# Turns the profiling of every question on or off in this process
+def set_profiling(enabled):
+    PROFILER.reset(enabled)
+    METRICS.listener = PROFILER.observe if enabled else None
+
+# Counters this worker collected since its last batch
+def take_worker_counters():
+    counters = collections.Counter()
+    for name, value in MATHML_CACHE.take_counters().items():
+        counters['mathml_' + name] = value
+    for name, value in INLINE_IMAGES.take_counters().items():
+        counters['images_' + name] = value
+    for name, value in MARKDOWN.take_counters().items():
+        counters['markdown_' + name] = value
+    for name, value in PAYLOAD_CACHE.take_counters().items():
+        counters['payload_cache_' + name] = value
+    return counters
+
+# Converts an already fetched QUESTION_URL response
+def convert_question_batch(question_info):
+    if question_info is None:
+        return None
+    try:
+        return convert_question_info(question_info)
     except Exception as e:
         print (e)
-        pass
 
+# True for the QUESTION_URL entries that convert to a question
+def convertible(value):
+    return value['success'] and str(value['question']['id']) not in invalid_question_list and str(value['question']['answer_type']) in ANSWER_TYPE_KEY
+
+# Converts the questions of a QUESTION_URL response into Question records.
+# Questions are converted by payload, so one repeating the content of an
+# earlier question in the same worker is built from its conversion
+def convert_question_info(question_info):
+    levels = [] 
+    for key4, value4 in question_info.items():
+        # this statement checks the success of question
+        if convertible(value4): # If question response is success then only it will execute following steps
+            parts = PROFILER.question(str(value4['question']['id']), question_payload(value4), PAYLOAD_CACHE)
+            levels.append(build_question(str(value4['question']['id']), parts, value4['question']['difficulty_level']))
+    return levels
+
+# Converts a question payload (see question_payload) into the parts of a
+# Question. The question and answer ids do not change the converted text
+def convert_payload(payload):
+    content, answer_type_name, unit, possible = payload
+    question = convert_question_content(str(content), None, True)
+    answer_type = ANSWER_TYPE_KEY[answer_type_name]
+
+    if len(str(unit)) > 0 and unit is not None:
+        question = question + "\n\n \_\_\_\_\_\_ " + str(unit)
+
+    possible_answers = []
+    correct_answer = []
+    for answer_content, is_correct in possible:
+        answer_data = convert_question_content(answer_content, None, False)
+        possible_answers.append(answer_data)
+        if is_correct:
+            correct_answer.append(answer_data)
+    if str(answer_type_name) == str(ANSWER_TYPE[0]):
+        correct_answer = correct_answer[0]
+
+    all_answers = None
+    if str(answer_type_name) == str(ANSWER_TYPE[0]) or str(answer_type_name) == str(ANSWER_TYPE[1]):
+        all_answers = possible_answers
+    # The hints are the correct answer, which Question does not store twice
+    return question_parts(Question(None, question, answer_type[1], all_answers, answer_type[0], correct_answer))
+
+# Takes the questions of a fetched batch whose payload payloads has seen
+# converted out of the batch and builds them from that conversion. Returns a
+# result for them, or None, and what is left of the batch to convert, or None
+def reuse_converted(payloads, fetched):
+    question_ids, question_info, fetch_stats = fetched
+    if question_info is None:
+        return None, fetched
+    reused = []
+    for key, value in question_info.items():
+        if not convertible(value):
+            continue
+        digest = PAYLOAD_CACHE.key(question_payload(value))
+        parts = payloads.converted(digest)
+        if parts is None:
+            payloads.expect(value['question']['id'], digest)
+        else:
+            reused.append((key, build_question(str(value['question']['id']), parts, value['question']['difficulty_level'])))
+    if not reused:
+        return None, fetched
+    keys = set(key for key, question in reused)
+    rest = [question_id for question_id in question_ids if str(question_id) not in keys]
+    result = {'question_ids': [question_id for question_id in question_ids if str(question_id) in keys],
+              'questions': [question for key, question in reused], 'error': None, 'elapsed': 0.0, 'bytes': 0,
+              'counters': collections.Counter(payloads_reused=len(reused))}
+    if not rest:
+        # Nothing left to convert: the whole fetch went into these questions
+        result.update(elapsed=fetch_stats.get('elapsed', 0.0), bytes=fetch_stats.get('bytes', 0))
+        return result, None
+    return result, (rest, dict((key, value) for key, value in question_info.items() if key not in keys), fetch_stats)
+
+# A concurrency controller for one crawl, capped at the requests the engine
+# keeps in flight at most
+def new_concurrency_controller():
+    most = ASYNC_CONCURRENCY if FETCH_ENGINE == 'asyncio' else MAX_BATCHES_IN_FLIGHT
+    breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_MAX_OPEN_SECONDS, CIRCUIT_MAX_TRIPS)
+    return ConcurrencyController(CONCURRENCY_INITIAL, CONCURRENCY_MIN, most, CONCURRENCY_LATENCY_TOLERANCE, CONCURRENCY_DECREASE, breaker)
+
+# Feeds question ids to the pool in batches sized by the planner, keeping
+# as many batches in flight as the concurrency controller allows. Failed
+# batches are split and retried. Yields the fetch_question_batch results as
+# they arrive; ids that were given up on are yielded with no questions.
+# question_ids is a list or a QuestionFeed, which is waited on for more ids
+# until it is closed; Notes other threads put on `done`, when given, are
+# yielded as they come
+def dispatch_question_batches(pool, planner, question_ids, controller=None, done=None):
+    controller = controller or new_concurrency_controller()
+    feed = question_ids if isinstance(question_ids, QuestionFeed) else QuestionFeed(question_ids)
+    pending = feed.pending
+    retry = collections.deque()
+    attempts = {}
+    done = done or queue.Queue()
+    in_flight = 0
+    while pending or retry or in_flight or not feed.closed:
+        while (pending or retry) and controller.allows(in_flight):
+            batch = retry.popleft() if retry else planner.next_batch(pending)
+            pool.apply_async(fetch_question_batch, (batch,), callback=done.put,
+                             error_callback=lambda e, batch=batch: done.put({'question_ids': batch, 'error': str(e)}))
+            in_flight += 1
+        if not in_flight and (pending or retry):
+            # The circuit breaker is open
+            time.sleep(controller.wait_time())
+            continue
+        # Without batches in flight, the next thing on `done` is a Note
+        result = done.get()
+        if isinstance(result, Note):
+            yield result
+            continue
+        in_flight -= 1
+        if result.get('fetch_failed'):
+            controller.record_failure(result['overload'])
+        elif result.get('requested'):
+            controller.record_success(result['elapsed'] / result['requested'])
+        if result['error'] is None:
+            planner.record(result['requested'], result['elapsed'], result['bytes'])
+            yield result
+        else:
+            print (result['error'])
+            batch = result['question_ids']
+            if result.get('convert_failed'):
+                # A conversion fails the same way every time: split the batch
+                # down to the question at fault, leaving the request size alone
+                middle = (len(batch) + 1) // 2
+                retries = [batch[:middle], batch[middle:]] if len(batch) > 1 else []
+            else:
+                retries = retry_batches(planner, attempts, batch, controller.breaker.state() == 'closed')
+            retry.extend(retries)
+            if not retries:
+                yield {'question_ids': batch, 'questions': None, 'error': result['error'], 'counters': collections.Counter()}
+
+# Fetches the questions of several topics through the shared pool and maps
+# them back to their topics. Yields (topic_id, [question, ...]) for each topic
+# as soon as all of its questions are in, and lets go of every question once
+# the last topic using it has been yielded. With a journal, every finished
+# batch is checkpointed and ids it already holds are not fetched again.
+# Requests in flight are set by controller, a ConcurrencyController.
+# topic_question_ids is a list of (topic_id, question_ids), or an iterator of
+# them that is read in a thread of its own, so the questions of the first
+# topics are fetched while later ones are still being read; Notes among them
+# are yielded back in order with the topics
+def iter_topic_questions(pool, planner, topic_question_ids, journal=None, controller=None):
+    remaining = {}
+    waiting = {}
+    users = collections.Counter()
+    ids_by_topic = {}
+    questions_by_id = {}
+    # Ids whose batch is in, kept while a topic that is not done uses them
+    finished = set()
+    # Share of its batch's fetch time, conversion time and bytes for each id
+    costs_by_id = {}
+    resumed = collections.Counter()
+    streamed = not isinstance(topic_question_ids, list)
+    feed = QuestionFeed(closed=not streamed)
+    # Batches, and the Notes the reading thread hands topics over in
+    inbox = queue.Queue(PIPELINE_QUEUE_SIZE if FETCH_ENGINE == 'asyncio' else 0)
+    stopped = threading.Event()
+
+    def topic_done(topic_id):
+        ids = [str(i) for i in ids_by_topic.pop(topic_id)]
+        topic_questions = [questions_by_id[i] for i in ids if i in questions_by_id]
+        costs = [costs_by_id.pop(i) for i in set(ids) if i in costs_by_id]
+        METRICS.add_subtotal(topic_group(topic_id), topics=1, questions=len(topic_questions),
+                             fetch_seconds=sum(cost[0] for cost in costs), convert_seconds=sum(cost[1] for cost in costs),
+                             bytes=sum(cost[2] for cost in costs))
+        for i in set(ids):
+            users[i] -= 1
+            if users[i] <= 0:
+                del users[i]
+                questions_by_id.pop(i, None)
+                finished.discard(i)
+        return topic_questions
+
+    # Starts waiting for the questions of some topics. Returns the ids to
+    # fetch, in order and each once, even when several topics share them, and
+    # the topics that have all their questions already
+    def register(topics):
+        question_ids = []
+        ready = []
+        for topic_id, ids in topics:
+            ids_by_topic[topic_id] = ids
+            wanted = remaining[topic_id] = set()
+            seen = set()
+            for question_id in ids:
+                i = str(question_id)
+                if i in seen:
+                    continue
+                seen.add(i)
+                users[i] += 1
+                if i in finished:
+                    continue
+                wanted.add(i)
+                if i not in waiting:
+                    waiting[i] = []
+                    question_ids.append(question_id)
+                waiting[i].append(topic_id)
+            if not wanted:
+                del remaining[topic_id]
+                ready.append(topic_id)
+        return question_ids, ready
+
+    # Takes the questions of a finished batch; yields the topics it completes
+    def take(result):
+        if journal is not None and not result.get('resumed'):
+            if result.get('error') is None:
+                journal.record_batch(result['question_ids'], result['questions'])
+            else:
+                journal.record_failure(result['question_ids'], result['error'])
+        CRAWL_COUNTERS.update(result['counters'])
+        METRICS.merge(result.get('metrics'))
+        PROFILER.merge(result.get('profile'))
+        share = float(max(1, len(result['question_ids'])))
+        cost = (result.get('elapsed', 0.0) / share, result.get('convert_elapsed', 0.0) / share, result.get('bytes', 0) / share)
+        for question_id in result['question_ids']:
+            costs_by_id[str(question_id)] = cost
+        # removed empty list if we don't get response of questoions
+        for question in result['questions'] or []:
+            questions_by_id[question["id"]] = question
+        for question_id in result['question_ids']:
+            finished.add(str(question_id))
+            for topic_id in waiting.pop(str(question_id), []):
+                remaining[topic_id].discard(str(question_id))
+                if not remaining[topic_id]:
+                    del remaining[topic_id]
+                    yield topic_id, topic_done(topic_id)
+
+    # Registers topics and hands their new ids to the fetch engine, apart
+    # from those the journal holds; yields the topics that are done already
+    def add(topics):
+        question_ids, ready = register(topics)
+        done = journal.load(question_ids) if journal is not None and question_ids else {}
+        if done:
+            resumed['questions'] += len(done)
+            question_ids = [question_id for question_id in question_ids if str(question_id) not in done]
+        feed.add(question_ids)
+        for topic_id in ready:
+            yield topic_id, topic_done(topic_id)
+        if done:
+            for topic in take({'question_ids': list(done), 'questions': [Question.from_dict(q) for q in done.values() if q is not None],
+                               'counters': collections.Counter(), 'resumed': True}):
+                yield topic
+
+    def put(note):
+        while not stopped.is_set():
+            try:
+                inbox.put(note, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    # Hands the topics over as they are read; Note(None) once all are in
+    def read():
+        try:
+            for item in topic_question_ids:
+                if stopped.is_set():
+                    break
+                put(Note(item))
+        except Exception as e:
+            print (e)
+        finally:
+            if hasattr(topic_question_ids, 'close'):
+                topic_question_ids.close()
+            put(Note(None))
+
+    try:
+        try:
+            if streamed:
+                threading.Thread(target=read, daemon=True).start()
+                topics = []
+            else:
+                # The largest topics come first so their batches are dispatched first
+                topics = add(sorted(topic_question_ids, key=lambda item: len(item[1]), reverse=True))
+            if FETCH_ENGINE == 'asyncio':
+                # Fetch in this process, convert in the pool what was not converted before
+                results = convert_fetched_batches(pool, iter_fetched_batches(planner, feed, controller, inbox), PAYLOADS)
+            else:
+                results = dispatch_question_batches(pool, planner, feed, controller, inbox)
+            for topic in topics:
+                yield topic
+            for result in results:
+                if not isinstance(result, Note):
+                    topics = take(result)
+                elif result.value is None:
+                    feed.close()
+                    continue
+                elif isinstance(result.value, Note):
+                    yield result.value
+                    continue
+                else:
+                    topics = add([result.value])
+                for topic in topics:
+                    yield topic
+        except Exception as e:
+            print (e)
+        if resumed:
+            print ("Resumed {0} questions from the checkpoint journal".format(resumed['questions']))
+        # Whatever is left could not be fetched completely
+        for topic_id in list(remaining):
+            del remaining[topic_id]
+            yield topic_id, topic_done(topic_id)
+    finally:
+        stopped.set()
+        feed.pending.clear()
+        feed.close()
+
+# Board and standard a topic key belongs to, as the subtotals are grouped
+def topic_group(topic_key):
+    return '/'.join(topic_key[:2])
+
+# Fingerprint of a topic's question id list
+def topic_fingerprint(question_ids):
+    source = TOPIC_FINGERPRINT_VERSION + ':' + ','.join(map(str, question_ids))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+# True when every question of a topic has a fresh response cache entry
+def questions_cached(question_ids):
+    for question_id in question_ids:
+        entry = RESPONSE_CACHE.get('question:' + str(question_id))
+        if entry is None or not RESPONSE_CACHE.is_fresh(entry):
+            return False
+    return True
+
+# Returns the levels stored for a topic by an earlier crawl, or None when its
+# question ids changed, the stored topic expired or its questions are due
+# for revalidation
+def load_topic_levels(topic_id, question_ids):
+    entry = TOPIC_STORE.get('topic:' + topic_id)
+    if entry is None or not TOPIC_STORE.is_fresh(entry):
+        return None
+    if entry['value']['fingerprint'] != topic_fingerprint(question_ids) or not questions_cached(question_ids):
+        return None
+    return [Level.from_dict(level) for level in entry['value']['levels']]
+
+# Stores the levels of a topic for later incremental crawls. Topics with
+# questions that could not be fetched are not stored, so they are retried
+def save_topic_levels(topic_id, question_ids, levels):
+    if questions_cached(question_ids):
+        TOPIC_STORE.put('topic:' + topic_id, {'fingerprint': topic_fingerprint(question_ids), 'levels': [level.to_dict() for level in levels]})
+
+# Groups the questions of one topic into level exercises
+def build_levels(topic_id, topic_questions):
+    # To sort data levelwise 
+    arrlevels = sorted(topic_questions, key=lambda k: k["id"])
+    levels = {}
+    # This code seperates the different questions based on level
+    for i in arrlevels:
+        diff = i["difficulty_level"]
+        if i["difficulty_level"] not in levels:
+            if str(i["difficulty_level"]) == "3":
+                val = "Challenge Set"
+                val1 = "Challenge_Set"   
+                source_id_unique = val1 + "_" + str(topic_id)  
+            else:
+                val = 'Level ' + str(i["difficulty_level"])
+                val1 = 'Level_' + str(i["difficulty_level"])
+                source_id_unique = val1 + "_" + str(topic_id)  
+            levels[diff] = Level(source_id_unique, val, [])
+        levels[diff]["questions"].append(i)
+    return list(levels.values())
+
+# Standards are numbers kept as strings; order them numerically
+def standard_sort_key(standard):
+    return (0, int(standard), standard) if standard.isdigit() else (1, 0, standard)
+
+# The selected topics of the tree document, read as it arrives (see
+# iter_tree_events), for iter_topic_questions: (topic_key, question_ids) for
+# every topic with questions to fetch, as soon as it is read, and Notes of
+#   ('stored', topic_key, levels)   a topic reusing its stored levels (incremental)
+#   ('board', board)                a board, before its standards
+#   ('standard', standard)          a standard with its topic tree
+# Boards and standards keep the crawl's order (boards descending, standards
+# by standard_sort_key, or as listed): each goes out once it and everything
+# before it has been read. The Topic of every selected topic is put in
+# topics_by_key before its standard goes out
+def iter_selected_topics(incremental, boards, standards, topics_by_key):
+    # Standards of every selected board read so far, in document order
+    seen = {}
+    # Boards read to the end
+    closed = set()
+    # Topics of the standards being read, by subject
+    subjects = {}
+    # Standards read but not gone out yet
+    parsed = {}
+    tree_done = failed = False
+    next_board, next_standard = 0, None
+
+    def standard_data(board_id, standard_id):
+        print (board_id + " Standards - " + standard_id)
+        standards_data = dict()
+        standards_data['id'] = standard_id
+        standards_data['title'] = standard_id
+        standards_data['description'] = DESCRIPTION
+        standards_data['children'] = []
+        result = []
+        for subject_id, topics in subjects.pop((board_id, standard_id), {}).items():
+            # calling build_magoegnie_tree by passing topics to create a magogenie tree
+            result = build_magogenie_tree(topics)
+            print(board_id + '--' + standard_id + '--' + subject_id)
+        standards_data['children'] = result
+        return standards_data
+
+    # Boards and standards whose turn has come
+    def ready():
+        nonlocal next_board, next_standard
+        if boards is not None:
+            order = boards
+        elif tree_done:
+            # To get boards in descending order used[::-1]
+            order = sorted(seen.keys())[::-1]
+        else:
+            return
+        while next_board < len(order):
+            key = order[next_board]
+            if key not in seen:
+                if not tree_done:
+                    return
+                if not failed:
+                    print ("Board " + key + " is not in the tree")
+                next_board += 1
+                continue
+            if next_standard is None:
+                board = dict()
+                board['id'] = key
+                board['title'] = key
+                board['description'] = DESCRIPTION
+                board['children'] = []
+                yield Note(('board', board))
+                next_standard = 0
+            # To get standards in ascending order
+            if standards is not None:
+                listed = standards
+            elif key in closed:
+                listed = sorted(seen[key], key=standard_sort_key)
+            else:
+                return
+            while next_standard < len(listed):
+                if (key, listed[next_standard]) in parsed:
+                    yield Note(('standard', parsed.pop((key, listed[next_standard]))))
+                elif key not in closed:
+                    return
+                elif not failed:
+                    print (key + " has no standard " + listed[next_standard])
+                next_standard += 1
+            next_board, next_standard = next_board + 1, None
 
-def get_magogenie_info_url():
-    SAMPLE = []
-    data = {}
     try:
-        conn = urlopen(TREE_URL)
-        data = json.loads(conn.read().decode('utf-8'))
-        conn.close()
+        for event in iter_tree_events():
+            keys = event[1]
+            if not keys:
+                tree_done = event[0] == 'end'
+            elif boards is not None and keys[0] not in boards or len(keys) > 1 and standards is not None and keys[1] not in standards:
+                continue
+            elif event[0] == 'item':
+                board_id, standard_id, subject_id = keys[:3]
+                value3 = event[2]
+                topic_data = Topic(str(value3['ancestry']) if value3['ancestry'] else None, str(value3['id']), value3['name'], [])
+                topic_key = (board_id, standard_id, topic_data["id"])
+                topics_by_key[topic_key] = topic_data
+                subjects.setdefault(keys[:2], {}).setdefault(subject_id, []).append(topic_data)
+                if value3['question_ids']:
+                    levels = load_topic_levels(topic_data["id"], value3['question_ids']) if incremental else None
+                    if levels is not None:
+                        yield Note(('stored', topic_key, levels))
+                    else:
+                        yield topic_key, value3['question_ids']
+                continue
+            elif event[0] != 'end':
+                continue
+            elif len(keys) == 3:
+                # A subject without topics still counts as the standard's last
+                subjects.setdefault(keys[:2], {}).setdefault(keys[2], [])
+                continue
+            elif len(keys) == 2:
+                seen.setdefault(keys[0], []).append(keys[1])
+                parsed[keys] = standard_data(*keys)
+            else:
+                seen.setdefault(keys[0], [])
+                closed.add(keys[0])
+            for note in ready():
+                yield note
     except Exception as e:
         print(e)
+        # What was read whole still goes out
+        tree_done = failed = True
+        closed.update(seen)
+        for note in ready():
+            yield note
 
-    # To get boards in descending order used[::-1]
-    # We have tesing here only for BalBharati board 
-    for key in ['BalBharati']:#sorted(data['boards'].keys())[::-1]:     
-        value = data['boards'][key]
-        board = dict()
-        board['id'] = key
-        board['title'] = key
-        board['description'] = DESCRIPTION
-        board['children'] = []
-        # To get standards in ascending order
-        # we have use 6th std for testing purpose
-        for key1 in ['3','4','5','6','7','8']:#sorted(value['standards'].keys()):  
-
-            value1 = value['standards'][key1]
-            print (key+" Standards - " + key1)
-            standards = dict()
-            standards['id'] = key1
-            standards['title'] = key1
-            standards['description'] = DESCRIPTION
-            standards['children'] = []
-            # To get subject under the standard
-            for key2, value2 in value1['subjects'].items():
-                subjects = dict()
-                subjects['id'] = key2
-                subjects['title'] = key2
-                subjects['description'] = DESCRIPTION
-                subjects['children'] = []
+# Walks the selected boards and standards of the tree document and streams them out:
+#   ('board', board)                a board, before its standards
+#   ('standard', standard)          a standard with its topic tree, still without levels
+#   ('levels', topic_key, levels)   the levels of one topic, as soon as its questions
+#                                   are converted and its standard has gone out;
+#                                   topic_key is (board id, standard id, topic id)
+# boards and standards are lists of ids, None selecting all of them. The tree
+# document is read as it arrives (see iter_selected_topics): the questions of
+# every topic are handed to one dispatcher as soon as the topic is read, so
+# they are fetched while the rest of the document is still coming and
+# subjects and standards are fetched and converted concurrently within the
+# pool's budget.
+# When incremental is true, topics whose question ids and cached questions are
+# unchanged since the last crawl reuse their stored levels instead of being
+# fetched and converted again.
+# Finished batches are checkpointed in CHECKPOINT_JOURNAL; when resume is true
+# and the last crawl over the same boards and standards did not finish, only
+# the questions it had not finished, or gave up on, are fetched
+def iter_magogenie_tree(incremental=INCREMENTAL, boards=BOARDS, standards=STANDARDS, resume=RESUME):
+    reused_topics = 0
+    CRAWL_COUNTERS.clear()
+    del CONCURRENCY_HISTORY[:]
+    PAYLOADS.clear()
 
-                topics = []
-                # To get topic names under subjects
-                for key3,value3 in value2['topics'].items():
-                    # value3 = value2['topics'][key3]
-                    topic_data = dict()
-                    topic_data["ancestry"] = None
-                    if value3['ancestry']:
-                        topic_data["ancestry"] = str(value3['ancestry'])
-                    topic_data["id"] = str(value3['id'])
-                    topic_data["title"] = value3['name']
-                    topic_data["description"] = DESCRIPTION
-                    topic_data["license"] = licenses.ALL_RIGHTS_RESERVED
-                    topic_data["mastery_model"] = exercises.M_OF_N
-                    topic_data["children"] = []
-                    if value3['question_ids']:
-                        # To take 6 question ids and put into URL for getting result
-                        f = lambda A, n=6: [A[i:i+n] for i in range(0, len(A), n)]
-                        levels = {}
-                        p = Pool(5)
-                      
-                        try:
-                            arrlevels = []
-                            arrlevels = p.map(question_list, f(value3['question_ids']))
-                            p.close()
-                            p.join()
-                        except Exception as e:
-                            print (e)
-                        # removed empty list if we don't get response of questoions    
-                        m = []
-                        # print ("arrlevels:",arrlevels)
-                        for arrlevel in arrlevels:
-                            if arrlevel is not None:
-                                if len(arrlevel)>0:
-                                    m.append(arrlevel)
-
-                                # To convert multiple list into single list
-                        newlist = list(itertools.chain(*m))             
-                        # To sort data levelwise 
-                        arrlevels = sorted(newlist, key=lambda k: k["id"])  
-                        newlist = []
-                        level = {}
-
-                        # This code seperates the different questions based on level
-                        for i in arrlevels:
-                            diff = i["difficulty_level"]
-                            if i["difficulty_level"] not in levels:
-                                if str(i["difficulty_level"]) == "3":
-                                    val = "Challenge Set"
-                                    val1 = "Challenge_Set"   
-                                    source_id_unique = val1 + "_" + str(value3['id'])  
-                                else:
-                                    val = 'Level ' + str(i["difficulty_level"])
-                                    val1 = 'Level_' + str(i["difficulty_level"])
-                                    source_id_unique = val1 + "_" + str(value3['id'])  
-                                levels[diff] = {'id': source_id_unique, 'title': val, 'questions': [], 'description':DESCRIPTION, 'mastery_model': exercises.M_OF_N, 'license': licenses.ALL_RIGHTS_RESERVED, 'domain_ns': 'GreyKite Technologies Pvt. Ltd.', 'Copyright Holder':'GreyKite Technologies Pvt. Ltd.'}
-                            levels[diff]["questions"].append(i)
-                        arrlevels = []
-                        arrlevels.append(levels)
-
-                        for index, level in levels.items():
-                            topic_data["children"].append(level)
-                    topics.append(topic_data)
-                # calling build_magoegnie_tree by passing topics to create a magogenie tree 
-                result = build_magogenie_tree(topics)  
-            print(key + '--' + key1 + '--' + key2)
-            standards['children'] = result
-            board['children'].append(standards)
-        SAMPLE.append(board)
+    # One worker pool is shared by every topic of the crawl
+    pool = Pool(CONVERT_POOL_SIZE if FETCH_ENGINE == 'asyncio' else POOL_SIZE, initializer=start_worker, initargs=(PROFILER.enabled,))
+    journal = None
+    if CHECKPOINT_JOURNAL:
+        journal = CheckpointJournal(CHECKPOINT_JOURNAL, TOPIC_FINGERPRINT_VERSION)
+        if journal.start({'boards': boards, 'standards': standards}, resume):
+            print ("Resuming the unfinished crawl")
+    prefetcher = None
+    if IMAGE_STORE is not None and PREFETCH_IMAGES:
+        prefetcher = ImagePrefetcher(IMAGE_STORE, ResponseCache(os.path.join(IMAGE_DIR, 'urls'), IMAGE_URL_TTL, IMAGE_URL_MAX_BYTES),
+                                     AsyncFetcher(IMAGE_PREFETCH_CONCURRENCY, ASYNC_TIMEOUT, ASYNC_RETRIES, ASYNC_BACKOFF))
+    planner = BatchPlanner(QUESTION_URL, QUESTION_BATCH_SIZE, BATCH_MIN_SIZE, BATCH_MAX_SIZE, BATCH_TARGET_SECONDS,
+                           BATCH_TARGET_BYTES, MAX_URL_LENGTH, os.path.join(STATE_DIR, 'batch_planner.json'))
+    controller = new_concurrency_controller()
+    try:
+        topics_by_key = {}
+        ids_by_topic = {}
+
+        # Runs in the thread iter_topic_questions reads topics in
+        def tree_topics():
+            for item in iter_selected_topics(incremental, boards, standards, topics_by_key):
+                if not isinstance(item, Note):
+                    ids_by_topic[item[0]] = item[1]
+                yield item
+
+        def topic_levels():
+            nonlocal reused_topics
+            # Questions of every selected topic are fetched together
+            for item in iter_topic_questions(pool, planner, tree_topics(), journal, controller):
+                if not isinstance(item, Note):
+                    topic_key, topic_questions = item
+                    levels = build_levels(topic_key[2], topic_questions)
+                    save_topic_levels(topic_key[2], ids_by_topic.pop(topic_key), levels)
+                    yield topic_key, levels
+                elif item.value[0] == 'stored':
+                    reused_topics += 1
+                    yield item.value[1], item.value[2]
+                else:
+                    yield item
+
+        def levels_event(topic_key, levels):
+            return 'levels', topic_key, name_levels(topics_by_key.pop(topic_key), share_levels(PAYLOADS, levels))
+
+        # Levels wait for their standard to go out, which names the topics
+        held = {}
+        announced = set()
+        board_id = None
+        for item in localize_topic_images(prefetcher, topic_levels()):
+            if not isinstance(item, Note):
+                if item[0][:2] in announced:
+                    yield levels_event(*item)
+                else:
+                    held.setdefault(item[0][:2], []).append(item)
+                continue
+            yield item.value
+            if item.value[0] == 'board':
+                board_id = item.value[1]['id']
+            else:
+                announced.add((board_id, item.value[1]['id']))
+                for topic in held.pop((board_id, item.value[1]['id']), []):
+                    yield levels_event(*topic)
+        if held:
+            print ("Levels of {0} topics were dropped: their standards could not be read whole".format(sum(map(len, held.values()))))
+        if journal is not None:
+            failed = journal.failed()
+            if failed:
+                # The next crawl tries them again with everything else
+                print ("{0} questions could not be fetched or converted: {1}".format(len(failed), ', '.join(failed)))
+                retried = journal.retried()
+                if retried:
+                    print ("{0} of them failed in the last crawl too".format(len(retried)))
+            journal.finish()
+    finally:
+        if journal is not None:
+            journal.close()
+        pool.close()
+        pool.join()
+        planner.save()
+        take_controller_metrics(controller)
+        if prefetcher is not None:
+            prefetcher.close()
+            for name, value in prefetcher.counters.items():
+                CRAWL_COUNTERS['image_urls_' + name] += value
+    RESPONSE_CACHE.evict()
+    TOPIC_STORE.evict()
+    if incremental:
+        print ("Reused {0} unchanged topics".format(reused_topics))
+    print ("MathML conversions: {0} cached in memory, {1} cached on disk, {2} converted".format(
+        CRAWL_COUNTERS['mathml_hits'], CRAWL_COUNTERS['mathml_disk_hits'], CRAWL_COUNTERS['mathml_misses']))
+    report_payloads(PAYLOADS)
+    if CRAWL_COUNTERS['markdown_fallback']:
+        print ("Markdown: {0} strings converted directly, {1} through html2text".format(
+            CRAWL_COUNTERS['markdown_direct'], CRAWL_COUNTERS['markdown_fallback']))
+    if CRAWL_COUNTERS['images_misses']:
+        print ("Inline images: {0} extracted, {1} repeated".format(CRAWL_COUNTERS['images_misses'], CRAWL_COUNTERS['images_hits']))
+    if prefetcher is not None and prefetcher.counters:
+        print ("Image URLs: {0} downloaded, {1} already stored, {2} failed".format(
+            CRAWL_COUNTERS['image_urls_downloaded'], CRAWL_COUNTERS['image_urls_stored'], CRAWL_COUNTERS['image_urls_failed']))
+    print ("Concurrency: {0} requests in flight at the end, {1} at most; raised {2} times, lowered {3} times; "
+           "fetching paused {4} times".format(controller.allowed, controller.peak, CRAWL_COUNTERS['concurrency_increases'],
+                                              CRAWL_COUNTERS['concurrency_decreases'], CRAWL_COUNTERS['circuit_opened']))
+
+# Adds the decisions of a crawl's concurrency controller to CRAWL_COUNTERS,
+# CONCURRENCY_HISTORY and METRICS, which times every outage the circuit
+# breaker waited out
+def take_controller_metrics(controller):
+    for name, value in controller.counters.items():
+        CRAWL_COUNTERS['concurrency_' + name] += value
+    for name, value in controller.breaker.counters.items():
+        CRAWL_COUNTERS['circuit_' + name] += value
+    CRAWL_COUNTERS['concurrency_peak'] = controller.peak
+    CRAWL_COUNTERS['concurrency_final'] = controller.allowed
+    CONCURRENCY_HISTORY[:] = controller.history
+    for seconds in controller.breaker.outages:
+        METRICS.record('circuit_outage', seconds)
+    if controller.breaker.outage_started is not None:
+        METRICS.record('circuit_outage', controller.breaker.clock() - controller.breaker.outage_started)
+
+# Points the questions of some levels at the one copy payloads keeps of
+# their converted text and answers
+def share_levels(payloads, levels):
+    for level in levels:
+        for question in level.get('questions', []):
+            payloads.share(question)
+    return levels
+
+# Adds how many questions repeated an earlier one to CRAWL_COUNTERS and prints it
+def report_payloads(payloads):
+    report = payloads.report()
+    CRAWL_COUNTERS['payloads_distinct'] = report['distinct']
+    CRAWL_COUNTERS['payloads_repeated'] = report['repeated']
+    print ("Question payloads: {0} questions, {1} distinct ({2:.0%} repeated); {3} converted in the workers, {4} built from earlier conversions".format(
+        report['questions'], report['distinct'], report['ratio'], CRAWL_COUNTERS['payload_cache_misses'],
+        CRAWL_COUNTERS['payload_cache_hits'] + CRAWL_COUNTERS['payloads_reused']))
+
+# Remote images shown by the questions of some levels
+def level_image_urls(levels):
+    urls = set()
+    for level in levels:
+        for question in level.get('questions', []):
+            for text in question_strings(question):
+                if '](http' in text:
+                    urls.update(REGEX_IMAGE_URL.findall(text))
+    return urls
+
+# Every string of a converted question: the question, answers and hints
+def question_strings(question):
+    for value in question.values():
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, str):
+                    yield item
+
+# Points the questions of some levels at the local copies of their images
+def localize_levels(levels, paths):
+    replace = lambda text: REGEX_IMAGE_URL.sub(lambda m: m.group(0).replace(m.group(1), paths.get(m.group(1)) or m.group(1)), text)
+    for level in levels:
+        for question in level.get('questions', []):
+            for key, value in question.items():
+                if isinstance(value, str):
+                    question[key] = replace(value)
+                elif isinstance(value, list):
+                    question[key] = [replace(item) if isinstance(item, str) else item for item in value]
+    return levels
+
+# Starts downloading the images of every topic as it comes in and passes the
+# topic on once they are stored, pointing its questions at the local copies.
+# Topics wait for their own images only, so downloads overlap with the
+# conversion of later topics. Images that fail keep their URL
+def localize_topic_images(prefetcher, topics):
+    if prefetcher is None:
+        for topic in topics:
+            yield topic
+        return
+    waiting = []
+
+    def finish(topic_key, levels, futures):
+        paths = dict((image_url, future.result()) for image_url, future in futures.items())
+        return topic_key, localize_levels(levels, paths) if paths else levels
+
+    for topic in topics:
+        if isinstance(topic, Note):
+            yield topic
+            continue
+        topic_key, levels = topic
+        futures = dict((image_url, prefetcher.prefetch(image_url)) for image_url in level_image_urls(levels))
+        waiting.append((topic_key, levels, futures))
+        still_waiting = []
+        for topic in waiting:
+            if all(future.done() for future in topic[2].values()):
+                yield finish(*topic)
+            else:
+                still_waiting.append(topic)
+        waiting = still_waiting
+    for topic in waiting:
+        yield finish(*topic)
+
+# Keys of the topics in a standard's topic tree, as used in 'levels' events
+def standard_topic_keys(board_id, standard):
+    return [((board_id, standard['id'], topic['id']), topic) for topic in walk_topics(standard['children'])]
+
+# The events of iter_magogenie_tree, read back from a snapshot when one is
+# given. A live crawl is written to SNAPSHOT_PATH as it goes
+def source_tree_events(incremental, boards, standards, resume, snapshot=None):
+    if snapshot:
+        print ("Building from the snapshot " + snapshot)
+        return shared_snapshot_events(snapshot)
+    events = iter_magogenie_tree(incremental, boards, standards, resume)
+    if SNAPSHOT_PATH:
+        events = write_snapshot(events, SNAPSHOT_PATH, {'boards': boards, 'standards': standards, 'conversion': TOPIC_FINGERPRINT_VERSION})
+    return events
+
+# The events of a snapshot, with repeated questions sharing their text
+def shared_snapshot_events(snapshot):
+    PAYLOADS.clear()
+    for event in iter_snapshot(snapshot):
+        if event[0] == 'levels':
+            share_levels(PAYLOADS, event[2])
+        yield event
+    report = PAYLOADS.report()
+    print ("Question payloads: {0} questions, {1} distinct ({2:.0%} repeated)".format(report['questions'], report['distinct'], report['ratio']))
+
+# Builds the whole source tree in memory, the way construct_channel used to
+def get_magogenie_info_url(incremental=INCREMENTAL, boards=BOARDS, standards=STANDARDS, resume=RESUME, snapshot=None):
+    SAMPLE = []
+    topics_by_key = {}
+    for event in source_tree_events(incremental, boards, standards, resume, snapshot):
+        if event[0] == 'board':
+            SAMPLE.append(event[1])
+        elif event[0] == 'standard':
+            SAMPLE[-1]['children'].append(event[1])
+            topics_by_key.update(standard_topic_keys(SAMPLE[-1]['id'], event[1]))
+        elif event[1] in topics_by_key:
+            # Levels come before the subtopics
+            topics_by_key[event[1]]['children'][:0] = event[2]
     return SAMPLE
 
+# Yields every topic of a topic tree built by build_magogenie_tree
+def walk_topics(topics):
+    for topic in topics:
+        yield topic
+        for child in walk_topics(topic['children']):
+            yield child
+
+# Titles the levels of a topic the way build_magogenie_tree does: the levels
+# of a subtopic carry the subtopic's name
+def name_levels(topic, levels):
+    if topic['ancestry'] != None:
+        for level in levels:
+            level['title'] = level['title'] + ": " + topic['title']
+    return levels
+
 # Bulid magogenie_tree
+@METRICS.timed('build_magogenie_tree')
 def build_magogenie_tree(topics):
     # To sort topics data id wise 
     tpo = sorted(topics, key=operator.itemgetter("id"))
@@ -300,20 +1356,122 @@ def build_magogenie_tree(topics):
     return result
 
 # Constructing Magogenie Channelss
-def construct_channel(result=None):
+# Options given on the ricecooker command line (key=value) arrive as strings
+def _as_bool(value, default):
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+# Comma separated ids from the command line; "all" selects everything
+def _as_list(value, default):
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return None if value.lower() == 'all' else [item.strip() for item in value.split(',') if item.strip()]
+    return list(value)
+
+# The channel is built while the crawl runs: the topic nodes of a standard
+# are created as soon as the tree document has been read, and the exercises
+# of each topic are added as soon as its questions are converted.
+# boards and standards select what to import, e.g. boards=BalBharati,CBSE
+# standards=all on the uploadchannel command line; report= overrides RUN_REPORT
+# and resume=false starts over even when the last crawl did not finish.
+# snapshot=<path> builds the channel from a snapshot left by an earlier crawl
+# (see SNAPSHOT_PATH) instead of crawling; the snapshot holds the boards and
+# standards that crawl selected
+def construct_channel(result=None, incremental=None, boards=None, standards=None, report=None, resume=None, snapshot=None,
+                      profile=None):
+    started = datetime.datetime.now()
+    METRICS.reset()
+    options = {'incremental': _as_bool(incremental, INCREMENTAL), 'boards': _as_list(boards, BOARDS),
+               'standards': _as_list(standards, STANDARDS), 'resume': _as_bool(resume, RESUME),
+               'fetch_engine': FETCH_ENGINE, 'pool_size': CONVERT_POOL_SIZE if FETCH_ENGINE == 'asyncio' else POOL_SIZE,
+               'snapshot': snapshot, 'profile': _as_bool(profile, PROFILE_QUESTIONS)}
+    set_profiling(options['profile'])
 
-    result_data = get_magogenie_info_url()
     channel = nodes.ChannelNode(
         source_domain="magogenie.com",
         source_id="Magogenie BalBharati Final Import",
         title="Magogenie BalBharati",
         thumbnail = "/Users/Admin/Documents/mago.png",
     )
-    _build_tree(channel, result_data)
+    board_node = None
+    topic_nodes = {}
+    for event in source_tree_events(options['incremental'], options['boards'], options['standards'], options['resume'], snapshot):
+        if event[0] == 'board':
+            board_node = _build_tree(channel, [event[1]]).children[-1]
+        elif event[0] == 'standard':
+            standard_node = _build_tree(board_node, [event[1]]).children[-1]
+            for node in walk_nodes(standard_node.children):
+                topic_nodes[(board_node.source_id, standard_node.source_id, node.source_id)] = node
+        elif event[1] in topic_nodes:
+            add_levels(topic_nodes.pop(event[1]), event[2])
     raise_for_invalid_channel(channel)
+    write_run_report(report or RUN_REPORT, started, options)
+    if options['profile']:
+        write_profile_report(PROFILE_DIR)
+        set_profiling(False)
     return channel
 
+# Writes the machine-readable report of a run: its options and duration,
+# the crawl counters, call counts and latencies of every stage summed over
+# all pool workers, subtotals per board and standard and how the requests
+# in flight changed over the crawl
+def write_run_report(path, started, options):
+    if not path:
+        return
+    report = {'started': started.isoformat(), 'seconds': (datetime.datetime.now() - started).total_seconds(),
+              'options': options, 'counters': dict(CRAWL_COUNTERS), 'concurrency_history': CONCURRENCY_HISTORY}
+    report.update(METRICS.report())
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print ("Run report written to " + path)
+    except OSError as e:
+        print (e)
+
+# Writes what PROFILER recorded into directory and prints the slowest
+# questions and MathML fragments. Conversions answered by the MathML, image
+# and payload caches cost next to nothing, so a cold cache shows the most
+def write_profile_report(directory, shown=10):
+    if not PROFILER.totals['questions']:
+        print ("Profiling: no question was converted")
+        return
+    try:
+        report = PROFILER.report(directory)
+    except OSError as e:
+        print (e)
+        return
+    totals = report['totals']
+    print ("Profiling: {0} questions in {1:.1f}s, {2} MathML fragments in {3:.1f}s; report in {4}".format(
+        totals['questions'], totals['question_seconds'], totals.get('fragments', 0), totals.get('fragment_seconds', 0.0),
+        os.path.join(directory, 'profile.json')))
+    for item in report['questions'][:shown]:
+        stages = ', '.join('{0} {1:.3f}s'.format(stage, seconds) for stage, seconds in sorted(item['stages'].items(), key=lambda stage: -stage[1]))
+        print ("  question {0}: {1:.3f}s ({2:.1%}), {3} bytes, {4} images, {5} MathML; {6}".format(
+            item['id'], item['seconds'], item['share'], item['bytes'], item['images'], item['mathml'], stages))
+    for item in report['fragments'][:shown]:
+        print ("  MathML of question {0}: {1:.3f}s ({2:.3f}s transform, {3:.3f}s regex), {4} bytes".format(
+            item['question'], item['seconds'], item['transform_seconds'], item['regex_seconds'], item['bytes']))
+
+# Yields every node below the given ricecooker nodes
+def walk_nodes(children):
+    for node in children:
+        yield node
+        for child in walk_nodes(node.children):
+            yield child
+
+# Builds the exercises of a topic node ahead of its subtopic nodes
+def add_levels(topic_node, levels):
+    count = len(topic_node.children)
+    _build_tree(topic_node, levels)
+    topic_node.children[:] = topic_node.children[count:] + topic_node.children[:count]
+
 # Build tree for channel
+@METRICS.timed('_build_tree')
 def _build_tree(node, sourcetree):
 
     for child_source_node in sourcetree:
@@ -385,6 +1543,7 @@ def add_files(node, file_list):
             raise UnknownFileTypeError("Unrecognized file type '{0}'".format(f['path']))
 
 
+@METRICS.timed('create_question')
 def create_question(raw_question):
 
     if raw_question["type"] == exercises.MULTIPLE_SELECTION:
@@ -415,56 +1574,222 @@ def create_question(raw_question):
     else:
         raise UnknownQuestionTypeError("Unrecognized question type '{0}': accepted types are {1}".format(raw_question["type"], [key for key, value in exercises.question_choices]))
 
+# The rewrites convert_question_content applies, in order. Each rule is
+# (condition, steps): the condition is None, a substring or a compiled regex,
+# checked once before the steps run. Each step is (guard, pattern, replacement)
+# where pattern is a literal or a compiled regex. A step is skipped unless its
+# guard (a substring, or a tuple of substrings of which one must occur) is in
+# the content, so most steps cost a substring scan instead of a rewrite pass.
+# Steps were only merged where the merged pattern provably rewrites the same
+# text; everything else keeps its original order.
+def compile_rules(rules):
+    compiled = []
+    for condition, steps in rules:
+        compiled_steps = []
+        for guard, pattern, replacement in steps:
+            if isinstance(pattern, str):
+                # A literal step can only change content that contains it
+                guard = pattern if guard is None else guard
+            elif isinstance(replacement, str):
+                # Regex replacements are literal text, not templates
+                replacement = replacement.replace('\\', '\\\\')
+            if isinstance(guard, str):
+                guard = (guard,)
+            compiled_steps.append((guard, pattern, replacement))
+        compiled.append((condition, compiled_steps))
+    return compiled
+
+def rewrite(content, rules):
+    for condition, steps in rules:
+        if condition is not None:
+            if isinstance(condition, str):
+                if condition not in content:
+                    continue
+            elif condition.search(content) is None:
+                continue
+        for guard, pattern, replacement in steps:
+            if guard is not None and not any(needle in content for needle in guard):
+                continue
+            if isinstance(pattern, str):
+                content = content.replace(pattern, replacement)
+            else:
+                content = pattern.sub(replacement, content)
+    return content
+
+REGEX_MATH = re.compile(r"<math.*?</math>", re.DOTALL)
+# Whitespace after a tag up to the next one; group 2 is '/' when that one closes
+REGEX_MATHML_SPACE = re.compile(r'(<[^<>]*>)\s+(?=<(/?))')
+REGEX_MATHML_TAG = re.compile(r'<[^<>]+>')
+# An attribute value in single quotes, with any spaces around its '='
+REGEX_MATHML_ATTRIBUTE = re.compile(r"""\s*=\s*(?:'([^'"]*)'|("[^"]*"))""")
+REGEX_MATHML_NBSP = re.compile(r'&#(?:160|[xX]0*[aA]0);')
+# Remote image in converted markdown; group 1 is its URL
+REGEX_IMAGE_URL = re.compile(r'!\[[^\]]*\]\((https?://[^)\s]+)\)')
+REGEX_IMG_ALT = re.compile(IMG_ALT_REGEX)
+# REGEX_BASE64 matches wherever this prefix does, since its payload groups may be empty
+REGEX_BASE64_PREFIX = re.compile(r'data:image\/[A-Za-z]*;base64,')
+
+QUESTION_PRE_RULES = compile_rules([
+    (None, [('alt', REGEX_IMG_ALT, ''), (None, '$$', '$')]),
+])
+ANSWER_PRE_RULES = compile_rules([
+    (None, [('alt', REGEX_IMG_ALT, '')]),
+])
+# Applied to the whole content once MathML has been converted to LaTeX
+MATH_RULES = compile_rules([
+    (None, [
+        ('\\overline{)', re.compile(r"(\\overline{\)[\\ ]+})"), '\\_' * 9),
+        (None, '\\_', '_'),
+        (None, '\\mathrm{__}', '___'),
+        # replace('--', ' - - -') followed by replace('-', ' -') in one pass
+        ('-', re.compile(r'--|-'), lambda m: '  -  -  -' if len(m.group()) == 2 else ' -'),
+    ]),
+])
+BEFORE_HTML2TEXT_RULES = compile_rules([
+    (REGEX_BASE64_PREFIX, [(None, '\n', ''), (None, '\r', ''), (None, '&#10;', '')]),
+    (None, [
+        (None, url, ''),
+        (None, '../..', ''),
+        (None, '..', ''),
+        (('/assets', '/wirispluginengine'), REGEX_IMAGE, lambda m: url + m.group(0) if url not in m.group(0) else m.group(0)),
+    ]),
+])
+QUESTION_AFTER_RULES = compile_rules([
+    (None, [
+        (None, '\\\\', '\\'),
+        (None, '___', '\\_\\_\\_'),
+        (None, '\\___$', '\\_$'),
+        (None, '\\overline{ }', '\\_' * 9),
+        (None, '\\__', '\\_'),
+        # REGEX_GIF and REGEX_BMP in one pass
+        (('image/gif', 'image/bmp'), re.compile(r'image/(?:gif|bmp)'), 'image/png'),
+    ]),
+])
+ANSWER_AFTER_RULES = QUESTION_AFTER_RULES + compile_rules([
+    (None, [(None, '$$', '$')]),
+])
+
+@METRICS.timed('convert_question_content')
 def convert_question_content(content, q_id, flag):
-    content = re.sub(IMG_ALT_REGEX, lambda m: "".format(m.group(0)), content)
-    if flag:
-        content = content
-        content = content.replace('$$','$')
+    content = extract_inline_images(content)
+    content = rewrite(content, QUESTION_PRE_RULES if flag else ANSWER_PRE_RULES)
+    content = convert_content_math(content, q_id)
+    content = rewrite(content, BEFORE_HTML2TEXT_RULES)
+    content = to_markdown(content)
+    content = rewrite(content, QUESTION_AFTER_RULES if flag else ANSWER_AFTER_RULES)
+    return link_stored_images(content)
+
+# Replaces every inline base64 image with a marker for its stored copy.
+# Images that cannot be decoded stay inline
+def extract_inline_images(content):
+    if IMAGE_STORE is None or ';base64,' not in content:
+        return content
+    return REGEX_DATA_URI.sub(lambda m: INLINE_IMAGES(m.group()) or m.group(), content)
+
+# Turns the markers left by extract_inline_images into the paths of the stored
+# images, which ricecooker attaches to the exercise like any other image
+def link_stored_images(content):
+    if IMAGE_MARKER not in content:
+        return content
+    return REGEX_IMAGE_MARKER.sub(lambda m: IMAGE_STORE.path_of(m.group(1)), content)
 
+# Decodes one inline image and stores it, transcoding anything but PNG and
+# JPEG (GIF and BMP, whatever the data URI claims) to PNG. Returns its marker,
+# or '' to leave the image inline; '' is cached too, so a broken image is
+# only tried once
+@METRICS.timed('extract_image')
+def extract_image(data_uri):
+    data = decode_data_uri(data_uri)
+    if not data:
+        return ''
+    extension = image_format(data)
+    if extension is None:
+        data = transcode_to_png(data)
+        if data is None:
+            return ''
+        extension = 'png'
+    try:
+        return IMAGE_MARKER + IMAGE_STORE.put(data, extension)
+    except OSError as e:
+        print (e)
+        return None
+
+@METRICS.timed('markdown')
+def to_markdown(content):
+    return MARKDOWN.convert(content)
+
+# Replaces every <math> fragment in content with LaTeX. Fragments are matched
+# across lines. The original code did that by swapping newlines for "@@@@"
+# and back, which also rewrites "@" characters already in the text, so that
+# detour is only taken when the text contains an "@"
+def convert_content_math(content, q_id):
+    if '@' not in content:
+        if '<math' not in content or REGEX_MATH.search(content) is None:
+            return content
+        converted = rewrite(REGEX_MATH.sub(lambda x: mathml_to_latex(x, q_id), content), MATH_RULES)
+        if '@' not in converted:
+            return converted
     content = content.replace("\n", "@@@@")
-    # print ("Before html2text:", content+"\n\n")
-    if len(re.findall(r"<math.*?</math>", content)) > 0:
-        content = re.sub(r"<math.*?</math>", lambda x : mathml_to_latex(x, q_id), content)       
-        content = re.sub(r"(\\overline{\)[\\ ]+})", lambda m:"\_\_\_\_\_\_\_\_\_".format(m.group(0)), content)
-        content = content.replace('\_','_').replace('\\mathrm{__}','___').replace('--',' - - -').replace('-',' -')
-    
-    # print ("After convert mathml to latext:", content+"\n\n")
-
-    content = content.replace("@@@@", "\n")   
-    if len(re.findall(REGEX_BASE64, content))  > 0:
-        content = content.replace('\n','').replace('\r','').replace('&#10;', '')
-
-    content = content.replace(url,'').replace('../..','').replace("..",'')
-    content = re.sub(REGEX_IMAGE, lambda m: url+"{}".format(m.group(0)) if url not in m.group(0) else "{}".format(m.group(0)), content)
-    content = html2text.html2text(content)
-   
-    content = content.replace("\\\\","\\")
-    # print ("After html2text:", content + "\n\n")
-    content = re.sub(r"___", lambda m: ("\_\_\_") .format(m.group(0)), content)
-    content = content.replace('\\___$','\\_$').replace('\overline{ }','\_\_\_\_\_\_\_\_\_').replace('\\__','\\_').replace("\\_","\_")
-    content = re.sub(REGEX_GIF, lambda m: "image/png".format(m.group(0)), content) 
-    content = re.sub(REGEX_BMP, lambda m: "image/png".format(m.group(0)), content)
-    
-    if not flag:
-        content = content.replace('$$','$')
-    #else:
-    #    print ("content:",content + "Question ID::"+q_id)
-    return content
+    if REGEX_MATH.search(content) is not None:
+        content = REGEX_MATH.sub(lambda x: mathml_to_latex(x, q_id), content)
+        content = rewrite(content, MATH_RULES)
+    return content.replace("@@@@", "\n")
+
+
+_MMLTEX = threading.local()
 
+# Returns mmltex.xsl compiled for this thread; workers compile it once and reuse it
+def get_mmltex_transform():
+    transform = getattr(_MMLTEX, 'transform', None)
+    if transform is None:
+        transform = _MMLTEX.transform = etree.XSLT(etree.parse(MMLTEX_XSL))
+    return transform
+
+# Runs mmltex.xsl over a MathML fragment and returns the raw LaTeX, exactly as
+# xsltproc would print it. Falls back to an xsltproc subprocess reading from
+# stdin when lxml is not installed
+@METRICS.timed('transform_mathml')
+def transform_mathml(mathml):
+    if etree is None:
+        p = subprocess.Popen(["xsltproc", MMLTEX_XSL, "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output, err = p.communicate(mathml.encode("utf-8"))
+        return output.decode("utf-8")
+    try:
+        document = etree.fromstring(mathml.encode("utf-8"))
+    except etree.XMLSyntaxError:
+        # xsltproc prints nothing for a fragment it cannot parse
+        return ""
+    return str(get_mmltex_transform()(document))
 
+@METRICS.timed('mathml_to_latex')
 def mathml_to_latex(match, q_id):
-    regex = r"\\overline{\)(.*?)}"
     match = match.group().replace("&gt;",">").replace('@@@@','\n')
+    return MATHML_CACHE(normalize_mathml(match))
+
+# Rewrites a MathML fragment the way the XML parser reads it, so fragments
+# that only differ in layout share one MATHML_CACHE entry: whitespace between
+# tags is dropped, unless it is all an element holds as in <mtext> </mtext>,
+# attribute values are double quoted, and no-break spaces written as &#160;
+# or &#xA0; become the character. &nbsp; is left alone: it is not an XML
+# entity, so fragments holding it do not parse and convert to nothing
+def normalize_mathml(mathml):
+    def space(match):
+        tag = match.group(1)
+        if match.group(2) and not tag.startswith('</') and not tag.endswith('/>'):
+            return match.group(0)
+        return tag
+    mathml = REGEX_MATHML_SPACE.sub(space, mathml)
+    mathml = REGEX_MATHML_TAG.sub(lambda tag: REGEX_MATHML_ATTRIBUTE.sub(
+        lambda value: '="' + value.group(1) + '"' if value.group(1) is not None else '=' + value.group(2), tag.group(0)), mathml)
+    return REGEX_MATHML_NBSP.sub('\xa0', mathml)
+
+# Converts one MathML fragment to LaTeX; called through MATHML_CACHE
+def convert_mathml(match):
+    regex = r"\\overline{\)(.*?)}"
     # match = match.replace('&nbsp;',' ').replace('&#xA0;',' ')
     # print ("match:", match)
-    path = "/Users/Admin/Documents/magogenie-channel/q_files"
-    filename = os.path.join(path, q_id+".mml")
-    with open(filename,"w") as f:
-        f.write(match)
     try:
-        p = subprocess.Popen(["xsltproc", "mmltex.xsl", filename], stdout=subprocess.PIPE)
-        output, err = p.communicate() 
-        text = output.decode("utf-8")
+        text = transform_mathml(match)
         # print ("original converstion of mathml:", text +"\n")
         text = re.sub(REGEX_PHANTOM, lambda m:"$<br>$".format(m.group(0)), text)
         text = re.sub(r"\\hspace{.*?}", lambda m:" ".format(m.group(0)), text)
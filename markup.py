@@ -0,0 +1,378 @@
+import collections
+import html
+import re
+from textwrap import wrap
+
+import html2text
+from html2text import config as html2text_config
+from html2text.utils import escape_md, list_numbering_start, name2cp
+
+# html2text keeps &nbsp; as this placeholder until the text is joined, so the
+# space it stands for survives the collapsing of whitespace
+NBSP_PLACEHOLDER = '&nbsp_place_holder;'
+# Named and numeric entities html2text prints as plain ASCII. html2text drops
+# nbsp from the numeric ones once its first converter is built
+UNIFIABLE = dict(html2text_config.UNIFIABLE, nbsp=NBSP_PLACEHOLDER)
+UNIFIABLE_N = dict((name2cp(name), value) for name, value in html2text_config.UNIFIABLE.items() if name != 'nbsp')
+
+# Tags converted directly. The others on this list print nothing, but still
+# end a list or start a pending link the way html2text does. Content with any
+# other tag goes through html2text
+INERT_TAGS = frozenset(['span', 'sup', 'sub', 'font', 'small', 'big', 'center', 'tbody', 'thead', 'tfoot', 'html', 'body'])
+SUPPORTED_TAGS = INERT_TAGS | frozenset(['p', 'div', 'br', 'b', 'strong', 'i', 'em', 'u', 'a', 'img', 'ul', 'ol', 'li',
+                                         'table', 'tr', 'td', 'th'])
+
+# A start or end tag with quoted attributes, a numeric entity or a named
+# entity. Markup outside this grammar (comments, bare attribute values, stray
+# "<" or "&") leaves a "<" or "&" in the text between tokens
+REGEX_TOKEN = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:\s+[a-zA-Z_:][-.:a-zA-Z0-9_]*(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'))?)*)\s*(/?)>'
+                         r'|&#([0-9]+|[xX][0-9a-fA-F]+);|&([a-zA-Z][a-zA-Z0-9]*);')
+REGEX_ATTRIBUTE = re.compile(r'([a-zA-Z_:][-.:a-zA-Z0-9_]*)(?:\s*=\s*("[^"]*"|\'[^\']*\'))?')
+REGEX_WHITESPACE = re.compile(r'\s+')
+REGEX_ABSOLUTE_URL = re.compile(r'^[a-zA-Z+]+://')
+# Characters textwrap rewrites before wrapping a line
+TEXTWRAP_REPLACED = re.compile(r'[\t\n\x0b\x0c\r]')
+
+
+class UnsupportedMarkup(Exception):
+    """ Raised for content the direct conversion does not handle """
+
+
+class _Writer(object):
+    """ Output state of one conversion; mirrors the fields of html2text.HTML2Text it uses """
+    __slots__ = ('out', 'p_p', 'start', 'space', 'last_was_nl', 'br_toggle', 'last_was_list', 'lists', 'astack',
+                 'maybe_automatic_link', 'empty_link', 'split_next_td', 'td_count', 'table_start')
+
+    def __init__(self):
+        self.out = []
+        self.p_p = 0
+        self.start = 1
+        self.space = 0
+        self.last_was_nl = False
+        self.br_toggle = ''
+        self.last_was_list = False
+        self.lists = []
+        self.astack = []
+        self.maybe_automatic_link = None
+        self.empty_link = False
+        self.split_next_td = False
+        self.td_count = 0
+        self.table_start = False
+
+    def write(self, s):
+        self.out.append(s)
+        if s:
+            self.last_was_nl = s[-1] == '\n'
+
+    def pbr(self):
+        if self.p_p == 0:
+            self.p_p = 1
+
+    def p(self):
+        self.p_p = 2
+
+    def soft_br(self):
+        self.pbr()
+        self.br_toggle = '  '
+
+    def o(self, data, puredata=False, force=None):
+        if puredata:
+            data = REGEX_WHITESPACE.sub(' ', data)
+            if data and data[0] == ' ':
+                self.space = 1
+                data = data[1:]
+        if not data and not force:
+            return
+        if self.start:
+            self.space = 0
+            self.p_p = 0
+            self.start = 0
+        if force == 'end':
+            self.p_p = 0
+            self.write('\n')
+            self.space = 0
+        if self.p_p:
+            self.write((self.br_toggle + '\n') * self.p_p)
+            self.space = 0
+            self.br_toggle = ''
+        if self.space:
+            if not self.last_was_nl:
+                self.write(' ')
+            self.space = 0
+        self.p_p = 0
+        self.write(data)
+
+    def handle_data(self, data, entity_char=False):
+        if self.maybe_automatic_link is not None:
+            href = self.maybe_automatic_link
+            if href == data and REGEX_ABSOLUTE_URL.match(href):
+                self.o('<' + data + '>')
+                self.empty_link = False
+                return
+            self.o('[')
+            self.maybe_automatic_link = None
+            self.empty_link = False
+        if not entity_char:
+            data = escape_section(data)
+        self.o(data, True)
+
+    def handle_tag(self, tag, attrs, start):
+        if start and self.maybe_automatic_link is not None and tag not in ('p', 'div', 'img'):
+            self.o('[')
+            self.maybe_automatic_link = None
+            self.empty_link = False
+        if tag in ('p', 'div'):
+            self.p()
+        elif tag == 'br':
+            if start:
+                self.o('  \n')
+        elif tag in ('i', 'em', 'u'):
+            self.o('_')
+        elif tag in ('b', 'strong'):
+            self.o('**')
+        elif tag == 'a':
+            self.handle_link(attrs, start)
+        elif tag == 'img':
+            if start and 'src' in attrs:
+                if self.maybe_automatic_link is not None:
+                    self.o('[')
+                    self.maybe_automatic_link = None
+                    self.empty_link = False
+                self.o('![' + escape_md(attrs.get('alt') or '') + ']')
+                self.o('(' + escape_md(attrs['src'] or '') + ')')
+        if tag in ('ol', 'ul'):
+            if not self.lists and not self.last_was_list:
+                self.p()
+            if start:
+                self.lists.append({'name': tag, 'num': list_numbering_start(attrs)})
+            elif self.lists:
+                self.lists.pop()
+                if not self.lists:
+                    self.o('\n')
+            self.last_was_list = True
+        else:
+            self.last_was_list = False
+        if tag == 'li':
+            self.pbr()
+            if start:
+                item = self.lists[-1] if self.lists else {'name': 'ul', 'num': 0}
+                self.o('  ' * len(self.lists))
+                if item['name'] == 'ul':
+                    self.o('* ')
+                else:
+                    item['num'] += 1
+                    self.o(str(item['num']) + '. ')
+                self.start = 1
+        elif tag in ('table', 'tr', 'td', 'th'):
+            self.handle_table(tag, start)
+
+    def handle_link(self, attrs, start):
+        if start:
+            href = attrs.get('href')
+            if href is not None and not href.startswith('#'):
+                self.astack.append(attrs)
+                self.maybe_automatic_link = href
+                self.empty_link = True
+            else:
+                self.astack.append(None)
+        elif self.astack:
+            link = self.astack.pop()
+            if self.maybe_automatic_link and not self.empty_link:
+                self.maybe_automatic_link = None
+            elif link:
+                if self.empty_link:
+                    self.o('[')
+                    self.empty_link = False
+                    self.maybe_automatic_link = None
+                if 'title' in link:
+                    self.o('](' + escape_md(link['href']) + ' "' + escape_md(link['title']) + '" )')
+                else:
+                    self.o('](' + escape_md(link['href']) + ')')
+
+    def handle_table(self, tag, start):
+        if tag == 'table':
+            if start:
+                self.table_start = True
+        elif tag == 'tr':
+            if start:
+                self.td_count = 0
+            else:
+                self.split_next_td = False
+                self.soft_br()
+                if self.table_start:
+                    # Underline the first row as the header
+                    self.o('|'.join(['---'] * self.td_count))
+                    self.soft_br()
+                    self.table_start = False
+        elif start:
+            if self.split_next_td:
+                self.o('| ')
+            self.split_next_td = True
+            self.td_count += 1
+
+    def close(self):
+        self.pbr()
+        self.o('', force='end')
+        text = ''.join(self.out)
+        if NBSP_PLACEHOLDER in text:
+            text = text.replace(NBSP_PLACEHOLDER, ' ')
+        return text
+
+
+# html2text.utils.escape_md_section, skipping the expressions whose
+# character is not in text
+def escape_section(text):
+    if '\\' in text:
+        text = html2text_config.RE_MD_BACKSLASH_MATCHER.sub(r'\\\1', text)
+    if '.' in text:
+        text = html2text_config.RE_MD_DOT_MATCHER.sub(r'\1\\\2', text)
+    if '+' in text:
+        text = html2text_config.RE_MD_PLUS_MATCHER.sub(r'\1\\\2', text)
+    if '-' in text:
+        text = html2text_config.RE_MD_DASH_MATCHER.sub(r'\1\\\2', text)
+    return text
+
+
+def charref(name):
+    code = int(name[1:], 16) if name[0] in 'xX' else int(name)
+    if code in UNIFIABLE_N:
+        return UNIFIABLE_N[code]
+    try:
+        return chr(code)
+    except (ValueError, OverflowError):
+        return ''
+
+
+def entityref(name):
+    if name in UNIFIABLE:
+        return UNIFIABLE[name]
+    try:
+        return chr(name2cp(name))
+    except KeyError:
+        return '&' + name + ';'
+
+
+def parse_attributes(text):
+    attrs = {}
+    for name, value in REGEX_ATTRIBUTE.findall(text):
+        if value:
+            value = html.unescape(value[1:-1])
+        else:
+            value = None
+        attrs[name.lower()] = value
+    return attrs
+
+
+# html2text.utils.skipwrap with links wrapped, as html2text is configured
+def skipwrap(para):
+    if para[0:4] == '    ' or para[0] == '\t':
+        return True
+    stripped = para.lstrip()
+    if stripped[0:2] == '--' and len(stripped) > 2 and stripped[2] != '-':
+        return False
+    if stripped[0:1] == '-' or stripped[0:1] == '*':
+        return True
+    return bool(html2text_config.RE_ORDERED_LIST_MATCHER.match(stripped) or
+                html2text_config.RE_UNORDERED_LIST_MATCHER.match(stripped))
+
+
+# textwrap.wrap as html2text calls it. A line that already fits comes back as
+# it is, less its trailing spaces, without building a TextWrapper
+def wrap_paragraph(para, width):
+    line = para.rstrip(' ')
+    if line and len(line) <= width and not line[-1].isspace() and TEXTWRAP_REPLACED.search(line) is None:
+        return line
+    return '\n'.join(wrap(para, width, break_long_words=False))
+
+
+# html2text.HTML2Text.optwrap
+def optwrap(text, width):
+    result = []
+    newlines = 0
+    for para in text.split('\n'):
+        if para:
+            if not skipwrap(para):
+                result.append(wrap_paragraph(para, width))
+                if para.endswith('  '):
+                    result.append('  \n')
+                    newlines = 1
+                else:
+                    result.append('\n\n')
+                    newlines = 2
+            elif not html2text_config.RE_SPACE.match(para):
+                result.append(para + '\n')
+                newlines = 1
+        elif newlines < 2:
+            result.append('\n')
+            newlines += 1
+    return ''.join(result)
+
+
+class QuestionMarkdown(object):
+    """ Converts question HTML to the Markdown html2text prints for it
+
+        Magogenie questions use a handful of tags: paragraphs, line breaks,
+        emphasis, images, links, lists and simple tables. Content made of
+        those alone is tokenized with one regular expression and written the
+        way html2text writes it, escaping included, without setting up an
+        HTML parser and a converter for every string. Anything else (another
+        tag, a comment, a stray "<" or "&") is handed to html2text, so the
+        output is the same either way. One instance serves every call;
+        counters records how often each path was taken.
+
+        Args:
+            body_width (int): column lines are wrapped at, as in html2text
+    """
+    def __init__(self, body_width=html2text_config.BODY_WIDTH):
+        self.body_width = body_width
+        self.counters = collections.Counter()
+
+    def convert(self, content):
+        try:
+            text = self.convert_direct(content)
+        except UnsupportedMarkup:
+            self.counters['fallback'] += 1
+            return html2text.html2text(content, bodywidth=self.body_width)
+        self.counters['direct'] += 1
+        return text
+
+    def convert_direct(self, content):
+        """ Converts content without html2text; raises UnsupportedMarkup for markup outside the supported subset """
+        writer = _Writer()
+        position = 0
+        for match in REGEX_TOKEN.finditer(content):
+            if match.start() > position:
+                self.text(writer, content[position:match.start()])
+            position = match.end()
+            closing, tag, attributes, self_closing, number, name = match.groups()
+            if tag is not None:
+                tag = tag.lower()
+                if tag not in SUPPORTED_TAGS or (closing and self_closing):
+                    raise UnsupportedMarkup(tag)
+                if closing:
+                    writer.handle_tag(tag, {}, False)
+                else:
+                    writer.handle_tag(tag, parse_attributes(attributes) if attributes else {}, True)
+                    if self_closing:
+                        writer.handle_tag(tag, {}, False)
+            elif number is not None:
+                writer.handle_data(html.escape(charref(number), quote=False), True)
+            else:
+                value = entityref(name)
+                if value != NBSP_PLACEHOLDER:
+                    value = html.escape(value, quote=False)
+                writer.handle_data(value, True)
+        if position < len(content):
+            self.text(writer, content[position:])
+        return optwrap(writer.close(), self.body_width)
+
+    def text(self, writer, data):
+        if '<' in data or '&' in data:
+            raise UnsupportedMarkup(data)
+        writer.handle_data(data)
+
+    def take_counters(self):
+        """ Returns the counters collected since the last call and resets them """
+        counters = self.counters
+        self.counters = collections.Counter()
+        return counters
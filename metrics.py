@@ -0,0 +1,126 @@
+import collections
+import functools
+import math
+import threading
+from time import perf_counter
+
+
+class Metrics(object):
+    """ Call counts, latencies and bytes per stage of a crawl
+
+        Latencies are kept in histogram buckets a quarter of a doubling wide,
+        so percentiles cost a counter increment per call and snapshots taken
+        in pool workers merge by adding buckets up. A call nested in a call
+        to the same stage, like _build_tree recursing, is only timed by the
+        outermost call. Subtotals are free-form sums kept per group, such as
+        per board and standard. A listener, when set, is called with the
+        stage and seconds of every call recorded.
+    """
+    # Buckets per doubling of latency
+    RESOLUTION = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stages = {}
+        self.subtotals = {}
+        self.listener = None
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.subtotals = {}
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'max': 0.0, 'bytes': 0, 'buckets': {}}
+        return stage
+
+    def record(self, name, seconds, nbytes=0):
+        bucket = math.floor(math.log2(seconds * 1e6 + 0.1) * self.RESOLUTION)
+        with self._lock:
+            stage = self._stage(name)
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            if seconds > stage['max']:
+                stage['max'] = seconds
+            stage['bytes'] += nbytes
+            buckets = stage['buckets']
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        if self.listener is not None:
+            self.listener(name, seconds)
+
+    def timed(self, name):
+        """ Decorator recording every call of the function under stage `name` """
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                active = self._local.__dict__.setdefault('active', set())
+                if name in active:
+                    return function(*args, **kwargs)
+                active.add(name)
+                start = perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    active.discard(name)
+                    self.record(name, perf_counter() - start)
+            return wrapper
+        return decorate
+
+    def add_subtotal(self, group, **values):
+        with self._lock:
+            self.subtotals.setdefault(group, collections.Counter()).update(values)
+
+    def take(self):
+        """ Returns everything recorded so far as a picklable snapshot and starts over """
+        with self._lock:
+            snapshot = {'stages': self.stages, 'subtotals': self.subtotals}
+            self.stages = {}
+            self.subtotals = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """ Adds a snapshot taken with take(), usually in a pool worker """
+        if not snapshot:
+            return
+        with self._lock:
+            for name, other in snapshot['stages'].items():
+                stage = self._stage(name)
+                stage['calls'] += other['calls']
+                stage['seconds'] += other['seconds']
+                stage['max'] = max(stage['max'], other['max'])
+                stage['bytes'] += other['bytes']
+                for bucket, count in other['buckets'].items():
+                    stage['buckets'][bucket] = stage['buckets'].get(bucket, 0) + count
+            for group, values in snapshot['subtotals'].items():
+                self.subtotals.setdefault(group, collections.Counter()).update(values)
+
+    def _percentile(self, stage, fraction):
+        # Upper edge of the bucket holding the requested call, capped at the slowest call
+        rank = fraction * stage['calls']
+        seen = 0
+        for bucket in sorted(stage['buckets']):
+            seen += stage['buckets'][bucket]
+            if seen >= rank:
+                return min(stage['max'], 2 ** ((bucket + 1) / self.RESOLUTION) / 1e6)
+        return stage['max']
+
+    def report(self):
+        """ Returns the stages and subtotals as a JSON-ready dict """
+        stages = {}
+        with self._lock:
+            for name, stage in sorted(self.stages.items()):
+                stages[name] = {
+                    'calls': stage['calls'],
+                    'total_seconds': stage['seconds'],
+                    'mean_seconds': stage['seconds'] / stage['calls'] if stage['calls'] else 0.0,
+                    'p50_seconds': self._percentile(stage, 0.5),
+                    'p90_seconds': self._percentile(stage, 0.9),
+                    'p99_seconds': self._percentile(stage, 0.99),
+                    'max_seconds': stage['max'],
+                    'bytes': stage['bytes'],
+                }
+            subtotals = dict((group, dict(values)) for group, values in sorted(self.subtotals.items()))
+        return {'stages': stages, 'subtotals': subtotals}
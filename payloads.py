@@ -0,0 +1,98 @@
+import collections
+import json
+
+from records import Question
+
+
+# The parts of a QUESTION_URL entry its conversion reads, as one string that
+# is the same for every question with the same content. Ids and the
+# difficulty level are left out: they do not change the converted text
+def question_payload(value):
+    question = value['question']
+    answers = [[answer['content'], bool(answer['is_correct'])] for answer in value['possible_answers']]
+    return json.dumps([question['content'], question['answer_type'], question['unit'], answers], ensure_ascii=False)
+
+
+def _frozen(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _thawed(value):
+    return list(value) if isinstance(value, tuple) else value
+
+
+# The converted text and answers of a question, with lists as tuples so the
+# parts can be hashed and shared without being changed in place
+def question_parts(question):
+    return (question.question, question.type, _frozen(question.all_answers), question.answer_key, _frozen(question.answer),
+            _frozen(question._hints))
+
+
+# A Question with the given id and difficulty level and converted parts
+def build_question(question_id, parts, difficulty_level):
+    text, question_type, all_answers, answer_key, answer, hints = parts
+    question = Question(question_id, text, question_type, _thawed(all_answers), answer_key, _thawed(answer),
+                        difficulty_level=difficulty_level)
+    question._hints = _thawed(hints)
+    return question
+
+
+class PayloadTable(object):
+    """ One copy of every distinct converted question of a crawl
+
+        The same question text, answers and MathML often come back under
+        different ids in several topics and levels. The table keeps the
+        converted parts of every raw payload converted so far by its digest,
+        so a question repeating one is built from them instead of being
+        converted again, and share() points every question at the first
+        copy of its converted strings, so a repeated payload is held once
+        however many topics use it. Lists stay per question, as ricecooker
+        extends the answer lists it is given.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._by_digest = {}
+        self._by_parts = {}
+        # Digest of every question sent off to be converted, by question id
+        self._pending = {}
+        self.counters = collections.Counter()
+
+    def converted(self, digest):
+        """ Parts of the question converted earlier from the payload with this digest, or None """
+        return self._by_digest.get(digest)
+
+    def expect(self, question_id, digest):
+        """ Notes the payload digest of a question sent off to be converted """
+        self._pending[str(question_id)] = digest
+
+    def record(self, question_ids, questions):
+        """ Remembers the questions converted for question_ids under the digests expect() noted """
+        for question in questions or []:
+            digest = self._pending.get(str(question['id']))
+            if digest is not None and digest not in self._by_digest:
+                self._by_digest[digest] = question_parts(question)
+        for question_id in question_ids:
+            self._pending.pop(str(question_id), None)
+
+    def share(self, question):
+        """ Points question at the strings of the first question converted to the same parts """
+        parts = question_parts(question)
+        first = self._by_parts.setdefault(parts, parts)
+        if first is parts:
+            self.counters['distinct'] += 1
+            return question
+        self.counters['repeated'] += 1
+        question.question = first[0]
+        question.all_answers = _thawed(first[2])
+        question.answer = _thawed(first[4])
+        question._hints = _thawed(first[5])
+        return question
+
+    def report(self):
+        """ {questions, distinct, repeated, ratio}, ratio being the share of questions that repeat an earlier one """
+        distinct, repeated = self.counters['distinct'], self.counters['repeated']
+        questions = distinct + repeated
+        return {'questions': questions, 'distinct': distinct, 'repeated': repeated,
+                'ratio': float(repeated) / questions if questions else 0.0}
@@ -0,0 +1,125 @@
+#############################################################################
+#   python plan.py [--boards BalBharati,CBSE] [--standards 3,4|all]         #
+#                  [--offline]                                              #
+#                                                                           #
+#   Reports what a crawl over a selection of boards and standards would     #
+#   do before starting one: topics, question ids, QUESTION_URL batches      #
+#   and how many questions the response cache already holds, per board,     #
+#   standard and subject. Only the TREE_URL document is read, from the      #
+#   response cache while it is fresh; ricecooker, html2text and the rest    #
+#   of the chef are not imported, so a plan takes a second or two.          #
+#############################################################################
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+import settings
+from config import *
+from cache import ResponseCache
+from batching import BatchPlanner
+from treedoc import load_tree
+
+
+# Comma separated ids; "all" selects everything
+def parse_selection(value, default):
+    if value is None:
+        return default
+    return None if value.lower() == 'all' else [item.strip() for item in value.split(',') if item.strip()]
+
+
+# Standards are numbers kept as strings; order them numerically
+def standard_sort_key(standard):
+    return (0, int(standard), standard) if standard.isdigit() else (1, 0, standard)
+
+
+# Question ids of the selected subjects as {(board, standard, subject): [(topic id, ids), ...]}
+def select_topics(tree, boards, standards):
+    selected = collections.OrderedDict()
+    for board_id in (boards if boards is not None else sorted(tree['boards'])[::-1]):
+        if board_id not in tree['boards']:
+            print ("Board " + board_id + " is not in the tree")
+            continue
+        board = tree['boards'][board_id]
+        for standard_id in (standards if standards is not None else sorted(board['standards'], key=standard_sort_key)):
+            if standard_id not in board['standards']:
+                print (board_id + " has no standard " + standard_id)
+                continue
+            for subject_id, subject in board['standards'][standard_id]['subjects'].items():
+                selected[(board_id, standard_id, subject_id)] = [(str(topic['id']), [str(i) for i in topic['question_ids']])
+                                                                for topic in subject['topics'].values()]
+    return selected
+
+
+# 'fresh', 'stale' or 'missing' for every question id in the response cache.
+# Only the time each entry was stored is read, and entries are not marked as
+# used, so a plan leaves the order eviction goes by as it was
+def cache_coverage(cache, question_ids):
+    coverage = {}
+    now = time.time()
+    for question_id in question_ids:
+        stored = cache.stored('question:' + question_id)
+        coverage[question_id] = 'missing' if stored is None else 'fresh' if now - stored < cache.ttl else 'stale'
+    return coverage
+
+
+# Number of QUESTION_URL requests the planner's current batch size makes of question_ids
+def count_batches(planner, question_ids):
+    pending = collections.deque(question_ids)
+    batches = 0
+    while pending:
+        planner.next_batch(pending)
+        batches += 1
+    return batches
+
+
+def plan(boards, standards, offline=False):
+    """ Prints the plan of a crawl over boards and standards and returns its totals """
+    cache = ResponseCache(CACHE_DIR, CACHE_TTL, CACHE_MAX_BYTES)
+    planner = BatchPlanner(settings.QUESTION_URL, QUESTION_BATCH_SIZE, BATCH_MIN_SIZE, BATCH_MAX_SIZE, BATCH_TARGET_SECONDS,
+                           BATCH_TARGET_BYTES, MAX_URL_LENGTH, os.path.join(STATE_DIR, 'batch_planner.json'))
+    selected = select_topics(load_tree(cache, settings.TREE_URL, offline, TREE_READ_SIZE), boards, standards)
+    unique_ids = list(collections.OrderedDict.fromkeys(i for topics in selected.values() for topic_id, ids in topics for i in ids))
+    coverage = cache_coverage(cache, unique_ids)
+
+    row = "{0:32} {1:>7} {2:>10} {3:>8} {4:>8} {5:>8} {6:>8}"
+    print (row.format('board/standard/subject', 'topics', 'questions', 'fresh', 'stale', 'missing', 'batches'))
+    for key, topics in selected.items():
+        ids = list(collections.OrderedDict.fromkeys(i for topic_id, topic_ids in topics for i in topic_ids))
+        counts = collections.Counter(coverage[i] for i in ids)
+        to_fetch = [i for i in ids if coverage[i] != 'fresh']
+        print (row.format('/'.join(key), len(topics), len(ids), counts['fresh'], counts['stale'], counts['missing'],
+                          count_batches(planner, to_fetch)))
+
+    counts = collections.Counter(coverage.values())
+    to_fetch = [i for i in unique_ids if coverage[i] != 'fresh']
+    totals = {'topics': sum(len(topics) for topics in selected.values()), 'questions': len(unique_ids),
+              'fresh': counts['fresh'], 'stale': counts['stale'], 'missing': counts['missing'],
+              'batches': count_batches(planner, to_fetch)}
+    print (row.format('total', totals['topics'], totals['questions'], totals['fresh'], totals['stale'], totals['missing'], totals['batches']))
+
+    state = planner.load_state()
+    print ("Batch size {0}{1}; stale questions are revalidated, missing ones fetched".format(
+        planner.size, " (settled by the last crawl)" if state else ""))
+    if state.get('seconds_per_id') and to_fetch:
+        concurrency = ASYNC_CONCURRENCY if FETCH_ENGINE == 'asyncio' else POOL_SIZE
+        print ("Last crawl measured {0:.3f} s and {1:.0f} bytes per question: about {2:.1f} s of requests at "
+               "concurrency {3} ({4} engine) and {5:.1f} MB".format(
+                   state['seconds_per_id'], state.get('bytes_per_id') or 0, len(to_fetch) * state['seconds_per_id'] / concurrency,
+                   concurrency, FETCH_ENGINE, len(to_fetch) * (state.get('bytes_per_id') or 0) / 1e6))
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plan a magogenie crawl without running it")
+    parser.add_argument('--boards', help="comma separated board ids, or all (default: BOARDS)")
+    parser.add_argument('--standards', help="comma separated standards, or all (default: STANDARDS)")
+    parser.add_argument('--offline', action='store_true', help="use the cached tree document, however old")
+    args = parser.parse_args()
+    try:
+        plan(parse_selection(args.boards, BOARDS), parse_selection(args.standards, STANDARDS), args.offline)
+    except (LookupError, OSError) as e:
+        print (e)
+        sys.exit(1)
@@ -0,0 +1,178 @@
+import collections
+import cProfile
+import hashlib
+import heapq
+import itertools
+import json
+import marshal
+import os
+from time import perf_counter
+
+
+# Characters of a MathML fragment kept in the report
+FRAGMENT_PREVIEW = 300
+
+
+class _Slowest(object):
+    """ The `size` slowest items seen, kept in a min-heap """
+    def __init__(self, size):
+        self.size = size
+        self.heap = []
+        self._order = itertools.count()
+
+    def threshold(self):
+        """ Seconds an item must exceed to be kept; 0 while the heap is not full """
+        return self.heap[0][0] if len(self.heap) >= self.size else 0.0
+
+    def push(self, seconds, item):
+        if self.size <= 0:
+            return
+        entry = (seconds, next(self._order), item)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, entry)
+        elif seconds > self.heap[0][0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def ranked(self):
+        return [item for seconds, order, item in sorted(self.heap, key=lambda entry: -entry[0])]
+
+
+class QuestionProfiler(object):
+    """ Times every converted question and MathML fragment (opt-in)
+
+        While enabled, question() converts a question through a callable
+        and keeps the `top` slowest questions with their size, the number of
+        inline images and MathML fragments in them and the seconds spent in
+        every timed stage (see observe). fragment() does the same for every
+        MathML fragment, splitting the XSLT transform from the regex clean
+        up. The `dumps` slowest questions are also run under cProfile and
+        their stats kept for report(). Pool workers send take() back to the
+        crawl process, which merge()s it. When disabled every call goes
+        straight to the conversion.
+
+        Args:
+            top (int): slowest questions and fragments kept
+            dumps (int): slowest questions whose cProfile stats are kept
+    """
+    def __init__(self, top=20, dumps=0):
+        self.top = top
+        self.dumps = dumps
+        self.enabled = False
+        self.reset()
+
+    def reset(self, enabled=None):
+        if enabled is not None:
+            self.enabled = enabled
+        self.questions = _Slowest(self.top)
+        self.fragments = _Slowest(self.top)
+        self.profiles = _Slowest(self.dumps)
+        self.totals = collections.Counter()
+        # Seconds per stage so far; a question's share is the change over its conversion
+        self._stages = collections.Counter()
+        self._question_id = None
+        self._profiling = False
+
+    def observe(self, stage, seconds):
+        """ Metrics listener: adds the seconds of a timed stage to the item being converted """
+        if self.enabled:
+            self._stages[stage] += seconds
+
+    def question(self, question_id, payload, convert):
+        """ convert(payload), timed as the question question_id """
+        if not self.enabled:
+            return convert(payload)
+        before = dict(self._stages)
+        self._question_id = question_id
+        profile = None
+        if self.dumps > 0 and not self._profiling:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                self._profiling = True
+            except ValueError:
+                # Another profiler is running, such as python -m cProfile
+                profile = None
+        start = perf_counter()
+        try:
+            return convert(payload)
+        finally:
+            seconds = perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            self._question_id = None
+            self.totals['questions'] += 1
+            self.totals['question_seconds'] += seconds
+            if seconds > self.questions.threshold():
+                stages = dict((stage, total - before.get(stage, 0.0)) for stage, total in self._stages.items()
+                              if total > before.get(stage, 0.0))
+                self.questions.push(seconds, {'id': question_id, 'seconds': seconds, 'bytes': len(payload),
+                                              'images': payload.count(';base64,'), 'mathml': payload.count('<math'),
+                                              'stages': stages})
+            if profile is not None and seconds > self.profiles.threshold():
+                profile.create_stats()
+                self.profiles.push(seconds, {'id': question_id, 'seconds': seconds, 'stats': profile.stats})
+
+    def fragment(self, mathml, convert):
+        """ convert(mathml), timed as one MathML fragment of the current question """
+        if not self.enabled:
+            return convert(mathml)
+        transformed = self._stages['transform_mathml']
+        start = perf_counter()
+        try:
+            return convert(mathml)
+        finally:
+            seconds = perf_counter() - start
+            transform = self._stages['transform_mathml'] - transformed
+            self.totals['fragments'] += 1
+            self.totals['fragment_seconds'] += seconds
+            if seconds > self.fragments.threshold():
+                self.fragments.push(seconds, {'question': self._question_id, 'seconds': seconds,
+                                              'transform_seconds': transform, 'regex_seconds': max(0.0, seconds - transform),
+                                              'bytes': len(mathml), 'sha1': hashlib.sha1(mathml.encode('utf-8')).hexdigest(),
+                                              'mathml': mathml[:FRAGMENT_PREVIEW]})
+
+    def take(self):
+        """ Returns what was recorded so far as a picklable snapshot and starts over, or None when disabled """
+        if not self.enabled:
+            return None
+        snapshot = {'questions': self.questions.ranked(), 'fragments': self.fragments.ranked(),
+                    'profiles': self.profiles.ranked(), 'totals': dict(self.totals)}
+        self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        """ Adds a snapshot taken with take(), usually in a pool worker """
+        if not snapshot:
+            return
+        for item in snapshot['questions']:
+            self.questions.push(item['seconds'], item)
+        for item in snapshot['fragments']:
+            self.fragments.push(item['seconds'], item)
+        for item in snapshot['profiles']:
+            self.profiles.push(item['seconds'], item)
+        self.totals.update(snapshot['totals'])
+
+    def report(self, directory):
+        """ Writes the ranked report, profile.json, and the cProfile dump of
+            every profiled question into directory. Returns the report """
+        os.makedirs(directory, exist_ok=True)
+        question_seconds = self.totals['question_seconds'] or 1.0
+        questions = self.questions.ranked()
+        for rank, item in enumerate(questions, 1):
+            item['rank'] = rank
+            item['share'] = item['seconds'] / question_seconds
+        dumps = {}
+        for item in self.profiles.ranked():
+            path = os.path.join(directory, 'question-{0}.prof'.format(item['id']))
+            # The format Profile.dump_stats writes, readable by pstats and snakeviz
+            with open(path, 'wb') as f:
+                marshal.dump(item['stats'], f)
+            dumps[item['id']] = path
+        for item in questions:
+            if item['id'] in dumps:
+                item['profile'] = dumps[item['id']]
+        report = {'totals': dict(self.totals), 'questions': questions, 'fragments': self.fragments.ranked()}
+        with open(os.path.join(directory, 'profile.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return report
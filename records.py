@@ -0,0 +1,186 @@
+import sys
+
+from le_utils.constants import licenses, exercises
+
+DESCRIPTION = "v0.1"
+COPYRIGHT_HOLDER = 'GreyKite Technologies Pvt. Ltd.'
+# Strings up to this length are interned: ids, titles and short answers such
+# as "5" or "Yes" repeat across thousands of questions
+INTERN_MAX_LENGTH = 64
+
+
+def intern_short(value):
+    if isinstance(value, str) and len(value) <= INTERN_MAX_LENGTH:
+        return sys.intern(value)
+    if isinstance(value, list) and value and isinstance(value[0], str):
+        return [intern_short(item) for item in value]
+    return value
+
+
+class Record(object):
+    """ Base of the compact records of a crawl
+
+        A record keeps its own values in __slots__ and its constant fields,
+        the same for every record of its kind, on the class. It reads and
+        writes like the dict it replaces, so code written against the dicts
+        keeps working, and pickles as a plain tuple of its values, which
+        keeps the results sent back by pool workers small.
+    """
+    __slots__ = ()
+    # Slot of every key that varies per record, in dict order
+    FIELDS = ()
+    # Key and value of every field shared by all records of the class
+    CONSTANTS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._slot_of = dict(cls.FIELDS)
+        cls._constants = dict(cls.CONSTANTS)
+        cls._keys = [key for key, name in cls.FIELDS] + [key for key, value in cls.CONSTANTS]
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, intern_short(value))
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        for key, name in cls.FIELDS:
+            setattr(record, name, intern_short(data.get(key)))
+        return record
+
+    def __reduce__(self):
+        return (self.__class__, tuple(getattr(self, name) for name in self.__slots__))
+
+    def keys(self):
+        return list(self._keys)
+
+    def __getitem__(self, key):
+        name = self._slot_of.get(key)
+        if name is not None:
+            return getattr(self, name)
+        return self._constants[key]
+
+    def __setitem__(self, key, value):
+        setattr(self, self._slot_of[key], value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def setdefault(self, key, default=None):
+        return self[key]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def __eq__(self, other):
+        return hasattr(other, 'keys') and dict(self.items()) == dict((key, other[key]) for key in other.keys())
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, dict(self.items()))
+
+    def to_dict(self):
+        """ The record as the plain dict it replaces, for JSON """
+        return dict((key, as_plain(value)) for key, value in self.items())
+
+
+class Question(Record):
+    """ A converted question
+
+        The correct answer is kept under the key its question type uses
+        (correct_answer, correct_answers or answers). Hints are the correct
+        answer unless set otherwise, so they are not stored a second time.
+    """
+    __slots__ = ('id', 'question', 'type', 'all_answers', 'answer_key', 'answer', '_hints', 'difficulty_level')
+
+    def __init__(self, id, question, type, all_answers, answer_key, answer, hints=None, difficulty_level=None):
+        Record.__init__(self, id, question, type, all_answers, answer_key, answer, None, difficulty_level)
+        if hints is not None:
+            self['hints'] = hints
+
+    @classmethod
+    def from_dict(cls, data):
+        answer_key = next(key for key in ('correct_answer', 'correct_answers', 'answers') if key in data)
+        return cls(data['id'], data['question'], data['type'], data.get('all_answers'), answer_key, data[answer_key],
+                   data.get('hints'), data.get('difficulty_level'))
+
+    def keys(self):
+        keys = ['id', 'question', 'type']
+        if self.all_answers is not None:
+            keys.append('all_answers')
+        keys.extend((self.answer_key, 'hints', 'difficulty_level'))
+        return keys
+
+    def __getitem__(self, key):
+        if key == 'hints':
+            return self.answer if self._hints is None else self._hints
+        if key == self.answer_key:
+            return self.answer
+        if key in ('id', 'question', 'type', 'difficulty_level') or (key == 'all_answers' and self.all_answers is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'hints':
+            self._hints = None if value == self.answer else value
+        elif key == self.answer_key:
+            # Hints that followed the answer keep following it
+            if self._hints is not None and self._hints == value:
+                self._hints = None
+            self.answer = value
+        elif key in ('id', 'question', 'type', 'all_answers', 'difficulty_level'):
+            setattr(self, key, value)
+        else:
+            raise KeyError(key)
+
+
+class Level(Record):
+    """ One level exercise of a topic and its questions """
+    __slots__ = ('id', 'title', 'questions')
+    FIELDS = (('id', 'id'), ('title', 'title'), ('questions', 'questions'))
+    CONSTANTS = (('description', DESCRIPTION), ('mastery_model', exercises.M_OF_N), ('license', licenses.ALL_RIGHTS_RESERVED),
+                 ('domain_ns', COPYRIGHT_HOLDER), ('Copyright Holder', COPYRIGHT_HOLDER))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['title'], [Question.from_dict(question) for question in data.get('questions', [])])
+
+
+class Topic(Record):
+    """ A topic of the magogenie tree; children are its levels and subtopics """
+    __slots__ = ('ancestry', 'id', 'title', 'children')
+    FIELDS = (('ancestry', 'ancestry'), ('id', 'id'), ('title', 'title'), ('children', 'children'))
+    CONSTANTS = (('description', DESCRIPTION), ('license', licenses.ALL_RIGHTS_RESERVED), ('mastery_model', exercises.M_OF_N))
+
+    def setdefault(self, key, default=None):
+        if key == 'children' and self.children is None:
+            self.children = default
+        return self[key]
+
+
+def as_plain(value):
+    """ value with every record in it turned into the plain dict it replaces, for JSON """
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return dict((key, as_plain(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [as_plain(item) for item in value]
+    return value
@@ -0,0 +1,268 @@
+#############################################################################
+#   python replay.py record <store> [board ...]     # record the live APIs  #
+#   python replay.py generate <store> <questions>   # synthetic store       #
+#   python replay.py serve <store> [port]           # serve a store         #
+#                                                                           #
+#   A fixture store is a directory holding tree.json (the TREE_URL          #
+#   document), questions.jsonl (one QUESTION_URL entry per line) and        #
+#   mathml.json (the LaTeX each MathML fragment converts to), so crawls     #
+#   replayed from it need neither the network nor mmltex.xsl.               #
+#############################################################################
+
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class FixtureStore(object):
+    """ Recorded TREE_URL and QUESTION_URL responses kept in a directory
+
+        Args:
+            path (str): directory holding tree.json, questions.jsonl and mathml.json
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tree = {}
+        self.questions = {}
+        self.mathml = {}
+
+    def load(self):
+        with open(os.path.join(self.path, 'tree.json'), encoding='utf-8') as f:
+            self.tree = json.load(f)
+        with open(os.path.join(self.path, 'questions.jsonl'), encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.questions[str(record['id'])] = record['value']
+        try:
+            with open(os.path.join(self.path, 'mathml.json'), encoding='utf-8') as f:
+                self.mathml = json.load(f)
+        except OSError:
+            self.mathml = {}
+        return self
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'tree.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.tree, f)
+        with open(os.path.join(self.path, 'questions.jsonl'), 'w', encoding='utf-8') as f:
+            for question_id, value in self.questions.items():
+                f.write(json.dumps({'id': question_id, 'value': value}) + '\n')
+        with open(os.path.join(self.path, 'mathml.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.mathml, f)
+        return self
+
+    def question_ids(self):
+        """ Question ids of every topic in the tree, in crawl order """
+        ids = []
+        for board in self.tree.get('boards', {}).values():
+            for standard in board['standards'].values():
+                for subject in standard['subjects'].values():
+                    for topic in subject['topics'].values():
+                        ids.extend(str(question_id) for question_id in topic['question_ids'])
+        return ids
+
+
+# Builds a store of about `questions` synthetic questions whose contents and
+# MathML come from the conversion corpus, spread over boards, standards,
+# topics and subtopics the way the real tree is
+def generate_fixtures(path, questions, corpus=None, standards=('3', '4', '5', '6', '7', '8'), topics_per_standard=6, boards=('BalBharati',)):
+    records = []
+    corpus = corpus or os.path.join(FIXTURES_DIR, 'edge_cases_corpus.jsonl')
+    with open(corpus, encoding='utf-8') as f:
+        records.extend(json.loads(line) for line in f if line.strip())
+    question_contents = [record['content'] for record in records if record['flag']]
+    answer_contents = [record['content'] for record in records if not record['flag']]
+
+    store = FixtureStore(path)
+    for record in records:
+        store.mathml.update(record.get('mathml', {}))
+    topic_count = max(1, len(boards) * len(standards) * topics_per_standard)
+    per_topic = max(1, questions // topic_count)
+    question_id = 900000
+    for b, board_id in enumerate(boards):
+        board = {'standards': {}}
+        for s, standard in enumerate(standards):
+            topics = {}
+            for t in range(topics_per_standard):
+                topic_id = (b * 10 + s + 1) * 1000 + t
+                ids = []
+                # Topics differ in size, like the real ones do
+                for i in range(per_topic + (t % 3) - 1):
+                    question_id += 1
+                    ids.append(question_id)
+                    store.questions[str(question_id)] = {
+                        'success': True,
+                        'question': {'id': question_id, 'content': question_contents[question_id % len(question_contents)],
+                                     'answer_type': ('radio', 'multiple_select')[question_id % 2], 'unit': '',
+                                     'difficulty_level': question_id % 3 + 1},
+                        'possible_answers': [{'id': question_id * 10 + k, 'content': answer_contents[(question_id + k) % len(answer_contents)],
+                                              'is_correct': k == question_id % 3} for k in range(3)]}
+                topics[str(topic_id)] = {'id': topic_id, 'name': 'Topic {0}'.format(topic_id),
+                                         'ancestry': str(topic_id - 1) if t % 3 else None, 'question_ids': ids}
+            board['standards'][standard] = {'subjects': {'Maths': {'topics': topics}}}
+        store.tree.setdefault('boards', {})[board_id] = board
+    return store.save()
+
+
+# Records the live TREE_URL and the QUESTION_URL responses of every topic in
+# the selected boards, together with the LaTeX of every MathML fragment.
+# The tree is trimmed to the selected boards so the store is self-contained.
+# Conversions go through caches of their own, empty and without a disk tier,
+# so every fragment is converted, and recorded, even after earlier crawls
+def record_fixtures(path, boards=None, limit=None):
+    import magogenie
+    from cache import ConversionCache
+    from treedoc import load_tree
+    store = FixtureStore(path)
+    tree = load_tree(magogenie.RESPONSE_CACHE, magogenie.TREE_URL, read_size=magogenie.TREE_READ_SIZE, metrics=magogenie.METRICS)
+    store.tree = {'boards': dict((key, value) for key, value in tree['boards'].items() if boards is None or key in boards)}
+    saved = dict((name, getattr(magogenie, name)) for name in ('convert_mathml', 'MATHML_CACHE', 'PAYLOAD_CACHE'))
+    def recording_convert_mathml(mathml):
+        latex = store.mathml[mathml] = saved['convert_mathml'](mathml)
+        return latex
+    magogenie.convert_mathml = recording_convert_mathml
+    magogenie.MATHML_CACHE = ConversionCache(lambda mathml: magogenie.convert_mathml(mathml), magogenie.MATHML_CACHE_SIZE)
+    magogenie.PAYLOAD_CACHE = ConversionCache(saved['PAYLOAD_CACHE'].convert, magogenie.PAYLOAD_CACHE_SIZE)
+    try:
+        ids = store.question_ids()[:limit]
+        for start in range(0, len(ids), magogenie.QUESTION_BATCH_SIZE):
+            question_info = magogenie.fetch_question_info(ids[start:start + magogenie.QUESTION_BATCH_SIZE])
+            magogenie.convert_question_batch(question_info)
+            store.questions.update(question_info)
+    finally:
+        for name, value in saved.items():
+            setattr(magogenie, name, value)
+    print ("Recorded {0} questions to {1}".format(len(store.questions), path))
+    return store.save()
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        replay = self.server.replay
+        parts = urlsplit(self.path)
+        ids = []
+        if parts.path == '/tree':
+            document = replay.store.tree
+        else:
+            for value in parse_qs(parts.query).get('ids', []):
+                ids.extend(question_id for question_id in value.split(',') if question_id)
+            document = dict((question_id, replay.store.questions[question_id]) for question_id in ids if question_id in replay.store.questions)
+        status = replay.plan(len(ids))
+        if status != 200:
+            self._send(status, b'')
+            return
+        body = json.dumps(document).encode('utf-8')
+        etag = '"{0}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'')
+            return
+        self._send(200, body, etag)
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ReplayServer(object):
+    """ Serves a fixture store over HTTP in place of TREE_URL and QUESTION_URL
+
+        The tree is served at /tree and questions at /questions?ids=<ids>,
+        with ETags so revalidation works as against the real server.
+
+        Args:
+            store (FixtureStore): loaded store to serve
+            latency (float): seconds every request waits before answering
+            latency_per_id (float): extra seconds per question id requested
+            error_rate (float): fraction of requests answered with error_status
+            error_status (int): status sent for injected errors
+            seed (int): seed for the error injection, for repeatable runs
+            port (int): port to listen on; 0 picks a free one
+    """
+    def __init__(self, store, latency=0.0, latency_per_id=0.0, error_rate=0.0, error_status=503, seed=None, port=0):
+        self.store = store
+        self.latency = latency
+        self.latency_per_id = latency_per_id
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def tree_url(self):
+        return 'http://127.0.0.1:{0}/tree'.format(self.port)
+
+    @property
+    def question_url(self):
+        return 'http://127.0.0.1:{0}/questions?ids=%s'.format(self.port)
+
+    def plan(self, id_count):
+        """ Waits out the configured latency and returns the status to answer with """
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        delay = self.latency + self.latency_per_id * id_count
+        if delay > 0:
+            time.sleep(delay)
+        return self.error_status if failed else 200
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port), _ReplayHandler)
+        self._server.daemon_threads = True
+        self._server.replay = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'record':
+        record_fixtures(sys.argv[2], sys.argv[3:] or None)
+    elif len(sys.argv) > 3 and sys.argv[1] == 'generate':
+        generate_fixtures(sys.argv[2], int(sys.argv[3]))
+    elif len(sys.argv) > 2 and sys.argv[1] == 'serve':
+        server = ReplayServer(FixtureStore(sys.argv[2]).load(), port=int(sys.argv[3]) if len(sys.argv) > 3 else 8765).start()
+        print ("TREE_URL = {0!r}\nQUESTION_URL = {1!r}".format(server.tree_url, server.question_url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.stop()
+    else:
+        print ("usage: python replay.py record <store> [board ...] | generate <store> <questions> | serve <store> [port]")
@@ -0,0 +1,100 @@
+import datetime
+import gzip
+import json
+import os
+import tempfile
+
+from records import Level, as_plain
+
+SNAPSHOT_FORMAT = 'magogenie-snapshot'
+# Bump when the layout of the lines changes; older snapshots are refused
+SNAPSHOT_VERSION = 1
+
+
+def _open(path, mode, compressed):
+    if compressed:
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=5)
+    return open(path, mode, encoding='utf-8')
+
+
+class SnapshotWriter(object):
+    """ Writes the events of a crawl to a snapshot file as they go by
+
+        A snapshot is line-delimited JSON, gzipped when the path ends in
+        .gz: a header naming the format, its version and the crawl options,
+        one line per board, standard and topic's levels in crawl order, and
+        an end line. It is written next to path and only replaces path once
+        the crawl finished, so an interrupted crawl leaves the last complete
+        snapshot in place. Questions point at images in IMAGE_DIR, which a
+        snapshot does not carry.
+
+        Args:
+            path (str): snapshot file
+            info (dict): crawl options and versions kept in the header
+    """
+    def __init__(self, path, info=None):
+        self.path = path
+        self.topics = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        os.close(fd)
+        self._file = _open(self._tmp, 'w', path.endswith('.gz'))
+        self._line({'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+                    'created': datetime.datetime.now().isoformat(), 'info': info or {}})
+
+    def _line(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')))
+        self._file.write('\n')
+
+    def write(self, event):
+        """ Writes one ('board', board), ('standard', standard) or ('levels', topic_key, levels) event """
+        if event[0] == 'levels':
+            self.topics += 1
+            self._line({'event': 'levels', 'topic': list(event[1]), 'levels': as_plain(event[2])})
+        else:
+            self._line({'event': event[0], event[0]: as_plain(event[1])})
+
+    def commit(self):
+        self._line({'event': 'end', 'topics': self.topics})
+        self._file.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp)
+
+
+# Passes the events of a crawl through, writing them to a snapshot at path.
+# The snapshot is only kept when every event went through
+def write_snapshot(events, path, info=None):
+    writer = SnapshotWriter(path, info)
+    try:
+        for event in events:
+            writer.write(event)
+            yield event
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    print ("Snapshot of {0} topics written to {1}".format(writer.topics, path))
+
+
+# Yields the events a snapshot was written from, reading one line at a time,
+# with levels as Level records the way a crawl yields them. Raises ValueError
+# for files that are not snapshots of this version or were cut short
+def iter_snapshot(path):
+    with _open(path, 'r', path.endswith('.gz')) as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError("{0} is not a magogenie snapshot".format(path))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("{0} is a version {1} snapshot, version {2} is needed".format(path, header.get('version'), SNAPSHOT_VERSION))
+        for line in f:
+            record = json.loads(line)
+            if record['event'] == 'levels':
+                yield 'levels', tuple(record['topic']), [Level.from_dict(level) for level in record['levels']]
+            elif record['event'] == 'end':
+                return
+            else:
+                yield record['event'], record[record['event']]
+    raise ValueError("{0} ends before its last topic".format(path))
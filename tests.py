@@ -9,9 +9,40 @@
 
 import pytest 
 import requests
-from urllib.request import urlopen,HTTPError
+from urllib.request import urlopen,Request,HTTPError
 import json
+import os
+import asyncio
+import shutil
+import subprocess
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from settings import *
+from cache import ResponseCache, ConversionCache
+from jsonstream import iter_events, iter_decoded_events
+from treedoc import TREE_PATH, iter_tree_events, load_tree
+from aiofetch import AsyncFetcher
+from batching import BatchPlanner
+import replay
+from replay import FixtureStore, ReplayServer, generate_fixtures, record_fixtures
+from metrics import Metrics
+from journal import CheckpointJournal
+from images import ImageStore, ImagePrefetcher, decode_data_uri, image_format
+from records import Question, Level, Topic
+from snapshot import write_snapshot, iter_snapshot
+from markup import QuestionMarkdown
+import html2text
+from concurrency import CircuitBreaker, ConcurrencyController, is_overload
+from aiofetch import FetchError
+from payloads import PayloadTable, question_payload
+from profiling import QuestionProfiler
+import pstats
+import base64
+import io
+import pickle
+from collections import deque
 
 question_type = ["radio","multiple_select","number","text","subjective"]
 level = [1,2,3]
@@ -129,3 +160,1217 @@ class TestUserHandling:
         '''
         assert True == bool(question_type_of_id in question_type)
 
+
+@pytest.fixture
+def response_cache(tmpdir):
+    '''
+    This method returns an empty response cache in a temporary directory
+    '''
+    return ResponseCache(str(tmpdir), 60, 4096)
+
+
+class TestResponseCache:
+    '''
+    Test cases for the on-disk QUESTION_URL/TREE_URL response cache
+    '''
+    def test_put_and_get(self, response_cache):
+        '''
+        Test is written to test whether a stored response is returned fresh with its validators
+        '''
+        response_cache.put('question:89555', {'success': True}, 'url', '"abc"', None)
+        entry = response_cache.get('question:89555')
+        assert entry['value'] == {'success': True}
+        assert entry['etag'] == '"abc"'
+        assert response_cache.is_fresh(entry)
+        assert response_cache.get('question:1') is None
+
+    def test_expired_entry_is_refreshed(self, response_cache):
+        '''
+        Test is written to test whether an expired entry becomes fresh after revalidation
+        '''
+        entry = response_cache.put('tree', {}, 'url', '"abc"', None)
+        entry['stored'] -= 120
+        assert not response_cache.is_fresh(entry)
+        assert response_cache.is_fresh(response_cache.refresh('tree', entry))
+
+    def test_eviction_keeps_cache_bounded(self, response_cache):
+        '''
+        Test is written to test whether least recently used entries are evicted past max_bytes
+        '''
+        for i in range(50):
+            response_cache.put('question:%d' % i, 'x' * 200)
+        response_cache.evict()
+        total = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, names in os.walk(response_cache.path) for name in names)
+        assert total <= response_cache.max_bytes
+        assert response_cache.get('question:49') is not None
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        body = json.dumps({'path': self.path}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestConversionCache:
+    '''
+    Test cases for the content-addressed MathML conversion cache
+    '''
+    def test_memory_and_disk_tiers(self, tmpdir):
+        '''
+        Test is written to test whether identical fragments are converted once and shared through the disk tier
+        '''
+        calls = []
+        def convert(source):
+            calls.append(source)
+            return source.upper()
+        disk = ResponseCache(str(tmpdir), float('inf'), 1024 * 1024)
+        first = ConversionCache(convert, 10, disk, '1')
+        assert first('<mn>1</mn>') == '<MN>1</MN>'
+        assert first('<mn>1</mn>') == '<MN>1</MN>'
+        second = ConversionCache(convert, 10, disk, '1')
+        assert second('<mn>1</mn>') == '<MN>1</MN>'
+        assert len(calls) == 1
+        assert first.take_counters() == {'misses': 1, 'hits': 1}
+        assert second.take_counters() == {'disk_hits': 1}
+        assert ConversionCache(convert, 10, disk, '2')('<mn>1</mn>') == '<MN>1</MN>'
+        assert len(calls) == 2
+
+    def test_layout_does_not_change_the_key(self):
+        '''
+        Test is written to test whether MathML differing only in whitespace, quoting or no-break space entities is normalized alike
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        expected = '<math><mrow><mi mathvariant="bold">x</mi><mtext> </mtext><mo>\xa0</mo></mrow></math>'
+        assert magogenie.normalize_mathml(expected) == expected
+        assert magogenie.normalize_mathml("<math>\n <mrow>\n  <mi mathvariant = 'bold'>x</mi>\n  <mtext> </mtext>"
+                                          "<mo>&#160;</mo>\n </mrow>\n</math>") == expected
+        assert magogenie.normalize_mathml('<math><mo>&#xA0;</mo></math>') == '<math><mo>\xa0</mo></math>'
+        # Not an XML entity, so it does not convert like a no-break space
+        assert magogenie.normalize_mathml('<math><mo>&nbsp;</mo></math>') == '<math><mo>&nbsp;</mo></math>'
+
+
+@pytest.fixture
+def local_server():
+    '''
+    This method returns the base URL of a local keep-alive HTTP server and the set of client addresses it saw
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+    server.clients = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1], server.clients
+    server.shutdown()
+    server.server_close()
+
+
+class TestAsyncFetcher:
+    '''
+    Test cases for the asyncio question fetch engine
+    '''
+    def test_connections_are_reused(self, local_server):
+        '''
+        Test is written to test whether sequential requests share one keep-alive connection
+        '''
+        base_url, clients = local_server
+        async def fetch_all():
+            fetcher = AsyncFetcher(1, 5, 0, 0)
+            try:
+                return [await fetcher.fetch(base_url + '/questions/%d' % i) for i in range(5)]
+            finally:
+                fetcher.close()
+        responses = asyncio.run(fetch_all())
+        assert [status for status, body, headers in responses] == [200] * 5
+        assert json.loads(responses[3][1].decode('utf-8')) == {'path': '/questions/3'}
+        assert len(clients) == 1
+
+
+@pytest.fixture
+def batch_planner(tmpdir):
+    '''
+    This method returns a batch planner starting at six ids per request
+    '''
+    return BatchPlanner('http://example.com/questions/%s', 6, 1, 40, 1.0, 10000, 120, str(tmpdir.join('planner.json')))
+
+
+class TestBatchPlanner:
+    '''
+    Test cases for adaptive QUESTION_URL batch sizing
+    '''
+    def test_grows_on_fast_responses(self, batch_planner):
+        '''
+        Test is written to test whether the batch size grows while requests are fast and small
+        '''
+        batch_planner.record(6, 0.06, 600)
+        assert batch_planner.size == 12
+        batch_planner.record(12, 0.12, 1200)
+        assert batch_planner.size == 24
+
+    def test_shrinks_and_splits_on_failure(self, batch_planner):
+        '''
+        Test is written to test whether a failed batch is split and growth is capped below its size
+        '''
+        halves = batch_planner.record_failure([1, 2, 3, 4, 5, 6])
+        assert halves == [[1, 2, 3], [4, 5, 6]]
+        assert batch_planner.size == 3
+        batch_planner.record(3, 0.01, 100)
+        assert batch_planner.size == 5
+
+    def test_respects_url_length_and_saves_size(self, batch_planner):
+        '''
+        Test is written to test whether batches stay under the URL limit and the size is reused next run
+        '''
+        batch_planner.size = 40
+        pending = deque(range(100000, 100040))
+        batch = batch_planner.next_batch(pending)
+        assert len(batch_planner.url_template % ','.join(map(str, batch))) <= 120
+        assert len(batch) + len(pending) == 40
+        batch_planner.save()
+        reloaded = BatchPlanner(batch_planner.url_template, 6, 1, 40, 1.0, 10000, 120, batch_planner.state_path)
+        assert reloaded.size == 40
+
+
+MATHML_FRAGMENTS = [
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><mfrac><mn>3</mn><mn>4</mn></mfrac></math>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><msup><mi>x</mi><mn>2</mn></msup><mo>+</mo><msqrt><mn>5</mn></msqrt></math>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><menclose notation="longdiv"><mn>125</mn></menclose></math>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><mover><mrow><mo>)</mo><mspace width="1em"/></mrow><mo>&#xAF;</mo></mover></math>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><mtable><mtr><mtd><mn>1</mn></mtd><mtd><mn>2</mn></mtd></mtr></mtable></math>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><mi>&#x3C0;</mi><mo>&#xD7;</mo><mn>7</mn></math>',
+    '<math xmlns="http://www.w3.org/1998/Math/MathML"><mtext>&nbsp;</mtext></math>',
+]
+
+
+class TestMathmlTransform:
+    '''
+    Test cases for the in-process mmltex.xsl engine
+    '''
+    @pytest.mark.parametrize('mathml', MATHML_FRAGMENTS)
+    def test_matches_xsltproc(self, mathml):
+        '''
+        Test is written to test whether the compiled stylesheet prints exactly what xsltproc prints
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        if magogenie.etree is None or shutil.which('xsltproc') is None or not os.path.exists(magogenie.MMLTEX_XSL):
+            pytest.skip('needs lxml, xsltproc and mmltex.xsl')
+        p = subprocess.Popen(['xsltproc', magogenie.MMLTEX_XSL, '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output, err = p.communicate(mathml.encode('utf-8'))
+        assert magogenie.transform_mathml(mathml) == output.decode('utf-8')
+
+    @pytest.mark.parametrize('mathml', MATHML_FRAGMENTS)
+    def test_normalized_fragment_converts_the_same(self, mathml):
+        '''
+        Test is written to test whether a fragment laid out differently converts exactly like the original
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        if magogenie.etree is None or not os.path.exists(magogenie.MMLTEX_XSL):
+            pytest.skip('needs lxml and mmltex.xsl')
+        spread = mathml.replace('><', '>\n  <').replace('"', "'").replace('=', ' = ')
+        assert magogenie.normalize_mathml(spread) == magogenie.normalize_mathml(mathml)
+        assert magogenie.transform_mathml(magogenie.normalize_mathml(spread)) == magogenie.transform_mathml(mathml)
+
+
+def _corpus_records():
+    bench = pytest.importorskip('bench')
+    return bench, bench.load_corpus(bench.corpus_files())
+
+
+class TestConvertQuestionContent:
+    '''
+    Test cases for the compiled convert_question_content rewrite rules
+    '''
+    def test_matches_legacy_on_corpus(self, monkeypatch):
+        '''
+        Test is written to test whether every corpus string converts byte for byte as before
+        '''
+        bench, records = _corpus_records()
+        assert records
+        monkeypatch.setattr(bench.magogenie, 'mathml_to_latex', bench.replay_mathml(records))
+        # The legacy function left base64 images inline
+        monkeypatch.setattr(bench.magogenie, 'IMAGE_STORE', None)
+        for record in records:
+            expected = bench.legacy_convert_question_content(record['content'], record['q_id'], record['flag'])
+            assert bench.convert_question_content(record['content'], record['q_id'], record['flag']) == expected, record['q_id']
+
+
+# Question markup the direct Markdown conversion handles, and some it hands to html2text
+MARKDOWN_CASES = [
+    '<p>Fill in: 7 + ___ = 12</p><p>Path \\\\ with \\_ and 1. not a list</p>',
+    '<div>Outer <span style="color:red">red <sup>2</sup> <sub>3</sub></span></div><br/>After&nbsp;break &#10; &#x2212;1',
+    '<p><b>Bold</b>, <i>italic</i>, <u>under</u> and <a href="/assets/x.png">link</a> <a href="http://a.com/">http://a.com/</a></p>',
+    '<p><img src="/assets/q(1).png" alt="a [triangle]"/> ' + 'a long sentence that has to be wrapped ' * 4 + '</p>',
+    '<table><tr><th>x</th><th>y</th></tr><tr><td>1</td><td>2</td></tr></table><ol start="3"><li>one<ul><li>two</li></ul></li></ol>',
+    '<P CLASS="q">- dash + plus &amp; &lt;tag&gt; &rsquo;quote&#8217; &unknown;</P>',
+    '<h1>Heading</h1><p>a</p>',
+    '<p>x <!-- comment --> y &amp z < w</p>',
+]
+
+
+class TestQuestionMarkdown:
+    '''
+    Test cases for the direct HTML to Markdown conversion of question markup
+    '''
+    @pytest.mark.parametrize('content', MARKDOWN_CASES)
+    def test_matches_html2text(self, content):
+        '''
+        Test is written to test whether the conversion prints exactly what html2text prints
+        '''
+        assert QuestionMarkdown().convert(content) == html2text.html2text(content)
+
+    def test_corpus_converts_directly(self, monkeypatch):
+        '''
+        Test is written to test whether every corpus string is converted without html2text, and the same
+        '''
+        bench, records = _corpus_records()
+        monkeypatch.setattr(bench.magogenie, 'mathml_to_latex', bench.replay_mathml(records))
+        monkeypatch.setattr(bench.magogenie, 'IMAGE_STORE', None)
+        converter = QuestionMarkdown()
+        for content in bench.markdown_inputs(records):
+            assert converter.convert(content) == html2text.html2text(content), content
+        assert converter.counters == {'direct': len(records)}
+        for content in MARKDOWN_CASES[-2:]:
+            converter.convert(content)
+        assert converter.take_counters()['fallback'] == 2
+
+
+def _question_value(question_id, content, answers):
+    return {'success': True,
+            'question': {'id': question_id, 'content': content, 'answer_type': 'radio', 'unit': '', 'difficulty_level': 1},
+            'possible_answers': [{'id': question_id * 10 + index, 'content': answer, 'is_correct': index == 0}
+                                 for index, answer in enumerate(answers)]}
+
+
+class TestPayloads:
+    '''
+    Test cases for converting and keeping every distinct question payload once
+    '''
+    def test_payload_ignores_ids(self):
+        '''
+        Test is written to test whether questions differing only by their ids have the same payload
+        '''
+        first, second = _question_value(1, '<p>2 + 2?</p>', ['4', '5']), _question_value(2, '<p>2 + 2?</p>', ['4', '5'])
+        second['question']['difficulty_level'] = 3
+        assert question_payload(first) == question_payload(second)
+        assert question_payload(first) != question_payload(_question_value(1, '<p>2 + 2?</p>', ['5', '4']))
+
+    def test_share_strings_not_lists(self):
+        '''
+        Test is written to test whether a repeated question shares the strings of the first one but keeps its own lists
+        '''
+        first = Question('1', 'What is 1 + 1?', 'multiple_selection', ['2', '3'], 'correct_answers', ['2'], difficulty_level=1)
+        second = Question('2', ''.join(['What is ', '1 + 1?']), 'multiple_selection', ['2', '3'], 'correct_answers', ['2'], difficulty_level=2)
+        table = PayloadTable()
+        table.share(first)
+        table.share(second)
+        assert second.question is first.question
+        assert second.all_answers == first.all_answers and second.all_answers is not first.all_answers
+        assert second['id'] == '2' and second['difficulty_level'] == 2
+        assert table.report() == {'questions': 2, 'distinct': 1, 'repeated': 1, 'ratio': 0.5}
+
+    def test_repeated_payload_converted_once(self, monkeypatch):
+        '''
+        Test is written to test whether a question repeating a converted payload is built without converting it again
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        monkeypatch.setattr(magogenie, 'PAYLOAD_CACHE', ConversionCache(magogenie.PAYLOAD_CACHE.convert, 16))
+        info = {'1': _question_value(1, '<p>2 + 2?</p>', ['4', '5']), '2': _question_value(2, '<p>2 + 2?</p>', ['4', '5'])}
+        first, second = magogenie.convert_question_info(info)
+        assert magogenie.PAYLOAD_CACHE.take_counters() == {'misses': 1, 'hits': 1}
+        assert (first['id'], second['id']) == ('1', '2')
+        assert first['question'] == second['question'] and first['all_answers'] is not second['all_answers']
+
+        table = PayloadTable()
+        reused, rest = magogenie.reuse_converted(table, ([1], {'1': info['1']}, {'elapsed': 0.5, 'bytes': 10}))
+        assert reused is None and rest[0] == [1]
+        table.record([1], [first])
+        reused, rest = magogenie.reuse_converted(table, ([2, 3], {'2': info['2'], '3': _question_value(3, '<p>3?</p>', ['3'])}, {}))
+        assert reused['question_ids'] == [2] and reused['counters'] == {'payloads_reused': 1}
+        assert reused['questions'][0]['id'] == '2' and reused['questions'][0]['question'] == first['question']
+        assert rest[0] == [3] and list(rest[1]) == ['3']
+
+
+class TestProfiler:
+    '''
+    Test cases for the opt-in profiling of questions and MathML fragments
+    '''
+    def test_keeps_slowest(self):
+        '''
+        Test is written to test whether only the slowest questions are kept, across merged worker snapshots
+        '''
+        profiler, worker = QuestionProfiler(top=2), QuestionProfiler(top=2)
+        profiler.reset(True)
+        worker.reset(True)
+        for question_id, seconds in (('1', 0.01), ('2', 0.05), ('3', 0.03)):
+            profiler.question(question_id, 'x' * 10, lambda payload: time.sleep(seconds))
+        worker.question('4', 'y', lambda payload: time.sleep(0.04))
+        profiler.merge(worker.take())
+        assert [item['id'] for item in profiler.questions.ranked()] == ['2', '4']
+        assert profiler.totals['questions'] == 4
+        assert worker.take()['totals'] == {}
+
+    def test_disabled_records_nothing(self):
+        '''
+        Test is written to test whether a disabled profiler only converts
+        '''
+        profiler = QuestionProfiler(dumps=1)
+        assert profiler.question('1', 'payload', len) == 7
+        assert profiler.fragment('<math/>', len) == 7
+        assert profiler.take() is None and not profiler.totals
+
+    def test_report_and_dumps(self, tmpdir, monkeypatch):
+        '''
+        Test is written to test whether converted questions and fragments are ranked with their stages and cProfile dumps
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        monkeypatch.setattr(magogenie, 'PAYLOAD_CACHE', ConversionCache(magogenie.PAYLOAD_CACHE.convert, 16))
+        monkeypatch.setattr(magogenie, 'MATHML_CACHE', ConversionCache(magogenie.MATHML_CACHE.convert, 16))
+        monkeypatch.setattr(magogenie, 'PROFILER', QuestionProfiler(top=5, dumps=1))
+        monkeypatch.setattr(magogenie, 'transform_mathml', magogenie.METRICS.timed('transform_mathml')(lambda mathml: 'x^{2}'))
+        magogenie.set_profiling(True)
+        try:
+            magogenie.convert_question_info({'1': _question_value(1, '<p>What is <math><msup><mi>x</mi><mn>2</mn></msup></math>?</p>', ['4']),
+                                             '2': _question_value(2, '<p>2 + 2?</p>', ['4', '5'])})
+            report = magogenie.PROFILER.report(str(tmpdir))
+        finally:
+            magogenie.set_profiling(False)
+        assert report['totals']['questions'] == 2 and report['totals']['fragments'] == 1
+        assert sorted(item['id'] for item in report['questions']) == ['1', '2']
+        first = next(item for item in report['questions'] if item['id'] == '1')
+        assert first['mathml'] == 1 and 'transform_mathml' in first['stages']
+        assert report['fragments'][0]['question'] == '1' and report['fragments'][0]['transform_seconds'] > 0
+        assert json.load(open(str(tmpdir.join('profile.json'))))['totals'] == report['totals']
+        dumped = [item for item in report['questions'] if 'profile' in item]
+        assert len(dumped) == 1 and pstats.Stats(dumped[0]['profile']).total_calls > 0
+
+
+class TestIncrementalCrawl:
+    '''
+    Test cases for reusing stored topics between crawls
+    '''
+    def test_topic_reused_until_ids_change(self, tmpdir, monkeypatch):
+        '''
+        Test is written to test whether stored levels are only reused for an unchanged question id list
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        monkeypatch.setattr(magogenie, 'RESPONSE_CACHE', ResponseCache(str(tmpdir.join('responses')), 60, 1024 * 1024))
+        monkeypatch.setattr(magogenie, 'TOPIC_STORE', ResponseCache(str(tmpdir.join('topics')), 60, 1024 * 1024))
+        question = magogenie.Question('89555', 'What is 1 + 1?', magogenie.exercises.INPUT_QUESTION, None, 'answers', ['2'], difficulty_level=1)
+        levels = [magogenie.Level('Level_1_7', 'Level 1', [question])]
+        magogenie.save_topic_levels('7', [89555], levels)
+        assert magogenie.load_topic_levels('7', [89555]) is None
+        magogenie.RESPONSE_CACHE.put('question:89555', {'success': True})
+        magogenie.save_topic_levels('7', [89555], levels)
+        assert magogenie.load_topic_levels('7', [89555]) == levels
+        assert magogenie.load_topic_levels('7', [89555, 89556]) is None
+
+
+class TestStreamingTree:
+    '''
+    Test cases for building the channel while the crawl runs
+    '''
+    def test_levels_added_ahead_of_subtopics(self):
+        '''
+        Test is written to test whether exercises streamed into a topic land before its subtopics
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        topic = magogenie.nodes.TopicNode(source_id='7', title='Fractions')
+        topic.add_child(magogenie.nodes.TopicNode(source_id='8', title='Halves'))
+        question = {'id': '89555', 'type': magogenie.exercises.INPUT_QUESTION, 'question': 'What is 1 + 1?', 'answers': ['2'], 'hints': ['2']}
+        levels = [{'id': 'Level_1_7', 'title': 'Level 1', 'questions': [question], 'license': magogenie.licenses.ALL_RIGHTS_RESERVED}]
+        magogenie.add_levels(topic, levels)
+        assert [child.source_id for child in topic.children] == ['Level_1_7', '8']
+        assert topic.children[0].parent is topic
+
+    def test_board_and_standard_selection(self):
+        '''
+        Test is written to test whether boards and standards given on the command line are parsed
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        assert magogenie._as_list('BalBharati, CBSE', ['x']) == ['BalBharati', 'CBSE']
+        assert magogenie._as_list('all', ['x']) is None
+        assert magogenie._as_list(None, ['x']) == ['x']
+        assert sorted(['10', '3', '8', 'KG'], key=magogenie.standard_sort_key) == ['3', '8', '10', 'KG']
+
+    def test_topics_go_out_while_the_tree_is_read(self, monkeypatch):
+        '''
+        Test is written to test whether topics are handed over as they are read while boards and standards keep their order
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        def topic(topic_id, question_ids):
+            return {'id': topic_id, 'name': 'Topic %d' % topic_id, 'ancestry': None, 'question_ids': question_ids}
+        tree = {'boards': {
+            'A': {'standards': {'10': {'subjects': {'Maths': {'topics': {'1': topic(1, [11, 12])}}}},
+                                '9': {'subjects': {'Maths': {'topics': {'2': topic(2, [])}}}}}},
+            'B': {'standards': {'9': {'subjects': {'Maths': {'topics': {'3': topic(3, [31])}}}}}}}}
+        monkeypatch.setattr(magogenie, 'iter_tree_events', lambda: iter_decoded_events(tree, magogenie.TREE_PATH))
+        def items(boards, standards):
+            topics_by_key = {}
+            result = []
+            for item in magogenie.iter_selected_topics(False, boards, standards, topics_by_key):
+                if isinstance(item, magogenie.Note):
+                    result.append((item.value[0], item.value[1]['id']))
+                else:
+                    result.append(item)
+            return result, topics_by_key
+        result, topics_by_key = items(None, None)
+        assert result == [(('A', '10', '1'), [11, 12]), (('B', '9', '3'), [31]),
+                          ('board', 'B'), ('standard', '9'), ('board', 'A'), ('standard', '9'), ('standard', '10')]
+        assert sorted(topics_by_key) == [('A', '10', '1'), ('A', '9', '2'), ('B', '9', '3')]
+        # Listed boards go out as soon as they are read
+        result, topics_by_key = items(['A', 'C'], ['10'])
+        assert result == [(('A', '10', '1'), [11, 12]), ('board', 'A'), ('standard', '10')]
+
+
+@pytest.fixture
+def fixture_store(tmpdir):
+    '''
+    This method returns a small synthetic fixture store
+    '''
+    return generate_fixtures(str(tmpdir.join('store')), 40)
+
+
+class TestReplayServer:
+    '''
+    Test cases for serving recorded TREE_URL/QUESTION_URL responses offline
+    '''
+    def test_serves_tree_and_questions(self, fixture_store):
+        '''
+        Test is written to test whether the recorded tree and questions are served with revalidation
+        '''
+        store = FixtureStore(fixture_store.path).load()
+        ids = store.question_ids()[:3]
+        with ReplayServer(store) as server:
+            assert json.loads(urlopen(server.tree_url).read().decode('utf-8')) == store.tree
+            response = urlopen(server.question_url % ','.join(ids))
+            assert sorted(json.loads(response.read().decode('utf-8'))) == sorted(ids)
+            request = Request(server.question_url % ','.join(ids), headers={'If-None-Match': response.headers['ETag']})
+            with pytest.raises(HTTPError) as error:
+                urlopen(request)
+            assert error.value.code == 304
+
+    def test_error_injection(self, fixture_store):
+        '''
+        Test is written to test whether the server answers with the injected error status
+        '''
+        with ReplayServer(fixture_store, error_rate=1.0, error_status=503) as server:
+            with pytest.raises(HTTPError) as error:
+                urlopen(server.tree_url)
+            assert error.value.code == 503
+            assert server.errors == 1
+
+    def test_stale_questions_revalidated_in_other_batches(self, fixture_store, tmpdir, monkeypatch):
+        '''
+        Test is written to test whether expired questions are revalidated with 304s although the batches changed size
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        statuses = []
+        send = replay._ReplayHandler._send
+        def recording_send(handler, status, body, etag=None):
+            statuses.append(status)
+            return send(handler, status, body, etag)
+        monkeypatch.setattr(replay._ReplayHandler, '_send', recording_send)
+        monkeypatch.setattr(magogenie, 'RESPONSE_CACHE', ResponseCache(str(tmpdir.join('responses')), 60, 1024 * 1024))
+        ids = fixture_store.question_ids()
+        with ReplayServer(fixture_store) as server:
+            monkeypatch.setattr(magogenie, 'QUESTION_URL', server.question_url)
+            for start in range(0, len(ids), 7):
+                magogenie.fetch_question_info(ids[start:start + 7])
+            assert set(statuses) == {200}
+            first = len(statuses)
+            del statuses[:]
+            magogenie.RESPONSE_CACHE.ttl = 1
+            time.sleep(1.1)
+            question_info = {}
+            for start in range(0, len(ids), 5):
+                stats = {'requested': 0, 'bytes': 0}
+                question_info.update(magogenie.fetch_question_info(ids[start:start + 5], stats))
+        # One conditional request per URL the questions were stored from
+        assert statuses == [304] * first
+        assert question_info == dict((question_id, fixture_store.questions[question_id]) for question_id in ids)
+
+    def test_replayed_crawls_start_cold(self, fixture_store, tmpdir):
+        '''
+        Test is written to test whether every replayed crawl converts its questions again instead of reusing earlier ones
+        '''
+        bench = pytest.importorskip('bench')
+        ids = fixture_store.question_ids()[:10]
+        for run in range(2):
+            with bench.replayed_crawl(fixture_store, str(tmpdir.join('run%d' % run))):
+                bench.question_list(ids)
+                counters = bench.magogenie.PAYLOAD_CACHE.take_counters()
+            assert not counters.get('hits') and counters['misses'] > 0
+
+    @pytest.mark.parametrize('engine', ['asyncio', 'pool'])
+    def test_offline_crawl(self, fixture_store, tmpdir, monkeypatch, engine):
+        '''
+        Test is written to test whether a crawl replayed from the store converts every question with either fetch engine
+        '''
+        bench = pytest.importorskip('bench')
+        monkeypatch.setattr(bench.magogenie, 'FETCH_ENGINE', engine)
+        iter_tree_events = bench.magogenie.iter_tree_events
+        def slow_tree_events():
+            for event in iter_tree_events():
+                if event == ('end', ()):
+                    # Levels come in before their standards can go out, so they are held back
+                    time.sleep(0.5)
+                yield event
+        monkeypatch.setattr(bench.magogenie, 'iter_tree_events', slow_tree_events)
+        with bench.replayed_crawl(fixture_store, str(tmpdir.join('crawl'))):
+            tree = bench.get_magogenie_info_url(incremental=False, boards=None, standards=None)
+        def count(children):
+            return sum(len(child.get('questions', [])) + count(child.get('children', [])) for child in children)
+        assert count(tree) == len(fixture_store.questions)
+        assert [standard['id'] for standard in tree[0]['children']] == ['3', '4', '5', '6', '7', '8']
+        # Every batch is timed, whichever engine fetched it
+        assert bench.magogenie.METRICS.stages['question_list']['calls'] > 0
+
+    @pytest.mark.parametrize('engine', ['asyncio', 'pool'])
+    def test_tree_read_failing_part_way(self, fixture_store, tmpdir, monkeypatch, capsys, engine):
+        '''
+        Test is written to test whether the standards read whole still go out when the tree read fails part way
+        '''
+        bench = pytest.importorskip('bench')
+        magogenie = bench.magogenie
+        monkeypatch.setattr(magogenie, 'FETCH_ENGINE', engine)
+        iter_tree_events = magogenie.iter_tree_events
+        def broken_tree_events():
+            started = False
+            for event in iter_tree_events():
+                if started:
+                    raise ValueError("Connection reset part way through the tree")
+                # Stops right after the first topic of standard 4 that has questions
+                started = event[0] == 'item' and event[1][1] == '4' and bool(event[2]['question_ids'])
+                yield event
+        monkeypatch.setattr(magogenie, 'iter_tree_events', broken_tree_events)
+        with bench.replayed_crawl(fixture_store, str(tmpdir.join('crawl'))):
+            tree = bench.get_magogenie_info_url(incremental=False, boards=None, standards=None)
+        out = capsys.readouterr().out
+        assert "Connection reset part way through the tree" in out
+        assert "Levels of 1 topics were dropped" in out
+        assert [standard['id'] for standard in tree[0]['children']] == ['3']
+
+    def test_recording_after_a_crawl_keeps_every_fragment(self, fixture_store, tmpdir, monkeypatch):
+        '''
+        Test is written to test whether fixtures recorded after earlier conversions still hold every MathML fragment
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        monkeypatch.setattr(magogenie, 'convert_mathml', lambda mathml: fixture_store.mathml.get(mathml, ''))
+        monkeypatch.setattr(magogenie, 'RESPONSE_CACHE', ResponseCache(str(tmpdir.join('responses')), 60, 1024 * 1024))
+        with ReplayServer(fixture_store) as server:
+            monkeypatch.setattr(magogenie, 'TREE_URL', server.tree_url)
+            monkeypatch.setattr(magogenie, 'QUESTION_URL', server.question_url)
+            first = record_fixtures(str(tmpdir.join('first')))
+            second = record_fixtures(str(tmpdir.join('second')))
+        assert first.mathml and second.mathml == first.mathml
+        assert second.questions == fixture_store.questions
+
+
+class TestMetrics:
+    '''
+    Test cases for the per-stage timings collected during a crawl
+    '''
+    def test_recursive_calls_timed_once(self):
+        '''
+        Test is written to test whether a recursive stage is counted by its outermost call only
+        '''
+        metrics = Metrics()
+        @metrics.timed('walk')
+        def walk(depth):
+            return walk(depth - 1) + 1 if depth else 0
+        assert walk(5) == 5
+        assert metrics.report()['stages']['walk']['calls'] == 1
+
+    def test_worker_snapshots_merge(self):
+        '''
+        Test is written to test whether snapshots from workers add up with percentiles in range
+        '''
+        worker, parent = Metrics(), Metrics()
+        for i in range(1, 101):
+            worker.record('http', i / 1000.0, 10)
+        parent.record('http', 0.5)
+        worker.add_subtotal('BalBharati/3', questions=4)
+        parent.merge(worker.take())
+        assert worker.report() == {'stages': {}, 'subtotals': {}}
+        stage = parent.report()['stages']['http']
+        assert stage['calls'] == 101 and stage['bytes'] == 1000
+        assert 0.05 <= stage['p50_seconds'] <= 0.05 * 2 ** 0.25
+        assert 0.1 <= stage['p99_seconds'] <= 0.1 * 2 ** 0.25
+        assert stage['max_seconds'] == 0.5
+        assert parent.report()['subtotals'] == {'BalBharati/3': {'questions': 4}}
+
+
+class TestInlineImages:
+    '''
+    Test cases for moving inline base64 images out of question content
+    '''
+    def test_gif_transcoded_and_stored_once(self, tmpdir, monkeypatch):
+        '''
+        Test is written to test whether a GIF becomes one PNG file referenced by every question using it
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        Image = pytest.importorskip('PIL.Image')
+        monkeypatch.setattr(magogenie, 'IMAGE_STORE', ImageStore(str(tmpdir)))
+        gif = io.BytesIO()
+        Image.new('P', (4, 4)).save(gif, 'GIF')
+        payload = base64.b64encode(gif.getvalue()).decode('ascii')
+        content = '<p>Which shape?\n<img src="data:image/gif;base64,%s\n%s" /></p>' % (payload[:8], payload[8:])
+        first = magogenie.convert_question_content(content, '1', True)
+        second = magogenie.convert_question_content(content, '2', True)
+        assert first == second
+        assert 'base64' not in first and 'Which shape?' in first
+        files = [os.path.join(root, name) for root, dirs, names in os.walk(str(tmpdir)) for name in names]
+        assert len(files) == 1 and files[0].endswith('.png') and files[0] in first
+        with open(files[0], 'rb') as f:
+            assert image_format(f.read()) == 'png'
+
+    def test_undecodable_image_left_inline(self, tmpdir, monkeypatch):
+        '''
+        Test is written to test whether an image that cannot be read keeps the legacy inline form
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        monkeypatch.setattr(magogenie, 'IMAGE_STORE', ImageStore(str(tmpdir)))
+        assert decode_data_uri('data:image/bmp;base64,Qk0=') == b'BM'
+        converted = magogenie.convert_question_content('<p><img src="data:image/bmp;base64,Qk0=" /></p>', '1', False)
+        assert 'data:image/png;base64,Qk0=' in converted
+        assert os.listdir(str(tmpdir)) == []
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # A 1x1 PNG
+    PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status, body = (200, self.PNG) if self.path.startswith('/assets/') else (404, b'')
+        if self.path.startswith('/moved/') or self.path == '/loop':
+            status = 302
+            self.send_response(status)
+            self.send_header('Location', self.path.replace('/moved/', '/assets/'))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def image_server():
+    '''
+    This method returns the base URL of a local server answering /assets/* with one PNG, and the paths it was asked for
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHandler)
+    server.paths = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1], server.paths
+    server.shutdown()
+    server.server_close()
+
+
+class TestImagePrefetcher:
+    '''
+    Test cases for downloading question images into the local store
+    '''
+    def prefetcher(self, tmpdir):
+        return ImagePrefetcher(ImageStore(str(tmpdir.join('images'))), ResponseCache(str(tmpdir.join('urls')), 60, 1024 * 1024),
+                               AsyncFetcher(4, 5, 0, 0))
+
+    def test_downloads_once_and_dedups(self, tmpdir, image_server):
+        '''
+        Test is written to test whether each URL is fetched once and identical images share a file
+        '''
+        base_url, paths = image_server
+        prefetcher = self.prefetcher(tmpdir)
+        try:
+            first = prefetcher.prefetch(base_url + '/assets/a.png').result(5)
+            again = prefetcher.prefetch(base_url + '/assets/a.png').result(5)
+            other = prefetcher.prefetch(base_url + '/assets/b.png').result(5)
+            missing = prefetcher.prefetch(base_url + '/missing.png').result(5)
+        finally:
+            prefetcher.close()
+        assert first == again == other and os.path.exists(first)
+        assert missing is None
+        assert sorted(paths) == ['/assets/a.png', '/assets/b.png', '/missing.png']
+
+        # A later run finds the images already stored
+        prefetcher = self.prefetcher(tmpdir)
+        try:
+            assert prefetcher.prefetch(base_url + '/assets/a.png').result(5) == first
+        finally:
+            prefetcher.close()
+        assert len(paths) == 3
+
+    def test_redirects_followed(self, tmpdir, image_server):
+        '''
+        Test is written to test whether redirected images are downloaded and endless redirects fail
+        '''
+        base_url, paths = image_server
+        prefetcher = self.prefetcher(tmpdir)
+        try:
+            moved = prefetcher.prefetch(base_url + '/moved/c.png').result(5)
+            looping = prefetcher.prefetch(base_url + '/loop').result(5)
+        finally:
+            prefetcher.close()
+        assert moved is not None and os.path.exists(moved)
+        assert looping is None
+        assert paths[:2] == ['/moved/c.png', '/assets/c.png']
+        assert dict(prefetcher.counters) == {'downloaded': 1, 'failed': 1}
+
+    def test_topics_point_at_local_copies(self, tmpdir, image_server):
+        '''
+        Test is written to test whether converted questions are rewritten to the downloaded images
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        base_url, paths = image_server
+        image, missing = base_url + '/assets/a.png', base_url + '/missing.png'
+        question = {'id': '1', 'question': 'Which? ![](%s)' % image, 'all_answers': ['![](%s)' % missing, 'b'], 'hints': []}
+        prefetcher = self.prefetcher(tmpdir)
+        try:
+            topics = list(magogenie.localize_topic_images(prefetcher, [('7', [{'questions': [question]}])]))
+        finally:
+            prefetcher.close()
+        assert topics[0][0] == '7'
+        assert base_url not in question['question'] and str(tmpdir) in question['question']
+        assert question['all_answers'] == ['![](%s)' % missing, 'b']
+
+
+class TestCheckpointJournal:
+    '''
+    Test cases for resuming a crawl from its checkpoint journal
+    '''
+    selection = {'boards': ['BalBharati'], 'standards': ['3']}
+
+    def test_unfinished_run_resumes(self, tmpdir):
+        '''
+        Test is written to test whether finished batches survive a crash and failed ids are retried
+        '''
+        path = str(tmpdir.join('journal.sqlite'))
+        journal = CheckpointJournal(path, '1')
+        assert not journal.start(self.selection)
+        journal.record_batch(['1', '2'], [{'id': '1', 'question': 'What is 1 + 1?'}])
+        journal.record_failure(['3'], 'HTTP Error 500')
+        journal.close()
+
+        journal = CheckpointJournal(path, '1')
+        assert journal.start(self.selection)
+        assert journal.load(['1', '2', '3']) == {'1': {'id': '1', 'question': 'What is 1 + 1?'}, '2': None}
+        assert journal.failed() == ['3']
+        journal.record_batch(['3'], [])
+        assert journal.failed() == []
+        journal.finish()
+        assert not journal.start(self.selection)
+        assert journal.load(['1']) == {}
+        journal.close()
+
+    def test_other_selection_or_version_starts_over(self, tmpdir):
+        '''
+        Test is written to test whether a different selection or conversion version ignores the journal
+        '''
+        path = str(tmpdir.join('journal.sqlite'))
+        journal = CheckpointJournal(path, '1')
+        journal.start(self.selection)
+        journal.record_batch(['1'], [{'id': '1'}])
+        journal.close()
+        journal = CheckpointJournal(path, '2')
+        assert journal.start(self.selection)
+        assert journal.load(['1']) == {}
+        assert not journal.start({'boards': ['BalBharati'], 'standards': ['4']})
+        assert not journal.start(self.selection, resume=False)
+        journal.close()
+
+    def test_failing_question_finishes_the_run(self, fixture_store, tmpdir, capsys):
+        '''
+        Test is written to test whether a question that always fails is retried by the next crawl without resuming it
+        '''
+        bench = pytest.importorskip('bench')
+        # A radio question without a correct answer cannot be converted
+        broken = sorted(question_id for question_id, value in fixture_store.questions.items() if value['question']['answer_type'] == 'radio')[0]
+        for answer in fixture_store.questions[broken]['possible_answers']:
+            answer['is_correct'] = False
+        workdir = str(tmpdir.join('crawl'))
+        for run in range(2):
+            with bench.replayed_crawl(fixture_store, workdir):
+                bench.get_magogenie_info_url(incremental=False, boards=None, standards=None)
+            out = capsys.readouterr().out
+            assert 'Resum' not in out
+            assert '1 questions could not be fetched or converted: ' + broken in out
+        assert '1 of them failed in the last crawl too' in out
+
+
+class TestPipeline:
+    '''
+    Test cases for the fetch and conversion stages of the asyncio engine
+    '''
+    def test_fetching_waits_for_conversion(self, monkeypatch):
+        '''
+        Test is written to test whether fetching pauses while the queue of fetched batches is full
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        fetched = []
+        async def fetch_batches(planner, question_ids, put, controller=None):
+            for question_id in question_ids:
+                await put(([question_id], {}, {}))
+                fetched.append(question_id)
+        monkeypatch.setattr(magogenie, 'fetch_question_batches_async', fetch_batches)
+        monkeypatch.setattr(magogenie, 'PIPELINE_QUEUE_SIZE', 2)
+        batches = magogenie.iter_fetched_batches(None, list(range(20)))
+        assert next(batches)[0] == [0]
+        time.sleep(0.3)
+        # The batch taken plus a full queue
+        assert len(fetched) == 3
+        assert [batch[0][0] for batch in batches] == list(range(1, 20))
+
+    def test_fetching_stops_when_batches_are_no_longer_taken(self, monkeypatch):
+        '''
+        Test is written to test whether the fetch thread ends when the consumer of the batches leaves early
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        fetched = []
+        async def fetch_batches(planner, question_ids, put, controller=None):
+            await asyncio.gather(*[put(([question_id], {}, {})) for question_id in question_ids])
+            fetched.extend(question_ids)
+        monkeypatch.setattr(magogenie, 'fetch_question_batches_async', fetch_batches)
+        monkeypatch.setattr(magogenie, 'PIPELINE_QUEUE_SIZE', 2)
+        threads = set(threading.enumerate())
+        batches = magogenie.iter_fetched_batches(None, list(range(20)))
+        next(batches)
+        batches.close()
+        deadline = time.time() + 5
+        while set(threading.enumerate()) - threads and time.time() < deadline:
+            time.sleep(0.1)
+        assert not set(threading.enumerate()) - threads
+        assert fetched == []
+
+    def test_failed_conversion_split_without_refetching(self, monkeypatch):
+        '''
+        Test is written to test whether a batch that fails to convert is narrowed down to the question at fault
+        '''
+        magogenie = pytest.importorskip('magogenie')
+        def convert(question_info):
+            if '3' in question_info:
+                raise ValueError('cannot convert')
+            return [{'id': question_id} for question_id in question_info]
+        monkeypatch.setattr(magogenie, 'convert_question_info', convert)
+        question_info = dict((str(i), {}) for i in range(6))
+        pool = ThreadPool(2)
+        try:
+            results = list(magogenie.convert_fetched_batches(pool, [(list(map(str, range(6))), question_info, {'elapsed': 1.0})]))
+        finally:
+            pool.close()
+        converted = sorted(question['id'] for result in results if result['error'] is None for question in result['questions'])
+        assert converted == ['0', '1', '2', '4', '5']
+        assert [result['question_ids'] for result in results if result['error'] is not None and result['question_ids']] == [['3']]
+        assert sum(result['elapsed'] for result in results) == 1.0
+
+
+class TestRecords:
+    '''
+    Test cases for the compact question, level and topic records
+    '''
+    def test_question_reads_like_its_dict(self):
+        '''
+        Test is written to test whether a Question answers like the dict it replaces and keeps hints with the answer
+        '''
+        question = Question('89555', 'Pick 2', 'single_selection', ['1', '2'], 'correct_answer', '2', difficulty_level=1)
+        assert question == {'id': '89555', 'question': 'Pick 2', 'type': 'single_selection', 'all_answers': ['1', '2'],
+                            'correct_answer': '2', 'hints': '2', 'difficulty_level': 1}
+        assert question.get('answers') is None and 'all_answers' in question
+        question['correct_answer'] = '3'
+        assert question['hints'] == '3'
+        question['hints'] = 'Count them'
+        assert question['hints'] == 'Count them' and question['correct_answer'] == '3'
+
+    def test_records_survive_pickle_and_json(self):
+        '''
+        Test is written to test whether records pickle compactly and round trip through their dicts
+        '''
+        question = Question('89555', 'What is 1 + 1?', 'input_question', None, 'answers', ['2'], difficulty_level=1)
+        level = Level('Level_1_7', 'Level 1', [question])
+        assert pickle.loads(pickle.dumps(level)) == level
+        assert len(pickle.dumps(question)) < len(pickle.dumps(question.to_dict()))
+        assert Level.from_dict(json.loads(json.dumps(level.to_dict()))) == level
+        assert level['license'] == Level('Level_2_7', 'Level 2', [])['license']
+        topic = Topic(None, '7', 'Fractions', [])
+        assert topic.setdefault('children', []) is topic['children']
+
+
+class TestSnapshot:
+    '''
+    Test cases for writing a crawl to a snapshot and building from it
+    '''
+    def events(self):
+        question = Question('89555', 'What is 1 + 1?', 'input_question', None, 'answers', ['2'], difficulty_level=1)
+        topic = Topic(None, '7', '1 Fractions', [])
+        return [('board', {'id': 'BalBharati', 'title': 'BalBharati', 'children': []}),
+                ('standard', {'id': '3', 'title': '3', 'children': [topic]}),
+                ('levels', ('BalBharati', '3', '7'), [Level('Level_1_7', 'Level 1', [question])])]
+
+    def test_events_round_trip(self, tmpdir):
+        '''
+        Test is written to test whether a snapshot yields the events it was written from
+        '''
+        path = str(tmpdir.join('snapshot.jsonl.gz'))
+        events = self.events()
+        assert list(write_snapshot(iter(events), path, {'boards': ['BalBharati']})) == events
+        loaded = list(iter_snapshot(path))
+        assert loaded == events
+        assert isinstance(loaded[2][2][0], Level)
+
+    def test_interrupted_crawl_keeps_last_snapshot(self, tmpdir):
+        '''
+        Test is written to test whether a crawl that stops part way leaves the previous snapshot alone
+        '''
+        path = str(tmpdir.join('snapshot.jsonl'))
+        list(write_snapshot(iter(self.events()), path))
+        events = write_snapshot(iter(self.events()), path)
+        next(events)
+        events.close()
+        assert len(list(iter_snapshot(path))) == 3
+        assert tmpdir.listdir() == [tmpdir.join('snapshot.jsonl')]
+
+    def test_cut_short_or_other_version_refused(self, tmpdir):
+        '''
+        Test is written to test whether truncated snapshots and other versions are refused
+        '''
+        path = str(tmpdir.join('snapshot.jsonl'))
+        list(write_snapshot(iter(self.events()), path))
+        lines = open(path).read().splitlines()
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines[:-1]) + '\n')
+        with pytest.raises(ValueError):
+            list(iter_snapshot(path))
+        with open(path, 'w') as f:
+            f.write(lines[0].replace('"version":1', '"version":0') + '\n')
+        with pytest.raises(ValueError):
+            list(iter_snapshot(path))
+
+
+class TestPlan:
+    '''
+    Test cases for planning a crawl from the tree document alone
+    '''
+    def test_counts_and_cache_coverage(self, fixture_store, tmpdir, monkeypatch, capsys):
+        '''
+        Test is written to test whether the plan counts topics, questions, batches and cached questions
+        '''
+        plan = pytest.importorskip('plan')
+        monkeypatch.setattr(plan, 'CACHE_DIR', str(tmpdir.join('cache')))
+        monkeypatch.setattr(plan, 'STATE_DIR', str(tmpdir.join('state')))
+        monkeypatch.setattr(plan, 'QUESTION_BATCH_SIZE', 10)
+        ids = fixture_store.question_ids()
+        with ReplayServer(fixture_store) as server:
+            monkeypatch.setattr(plan.settings, 'TREE_URL', server.tree_url)
+            monkeypatch.setattr(plan.settings, 'QUESTION_URL', server.question_url)
+            totals = plan.plan(['BalBharati'], None)
+        assert totals == {'topics': 36, 'questions': len(ids), 'fresh': 0, 'stale': 0, 'missing': len(ids), 'batches': 4}
+        cache = ResponseCache(str(tmpdir.join('cache')), 60, 1024 * 1024)
+        for question_id in ids[:35]:
+            cache.put('question:' + question_id, {'success': True})
+        # The tree comes from the response cache this time
+        totals = plan.plan(['BalBharati'], ['3', '4', '5', '6', '7', '8'], offline=True)
+        assert (totals['fresh'], totals['missing'], totals['batches']) == (35, len(ids) - 35, 1)
+        assert 'BalBharati/3/Maths' in capsys.readouterr().out
+
+    def test_cache_coverage_is_read_only(self, tmpdir):
+        '''
+        Test is written to test whether cache coverage reads when entries were stored without marking them as used
+        '''
+        plan = pytest.importorskip('plan')
+        cache = ResponseCache(str(tmpdir), 60, 1024 * 1024)
+        cache.put('question:1', {'success': True, 'text': 'x' * 1000})
+        cache.refresh('question:2', cache.put('question:2', {'success': True}))
+        writer = cache.writer('question:3')
+        writer.write(b'{"success": true}')
+        writer.commit()
+        stale = cache.put('question:4', {'success': True})
+        stale['stored'] -= 120
+        cache._write('question:4', stale)
+        for key in ('question:1', 'question:2', 'question:3', 'question:4'):
+            os.utime(cache._filename(key), (1000, 1000))
+        coverage = plan.cache_coverage(cache, ['1', '2', '3', '4', '5'])
+        assert coverage == {'1': 'fresh', '2': 'fresh', '3': 'fresh', '4': 'stale', '5': 'missing'}
+        for key in ('question:1', 'question:2', 'question:3', 'question:4'):
+            assert os.path.getmtime(cache._filename(key)) == 1000
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConcurrency:
+    '''
+    Test cases for the adaptive request concurrency and the circuit breaker
+    '''
+    def controller(self, clock, initial=2, max_limit=16):
+        breaker = CircuitBreaker(3, 10, 40, 2, clock)
+        return ConcurrencyController(initial, 1, max_limit, 2.0, 0.5, breaker, clock)
+
+    def test_grows_and_backs_off(self):
+        '''
+        Test is written to test whether the limit grows on fast responses and halves on overload
+        '''
+        controller = self.controller(_Clock())
+        for i in range(6):
+            controller.record_success(0.01)
+        assert controller.allowed == 8
+        controller.record_failure(True)
+        assert controller.allowed == 4
+        # Requests that were in flight report the same congestion once
+        controller.record_failure(True)
+        assert controller.allowed == 4
+        # Past slow start the limit grows by one per round
+        for i in range(4):
+            controller.record_success(0.01)
+        assert controller.allowed == 5
+        # Failures unrelated to load leave the limit alone
+        controller.record_failure(False)
+        assert controller.allowed == 5
+
+    def test_slow_responses_lower_the_limit(self):
+        '''
+        Test is written to test whether growing latency takes one off the limit
+        '''
+        controller = self.controller(_Clock(), initial=4)
+        controller.record_success(0.01)
+        assert controller.allowed == 5
+        # Responses in the same round report one congestion
+        for i in range(4):
+            controller.record_success(0.1)
+        assert controller.allowed == 4
+        assert controller.counters['latency_decreases'] == 1
+
+    def test_breaker_waits_out_outages(self):
+        '''
+        Test is written to test whether the breaker opens, lets one probe through and closes on success
+        '''
+        clock = _Clock()
+        controller = self.controller(clock, initial=4)
+        for i in range(3):
+            controller.record_failure(True)
+        assert not controller.allows(0)
+        assert controller.wait_time() == 10
+        clock.now = 10
+        assert controller.allows(0) and not controller.allows(1)
+        # A failed probe opens the breaker again for twice as long
+        controller.record_failure(True)
+        assert controller.wait_time() == 20
+        clock.now = 30
+        controller.record_success(0.01)
+        assert controller.allows(0) and controller.breaker.state() == 'closed'
+        assert controller.breaker.outages == [30]
+        assert dict(controller.breaker.counters) == {'opened': 2, 'closed': 1}
+
+    def test_breaker_gives_up(self):
+        '''
+        Test is written to test whether a breaker that keeps failing stops waiting after max_trips
+        '''
+        clock = _Clock()
+        breaker = CircuitBreaker(1, 10, 40, 2, clock)
+        for i in range(3):
+            breaker.record_failure()
+            clock.now += 100
+        assert breaker.state() == 'closed' and breaker.counters['gave_up'] == 1
+
+    def test_overload_errors(self):
+        '''
+        Test is written to test whether only timeouts, connection errors, 429 and 5xx count as overload
+        '''
+        assert is_overload(FetchError('http://example.com', 503))
+        assert is_overload(FetchError('http://example.com', 429))
+        assert not is_overload(FetchError('http://example.com', 404))
+        assert is_overload(ConnectionResetError())
+        assert is_overload(asyncio.TimeoutError())
+        assert not is_overload(ValueError('bad json'))
+
+
+class TestJsonStream:
+    '''
+    Test cases for reading the tree document as it arrives
+    '''
+    path = ('boards', None, 'standards', None, 'topics', None)
+    document = {'version': 2, 'boards': {
+        'A': {'name': 'Board \u00e9', 'standards': {'1': {'topics': {'7': {'id': 7, 'ratio': -1.5e-3, 'ids': [1, 22, 333]}}},
+                                                   '2': {'topics': {}, 'empty': None}}},
+        'B': {'standards': {}}, 'C': 'not an object'}}
+
+    def test_chunks_give_the_decoded_events(self):
+        '''
+        Test is written to test whether a document split anywhere is walked like the decoded document
+        '''
+        body = json.dumps(self.document, ensure_ascii=False).encode('utf-8')
+        expected = list(iter_decoded_events(self.document, self.path))
+        assert ('item', ('A', '1', '7'), self.document['boards']['A']['standards']['1']['topics']['7']) in expected
+        assert expected[-1] == ('end', ())
+        for size in range(1, 9):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            assert list(iter_events(chunks, self.path)) == expected
+
+    def test_broken_documents_raise(self):
+        '''
+        Test is written to test whether a document that ends early or goes on is refused
+        '''
+        body = json.dumps(self.document).encode('utf-8')
+        for broken in (body[:-1], body[:len(body) // 2], body + b' {}', b''):
+            with pytest.raises(ValueError):
+                list(iter_events([broken], self.path))
+
+    def test_streamed_entry_round_trip(self, tmpdir):
+        '''
+        Test is written to test whether a cache entry written as it arrives reads back whole or streamed
+        '''
+        cache = ResponseCache(str(tmpdir), 60, 1024 * 1024)
+        body = json.dumps(self.document).encode('utf-8')
+        writer = cache.writer('tree', 'http://example.com/tree', '"v1"')
+        for i in range(0, len(body), 5):
+            writer.write(body[i:i + 5])
+        writer.commit()
+        assert cache.get('tree')['value'] == self.document
+        header = cache.header('tree')
+        assert header['etag'] == '"v1"' and cache.is_fresh(header) and 'value' not in header
+        assert b''.join(cache.iter_value('tree', 7)) == body
+        cache.refresh_streamed('tree', header)
+        assert cache.get('tree')['value'] == self.document
+        # Entries put whole have no header of their own
+        cache.put('tree', self.document)
+        assert cache.header('tree') is None
+        writer = cache.writer('tree')
+        writer.write(b'{"half')
+        writer.abort()
+        assert cache.get('tree')['value'] == self.document
+        assert [name for name in os.listdir(os.path.dirname(cache._filename('tree'))) if name.endswith('.tmp')] == []
+
+    def test_tree_downloaded_once_then_read_from_the_cache(self, fixture_store, tmpdir):
+        '''
+        Test is written to test whether the tree is cached as it is downloaded, revalidated, and read offline
+        '''
+        cache = ResponseCache(str(tmpdir), 60, 1024 * 1024)
+        with pytest.raises(LookupError):
+            load_tree(cache, 'http://127.0.0.1:1/tree', offline=True)
+        expected = list(iter_decoded_events(fixture_store.tree, TREE_PATH))
+        with ReplayServer(fixture_store) as server:
+            assert list(iter_tree_events(cache, server.tree_url, read_size=100)) == expected
+            assert cache.header('tree')['url'] == server.tree_url
+            cache.ttl = 0
+            metrics = Metrics()
+            assert load_tree(cache, server.tree_url, metrics=metrics) == fixture_store.tree
+            assert server.requests == 2
+        assert cache.header('tree') is not None
+        assert list(iter_tree_events(cache, server.tree_url, offline=True)) == expected
+
@@ -0,0 +1,87 @@
+import time
+from urllib.request import urlopen, Request, HTTPError
+
+from cache import validator_headers
+from jsonstream import iter_events, iter_decoded_events
+
+# Members of the TREE_URL document the crawl walks: every topic of every
+# subject of every standard of every board
+TREE_PATH = ('boards', None, 'standards', None, 'subjects', None, 'topics', None)
+
+
+# The events of the TREE_URL document at url along path (see
+# jsonstream.iter_events), read as it arrives. The document is kept in cache
+# under 'tree': a download is copied into it as it is read (a StreamedEntry)
+# and a fresh copy is read back from disk the same way, so the document is
+# never decoded in one piece; copies cached whole by earlier versions are
+# decoded as before. Offline, any cached copy is used and nothing is
+# fetched. The download is timed as 'http' in metrics, a Metrics
+def iter_tree_events(cache, url, path=TREE_PATH, read_size=64 * 1024, offline=False, metrics=None):
+    header = cache.header('tree')
+    entry = cache.get('tree') if header is None else None
+    if header is not None and (offline or cache.is_fresh(header)):
+        events = iter_events(cache.iter_value('tree', read_size), path)
+    elif entry is not None and (offline or cache.is_fresh(entry)):
+        events = iter_decoded_events(entry['value'], path)
+    elif offline:
+        raise LookupError("The tree document is not in the response cache")
+    else:
+        events = _download_events(cache, url, path, read_size, metrics, header, entry)
+    entry = None
+    for event in events:
+        yield event
+
+
+# iter_tree_events for a cached document that is missing or stale, which is
+# revalidated against header or entry, whichever is cached
+def _download_events(cache, url, path, read_size, metrics, header, entry):
+    start = time.perf_counter()
+    try:
+        conn = urlopen(Request(url, headers=validator_headers(header or entry)))
+    except HTTPError as e:
+        if e.code != 304 or (header or entry) is None:
+            raise
+        if metrics is not None:
+            metrics.record('http', time.perf_counter() - start)
+        if header is not None:
+            cache.refresh_streamed('tree', header)
+            events = iter_events(cache.iter_value('tree', read_size), path)
+        else:
+            events = iter_decoded_events(cache.refresh('tree', entry)['value'], path)
+        for event in events:
+            yield event
+        return
+    # The document cached whole is not needed once a new one is coming
+    entry = None
+    size = 0
+    writer = cache.writer('tree', url, conn.headers.get('ETag'), conn.headers.get('Last-Modified'))
+
+    def chunks():
+        nonlocal size
+        for chunk in iter(lambda: conn.read(read_size), b''):
+            writer.write(chunk)
+            size += len(chunk)
+            yield chunk
+
+    try:
+        for event in iter_events(chunks(), path):
+            yield event
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        conn.close()
+    writer.commit()
+    if metrics is not None:
+        metrics.record('http', time.perf_counter() - start, size)
+
+
+# The whole TREE_URL document, read through iter_tree_events
+def load_tree(cache, url, offline=False, read_size=64 * 1024, metrics=None):
+    document = {}
+    for event in iter_tree_events(cache, url, ('boards',), read_size, offline, metrics):
+        if event[0] == 'item':
+            document['boards'] = event[2]
+        elif event[0] == 'other':
+            document[event[2]] = event[3]
+    return document